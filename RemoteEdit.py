@@ -8,10 +8,19 @@ import time
 import re
 import json
 import pickle
-import tarfile
-import queue
 import hashlib
+import codecs
+import zlib
+import threading
+import stat
+import collections
+from .remote_edit import RemoteEditCompactCat
 from .remote_edit import RemoteEditConnectionWorker
+from .remote_edit import RemoteEditFuture
+from .remote_edit import RemoteEditLog
+from .remote_edit import RemoteEditStats
+from .remote_edit import RemoteEditSftpWorker
+from .remote_edit import RemoteEditWorkerPool
 
 
 class RemoteEditCommand(sublime_plugin.WindowCommand):
@@ -38,7 +47,10 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
     dontListExt = []
     catExcludeFolders = []
     bgCat = 0
-    bgCatStep = 0
+    # Shards of the top level for each of cat_workers, see cat_top_callback
+    catShardsPerWorker = 4
+    # Minutes added to the window refresh_cat looks for changes in
+    catRefreshSlack = 5
     permsLookup = None
     lsParams = "-lap --time-style=long-iso --color=never"
     unixLsParams = "-lapD\"%Y-%m-%d %H:%M\""
@@ -51,6 +63,10 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
     connector = None
     platform = sublime.platform()
     statusBarUpdater = False
+    navFuture = None
+    # See measure_transport
+    transportProbeBytes = 1048576
+    compressBelow = 4194304
     FILE_TYPE_FILE = 0
     FILE_TYPE_FOLDER = 1
     FILE_TYPE_SYMLINK = 2
@@ -77,12 +93,10 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
     # Copy directories to another location / server
     # server remote_path setting as dict + auto add to bookmarks.
     # settings
-    # logging to file + add debug level and allow turning off
     # configure server settings menu
     # multiple cat locations
     # status bar busy
     # Server health (disks, htop etc) Status bar?
-    # keepalives
     # SVN switch etc etc for configured dir's
 
     #  No fucking interactive shit ubuntu!!!!!
@@ -93,18 +107,40 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             # Tidy up our local temp folder. This should only contain files that are
             # open but occasionally if a command fails halfway through it doesn't
             # keep things tidy
-            return self.tidy_local_tmp_path()
+            self.tidy_local_tmp_path()
+            if self.get_settings().get("preconnect", False):
+                self.preconnect()
+            return
         # Ensure that the self.servers dict is populated
         self.load_server_list()
-        # Load the connector
-        if not self.connector:
-            self.connector = RemoteEditConnector(self.window)
+        self.load_connector()
         if action == "save" and save:
             # If save was called from the external RE events handler class then save
             # the file back to the server
             self.save(save)
         elif action == "kill":
             self.connector.killTab(viewId)
+        elif action == "jobs":
+            self.show_jobs()
+        elif action == "stats":
+            self.show_stats()
+        elif action == "log":
+            self.window.run_command(
+                "remote_edit_show_text",
+                {
+                    "title": "RemoteEdit log",
+                    "contents": "\n".join(RemoteEditLog.log.lines())
+                }
+            )
+        elif action == "stats_json":
+            self.window.run_command(
+                "remote_edit_show_text",
+                {
+                    "title": "RemoteEdit stats.json",
+                    "contents": self.connector.stats.to_json(),
+                    "syntax": "Packages/JavaScript/JSON.sublime-syntax"
+                }
+            )
         elif action == "fuzzy":
             # If fuzzy was passed as a command arg then we display the fuzzy file
             # list from the catalogue
@@ -169,6 +205,36 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             ])
             self.show_quick_panel(items, self.handle_server_select)
 
+    def load_connector(self):
+        if not self.connector:
+            self.connector = RemoteEditConnector(
+                self.window,
+                self.get_settings().get("connection_engine", "threads"),
+                self.get_settings().get("max_workers", 4),
+                self.get_settings().get("worker_idle_timeout", 60),
+                self.get_settings().get("server_idle_timeout", 600),
+                self.get_settings().get("reserve_interactive_worker", False),
+                self.get_settings().get("keepalive_interval", 60)
+            )
+
+    def preconnect(self):
+        # Connect to the server we're most likely to want next in the
+        # background so that the first listing doesn't have to wait
+        self.load_server_list()
+        serverName = self.get_settings().get(
+            "default_fuzzy_server",
+            self.get_settings().get("last_server", None)
+        )
+        if serverName not in self.servers:
+            return
+        info("Pre-connecting to %s", serverName)
+        self.load_connector()
+        settings = self.get_connection_settings(serverName)
+        appTypes = ["sftpv3" if settings.get("sftp_protocol", False) else "sftp"]
+        if not settings.get("sftp_only", False):
+            appTypes.append("ssh")
+        self.connector.preconnect(appTypes, serverName, settings)
+
     def load_server_list(self, force=False):
         if self.servers and not force:
             return
@@ -247,7 +313,8 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
         self.run_sftp_command(
             cmd,
             callback=self.save_callback,
-            cP=cP
+            cP=cP,
+            priority="interactive"
         )
 
     def save_callback(self, results, cP):
@@ -348,6 +415,10 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                 self.bgCat = 0
                 self.serverName = serverName
                 self.server = self.servers[serverName]
+                if not quickConnect:
+                    # Remembered for preconnect
+                    self.get_settings().set("last_server", serverName)
+                    sublime.save_settings(self.settingFile)
                 self.forceReloadCat = True
                 self.lastDir = self.get_server_setting("remote_path", None)
                 self.orderBy = self.parse_order_by_setting(
@@ -403,9 +474,11 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                     self.catExcludeFolders
                 )
         except Exception as e:
-            debug("Exception when gathering server settings for %s: %s" % (
-                self.serverName, e
-            ))
+            warning(
+                "Exception when gathering server settings for %s: %s",
+                self.serverName,
+                e
+            )
             self.serverName = None
             self.run()
             return
@@ -434,6 +507,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             cmd = self.hostInfoCommand
             self.run_ssh_command(cmd, callback=self.handle_server_info)
         else:
+            self.check_transport()
             self.check_cat()
             self.show_current_path_panel(doCat=False)
             if not self.statusBarUpdater and self.get_settings().get("status_bar_type"):
@@ -498,15 +572,77 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             settings["shell"] = shellVersion
             settings["os"] = osVersion
             self.save_server_settings(self.serverName, settings)
+            self.check_transport()
             self.check_cat()
             self.show_current_path_panel()
 
     def save_server_settings(self, server, settings):
         sSettings = self.get_settings()
         for settingKey in settings:
-            sSettings.set(self.serverName + ":" + settingKey, settings[settingKey])
+            sSettings.set(server + ":" + settingKey, settings[settingKey])
         sublime.save_settings(self.settingFile)
 
+    def check_transport(self):
+        # The first time we connect to a server measure the link and pick
+        # compression and a cipher to suit (see get_connection_settings).
+        # Whatever has been set by hand is left alone.
+        if self.get_server_setting("sftp_only", False):
+            return
+        if self.get_settings().get("%s:transport_compression" % self.serverName) is not None:
+            return
+        if self.get_server_setting("compression", "auto") != "auto" and self.get_server_setting("cipher", "auto") != "auto":
+            return
+        t = threading.Thread(
+            target=self.measure_transport,
+            args=(self.serverName, self.get_connection_settings())
+        )
+        t.daemon = True
+        t.start()
+
+    def measure_transport(self, serverName, settings):
+        # Runs in a thread of its own. RTT is the quickest of a few empty
+        # commands, throughput from pulling transportProbeBytes of random
+        # (so incompressible) data. Compression only pays where the link is
+        # slower than we can compress, below compressBelow bytes a second.
+        def run(cmd, timeout=None):
+            return self.connector.run_remote_command(
+                "ssh",
+                cmd,
+                timeout=timeout,
+                serverName=serverName,
+                serverSettings=settings,
+                priority="background"
+            )
+        # Connect first so that it isn't counted
+        if not run(":"):
+            return
+        rtt = None
+        for i in range(3):
+            startAt = time.time()
+            if not run(":"):
+                return
+            rtt = min(rtt or 60, time.time() - startAt)
+        startAt = time.time()
+        if not run("head -c %s /dev/urandom | base64" % self.transportProbeBytes, 120):
+            return
+        # base64 adds a third
+        throughput = int(
+            self.transportProbeBytes * 4 / 3 / max(time.time() - startAt - rtt, 0.001)
+        )
+        profile = {
+            "transport_rtt": int(rtt * 1000),
+            "transport_throughput": throughput,
+            "transport_compression": throughput < self.compressBelow,
+            "transport_cipher": RemoteEditConnectionWorker.get_fast_ciphers(
+                sublime.platform()
+            )
+        }
+        info("Transport profile for %s: %s", serverName, profile)
+        sublime.set_timeout(
+            lambda: self.save_server_settings(serverName, profile),
+            0
+        )
+
     def handle_quick_host(self, cs):
         self.server = {}
         self.server["settings"] = {}
@@ -587,7 +723,6 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             )
         self.run_ssh_command(
             cmd,
-            listenAttempts=2,
             callback=self.grep_callback_1,
             cP={"local": localPath, "remote": remotePath, "search": search}
         )
@@ -705,84 +840,118 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
 
     def navigate_unknown(self, path):
         # We don't know where it links to, slap a slash on the end of it and
-        # try to ls it...
+        # try to ls it. Any parent folders we've not listed yet go in the same
+        # batch so that we know what it is should it turn out to be a file.
         if path[-1] != "/":
             path += "/"
+        folders = [path]
+        head = path
+        while len(head) > 1:
+            (head, tail) = self.split_path(head)
+            head = head.rstrip("/") + "/"
+            f = self.get_file_from_cat(head)
+            if f and "/NO_INDEX/" not in f:
+                break
+            folders.append(head)
         cP = {}
         cP["path"] = path
         cP["prevDir"] = self.lastDir
-        self.do_ls(path, self.unknown_callback_1, cP)
+        cP["folders"] = folders
+        self.supersede(self.do_ls_batch(folders, self.unknown_callback, cP))
+
+    def supersede(self, future):
+        # Only the latest listing we've navigated to matters, cancel the one
+        # before it if it's still going
+        if self.navFuture:
+            self.connector.cancel(self.navFuture)
+        self.navFuture = future
+        return future
 
     def do_ls(self, path, callback, cP, acceptNew=False):
         if self.get_server_setting("sftp_only", False):
-            params = ""
-            if self.platform != "windows":
-                params = "-la "
-            cmd = "ls %s%s" % (
-                params,
-                self.escape_remote_path(path)
-            )
             return self.run_sftp_command(
-                cmd,
+                self.get_ls_command(path),
                 callback=callback,
                 cP=cP,
-                acceptNew=acceptNew
+                acceptNew=acceptNew,
+                priority="interactive"
             )
         else:
-            cmd = "ls %s %s" % (
-                self.get_ls_params(),
-                self.escape_remote_path(path)
-            )
             return self.run_ssh_command(
-                cmd,
+                self.get_ls_command(path),
                 callback=callback,
                 cP=cP,
-                acceptNew=acceptNew
+                acceptNew=acceptNew,
+                priority="interactive"
             )
 
-    def unknown_callback_1(self, results, cP):
-        if not results["success"]:
-            self.lastDir = cP["prevDir"]
-            self.show_current_path_panel()
-            self.error_message("Error navigating to %s" % cP["path"])
-        elif "o such file or directory" in results["out"]:
-            # sftp, either a file or doesn't exist. Do the same but go up a folder...
-            # ls parent, check for file then prevDir or open file
-            (head, tail) = self.split_path(cP["path"])
-            self.do_ls(head, self.unknown_callback_2, cP)
-        elif "Not a directory" in results["out"]:
-            # It's a file.. open it
-            self.maintain_or_download(cP["path"])
+    def do_ls_batch(self, paths, callback, cP):
+        # List several paths in one round trip, results["batch"] holds the
+        # listings in the same order as paths
+        cmds = [self.get_ls_command(path) for path in paths]
+        if self.get_server_setting("sftp_only", False):
+            return self.run_sftp_batch(
+                cmds,
+                callback=callback,
+                cP=cP,
+                priority="interactive"
+            )
         else:
-            # We should be a folder, parse the ls and add to the catalogue
-            darwin = "darwin" in self.get_settings().get("%s:os" % self.serverName)
-            self.cat = self.parse_ls(
-                self.cat,
-                "./:\n%s" % (results["out"]),
-                cP["path"],
-                darwin=darwin
+            return self.run_ssh_batch(
+                cmds,
+                callback=callback,
+                cP=cP,
+                priority="interactive"
             )
-            self.lastDir = cP["path"]
-            self.show_current_path_panel()
 
-    def unknown_callback_2(self, results, cP):
-        if not results["success"] or "o such file or directory" in results["out"]:
+    def get_ls_command(self, path):
+        if self.get_server_setting("sftp_only", False):
+            params = ""
+            if self.platform != "windows":
+                params = "-la "
+            return "ls %s%s" % (
+                params,
+                self.escape_remote_path(path)
+            )
+        return "ls %s %s" % (
+            self.get_ls_params(),
+            self.escape_remote_path(path)
+        )
+
+    def is_folder_listing(self, result):
+        return (
+            result["exit_status"] == 0 and
+            "Not a directory" not in result["out"] and
+            "o such file or directory" not in result["out"]
+        )
+
+    def unknown_callback(self, results, cP):
+        if not results["success"]:
             self.lastDir = cP["prevDir"]
             self.show_current_path_panel()
             return self.error_message("Error navigating to %s" % cP["path"])
+        # Parse the listings into the catalogue, parents first
+        sftpMode = self.get_server_setting("sftp_only", False)
+        for (folder, result) in reversed(list(zip(cP["folders"], results["batch"]))):
+            if self.is_folder_listing(result):
+                self.add_listing_to_cat(result, folder, sftpMode)
+        if self.is_folder_listing(results["batch"][0]):
+            self.lastDir = cP["path"]
+            return self.show_current_path_panel()
+        # Either a file or doesn't exist, the parent's listing will tell us
+        f = self.get_file_from_cat(cP["path"])
+        try:
+            fileType = f["/"][self.STAT_KEY_TYPE]
+        except:
+            fileType = False
+        if fileType == self.FILE_TYPE_SYMLINK:
+            self.navigate_to_symlink(cP["path"].rstrip("/"), f)
+        elif fileType == self.FILE_TYPE_FILE:
+            self.maintain_or_download(cP["path"].rstrip("/"))
         else:
-            # We can now check for the file / folder with:
-            try:
-                f = self.get_file_from_cat(cP["path"])
-                fileType = f["/"][self.STAT_KEY_TYPE]
-            except:
-                self.lastDir = cP["prevDir"]
-                self.show_current_path_panel()
-                return self.error_message("Error navigating to %s" % cP["path"])
-            if fileType == self.FILE_TYPE_SYMLINK:
-                self.navigate_to_symlink(cP["path"], f)
-            elif fileType == self.FILE_TYPE_FILE:
-                self.maintain_or_download(cP["path"])
+            self.lastDir = cP["prevDir"]
+            self.show_current_path_panel()
+            self.error_message("Error navigating to %s" % cP["path"])
 
     def get_symlink_dest(self, path):
         d = self.get_file_from_cat(path)
@@ -904,7 +1073,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                 path,
                 self.escape_remote_path(path),
                 self.serverName,
-                self.server["settings"]
+                self.get_connection_settings()
             )
         elif selection == 10:
             # Delete
@@ -927,8 +1096,16 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                     cP=cP
                 )
 
+    def sftp_failed(self, results):
+        # psftp reports success on stdout, anything else means it went wrong
+        return not results["success"] or (
+            self.platform == "windows" and
+            self.get_sftp_app_type() == "sftp" and
+            ": OK" not in results["out"]
+        )
+
     def delete_file_callback(self, results, cP):
-        if not results["success"] or (self.platform == "windows" and ": OK" not in results["out"]):
+        if self.sftp_failed(results):
             if "permission denied" in results["out"]:
                 return self.error_message(
                     "Permission denied error when trying to delete file %s" % cP["fileName"]
@@ -942,7 +1119,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
         self.show_current_path_panel()
 
     def delete_folder_callback(self, results, cP):
-        if not results["success"] or (self.platform == "windows" and ": OK" not in results["out"]):
+        if self.sftp_failed(results):
             if "permission denied" in results["out"]:
                 return self.error_message(
                     "Permission denied error when trying to delete folder %s" % cP["folderName"]
@@ -1067,18 +1244,17 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
         cP["compressTo"] = compressTo
         self.run_ssh_command(
             cmd,
-            listenAttempts=2,
             callback=self.compress_callback_1,
             cP=cP
         )
 
     def compress_callback_1(self, results, cP):
         if not results["success"]:
-            debug("Error compressing folder %s" % cP["folder"])
+            warning("Error compressing folder %s", cP["folder"])
             self.error_message("Error compressing \"%s\"" % cP["folder"])
             self.list_directory(cP["folder"])
         else:
-            debug("Successfully compressed folder %s" % cP["folder"])
+            debug("Successfully compressed folder %s", cP["folder"])
             if cP["download"]:
                 downloadFolder = self.get_default_download_folder()
                 localPath = self.join_path(
@@ -1087,11 +1263,12 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                 )
                 cP["downloadFolder"] = downloadFolder
                 cP["localPath"] = localPath
-                cmd = "get %s %s" % (
-                    self.escape_remote_path(cP["compressTo"]),
-                    self.escape_remote_path(localPath)
+                self.download(
+                    cP["compressTo"],
+                    localPath,
+                    self.compress_callback_2,
+                    cP
                 )
-                self.run_sftp_command(cmd, callback=self.compress_callback_2, cP=cP)
             else:
                 cmd = "rename %s %s" % (
                     self.escape_remote_path(cP["compressTo"]),
@@ -1112,10 +1289,10 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
 
     def compress_callback_2(self, results, cP):
         if not results["success"]:
-            debug("Error downloading file %s" % cP["compressTo"])
+            warning("Error downloading file %s", cP["compressTo"])
             self.error_message("File compressed successfully but download failed. Your compressed file is at \"%s\"" % cP["compressTo"])
         else:
-            debug("Successfully downloaded file %s" % cP["localPath"])
+            debug("Successfully downloaded file %s", cP["localPath"])
             self.success_message("File %s downloaded successfully" % (
                 cP["fileName"]
             ))
@@ -1176,7 +1353,10 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             ))
         else:
             f = self.get_file_from_cat(cP["fileName"])
-            f["/"][self.STAT_KEY_PERMISSIONS] = int(str(cP["chmod"]), 8)
+            # A copy of the stats if the catalogue's compact, assign it back
+            stats = list(f["/"])
+            stats[self.STAT_KEY_PERMISSIONS] = int(str(cP["chmod"]), 8)
+            f["/"] = stats
         self.show_current_path_panel()
 
     def handle_chown(self, chown):
@@ -1240,28 +1420,34 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             return False
 
     def append_files_from_path(self, fileDict, filePath):
-        for f in filter(self.remove_stats, fileDict):
+        # items() and each entry's stats just the once, both are built on
+        # demand from a compact catalogue
+        catData = self.cat["/CAT_DATA/"]
+        for (f, entry) in fileDict.items():
+            if not self.remove_stats(f):
+                continue
             # Don't show files / folders if they begin with a dot and showHidden
             # is not enabled.
             if self.showHidden or (not self.showHidden and f[0] != "."):
+                stats = entry["/"]
                 # If we have a file
-                if fileDict[f]["/"][self.STAT_KEY_TYPE] == self.FILE_TYPE_FILE:
+                if stats[self.STAT_KEY_TYPE] == self.FILE_TYPE_FILE:
                     if f.split(".")[-1] not in self.dontListExt:
                         self.items.append([
                             self.join_path(filePath, f),
                             "%s  %s %s %s %s" % (
-                                oct(fileDict[f]["/"][self.STAT_KEY_PERMISSIONS])[2:5],
-                                self.cat["/CAT_DATA/"]["users"][fileDict[f]["/"][self.STAT_KEY_USER]],
-                                self.cat["/CAT_DATA/"]["groups"][fileDict[f]["/"][self.STAT_KEY_GROUP]],
-                                "" if fileDict[f]["/"][self.STAT_KEY_TYPE] == self.FILE_TYPE_FOLDER else " %s " % self.display_size(fileDict[f]["/"][self.STAT_KEY_SIZE]),
-                                self.display_time(fileDict[f]["/"][self.STAT_KEY_MODIFIED])
+                                oct(stats[self.STAT_KEY_PERMISSIONS])[2:5],
+                                catData["users"][stats[self.STAT_KEY_USER]],
+                                catData["groups"][stats[self.STAT_KEY_GROUP]],
+                                "" if stats[self.STAT_KEY_TYPE] == self.FILE_TYPE_FOLDER else " %s " % self.display_size(stats[self.STAT_KEY_SIZE]),
+                                self.display_time(stats[self.STAT_KEY_MODIFIED])
                             )
                         ])
                 else:
                     # Else, assume a folder and recurse into it
                     # TODO: Symlinks?
                     self.append_files_from_path(
-                        fileDict[f],
+                        entry,
                         self.join_path(filePath, f)
                     )
 
@@ -1784,9 +1970,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
     def move_callback(self, results, cP):
         if not results["success"] or "no such file or directory" in results["out"]:
             self.error_message("Error moving %s" % cP["folder"])
-        cP["sftpMode"] = self.get_server_setting("sftp_only", False)
-        self.do_ls(cP["folder"], callback=self.parse_list_only_callback, cP=cP)
-        return self.show_current_path_panel(forceReload=True)
+        return self.refresh_folders([cP["folder"], self.lastDir])
 
     def handle_copy(self, selection):
         if selection == -1:
@@ -1808,7 +1992,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                 cP["folder"] = self.movingFrom
                 cP["item"] = self.selected
                 cP["dest"] = dest
-                return self.run_ssh_command(cmd, listenAttempts=2, callback=self.copy_callback, cP=cP)
+                return self.run_ssh_command(cmd, callback=self.copy_callback, cP=cP)
         else:
             if selection == -2:
                 # Do nothing, just display the menus
@@ -1856,9 +2040,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                 cP["folder"],
                 cP["dest"]
             ))
-        cP["sftpMode"] = self.get_server_setting("sftp_only", False)
-        self.do_ls(cP["folder"], callback=self.parse_list_only_callback, cP=cP)
-        return self.show_current_path_panel(forceReload=True)
+        return self.refresh_folders([cP["folder"], cP["dest"]])
 
     def add_options_to_items(self):
         if self.fileInfo:
@@ -1912,7 +2094,12 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
         cP["localFile"] = localFile
         cP["lineNumber"] = lineNumber
         cP["serverName"] = self.serverName
-        self.run_sftp_command(cmd, callback=self.download_and_open_callback, cP=cP)
+        self.run_sftp_command(
+            cmd,
+            callback=self.download_and_open_callback,
+            cP=cP,
+            priority="interactive"
+        )
 
     def download_and_open_callback(self, results, cP):
         if not results["success"]:
@@ -1946,15 +2133,11 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             destination,
             self.escape_local_path(f)
         )
-        cmd = "get %s %s" % (
-            self.escape_remote_path(sourceFile),
-            self.escape_remote_path(destFile)
-        )
         cP = {}
         cP["file"] = self.selected
         cP["open"] = openFile
         cP["destination"] = destination
-        self.run_sftp_command(cmd, callback=self.download_file_callback, cP=cP)
+        self.download(sourceFile, destFile, self.download_file_callback, cP)
 
     def download_file_callback(self, results, cP):
         if results["success"]:
@@ -1972,6 +2155,180 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             )
             os.startfile(f)
 
+    def download(self, remotePath, localPath, callback, cP):
+        # Large files are split into ranges that are fetched at the same time
+        # by several sftp protocol workers then verified and moved into place.
+        # Anything else is a plain get. callback gets the usual results dict.
+        dP = {}
+        dP["remotePath"] = remotePath
+        dP["localPath"] = localPath
+        dP["callback"] = callback
+        dP["cP"] = cP
+        if self.get_sftp_app_type() != "sftpv3":
+            return self.download_whole(dP)
+        # Not the catalogue's size, that may be hours old and the ranges
+        # must add up to the file as it is now
+        self.run_sftp_command(
+            "stat %s" % self.escape_remote_path(remotePath),
+            callback=self.download_stat_callback,
+            cP=dP
+        )
+
+    def download_stat_callback(self, results, dP):
+        if not results["success"] or not results.get("entries"):
+            return self.download_whole(dP)
+        self.download_ranges(dP, results["entries"][0].get("size", 0))
+
+    def download_whole(self, dP):
+        cmd = "get %s %s" % (
+            self.escape_remote_path(dP["remotePath"]),
+            self.escape_remote_path(dP["localPath"])
+        )
+        self.run_sftp_command(cmd, callback=dP["callback"], cP=dP["cP"])
+
+    def download_ranges(self, dP, size):
+        segments = int(self.get_settings().get("download_segments", 4))
+        minSize = int(self.get_settings().get("download_segment_min_size", 16777216))
+        count = max(1, min(segments, size // max(minSize, 1)))
+        if count < 2:
+            return self.download_whole(dP)
+        debug("Downloading %s in %s ranges", dP["remotePath"], count)
+        dP["partPath"] = "%s.part" % dP["localPath"]
+        with open(dP["partPath"], "wb") as f:
+            f.truncate(size)
+        dP["size"] = size
+        dP["started"] = time.time()
+        dP["progress"] = {}
+        dP["pending"] = count
+        dP["failed"] = False
+        dP["verify"] = (
+            self.get_server_setting("verify_downloads", False) and
+            not self.get_server_setting("sftp_only", False)
+        )
+        if dP["verify"]:
+            # Checksummed on the server while we download
+            path = self.escape_remote_path(dP["remotePath"])
+            self.run_ssh_command(
+                "md5sum %s 2>/dev/null || md5 -q %s" % (path, path),
+                callback=self.download_checksum_callback,
+                cP=dP
+            )
+        rangeSize = -(-size // count)
+        for i in range(count):
+            offset = i * rangeSize
+            length = min(rangeSize, size - offset)
+            # The last range runs to the end of the file, whatever it's grown
+            # or shrunk to since the stat. The others fail if they come up
+            # short.
+            self.connector.run_remote_command(
+                "sftpv3",
+                "get %s %s %s%s" % (
+                    self.escape_remote_path(dP["remotePath"]),
+                    self.escape_remote_path(dP["partPath"]),
+                    offset,
+                    " %s" % length if i < count - 1 else ""
+                ),
+                # Allow for a slow link, at least 64KB/s
+                timeout=self.connector.timeout + length // 65536,
+                callback=self.download_range_callback,
+                cP=dP,
+                serverName=self.serverName,
+                serverSettings=self.get_connection_settings(),
+                progress=dP["progress"]
+            )
+        self.download_progress(dP)
+
+    def download_progress(self, dP):
+        if not dP["pending"]:
+            return self.window.active_view().erase_status("remoteedit_download")
+        got = sum(dP["progress"].values())
+        elapsed = max(time.time() - dP["started"], 0.001)
+        self.window.active_view().set_status(
+            "remoteedit_download",
+            "Downloading %s: %s%% of %s at %s/s" % (
+                self.split_path(dP["remotePath"])[1],
+                got * 100 // dP["size"],
+                self.display_size(dP["size"]),
+                self.display_size(got / elapsed)
+            )
+        )
+        sublime.set_timeout(lambda: self.download_progress(dP), 500)
+
+    def download_range_callback(self, results, dP):
+        dP["pending"] -= 1
+        if not results["success"]:
+            dP["failed"] = True
+        self.download_finish(dP)
+
+    def download_checksum_callback(self, results, dP):
+        out = results["out"].split()
+        dP["remoteMd5"] = out[0] if results["success"] and out else None
+        self.download_finish(dP)
+
+    def download_finish(self, dP):
+        # Called as each range (and the checksum) comes in, carries on once
+        # they've all arrived
+        if dP["pending"] or (dP["verify"] and "remoteMd5" not in dP):
+            return
+        if dP["failed"]:
+            # A range came back short (the file changed since we stat'd it
+            # say), start again with a plain get rather than leave a hole
+            warning("Error downloading a part of %s, getting it whole", dP["remotePath"])
+            try:
+                os.remove(dP["partPath"])
+            except OSError:
+                pass
+            return self.download_whole(dP)
+        if not dP["verify"]:
+            return self.download_complete(dP)
+        if not dP["remoteMd5"]:
+            debug("No checksum from the server, skipping verification")
+            return self.download_complete(dP)
+        # Hashing a big file takes a while, keep it off the main thread
+        threading.Thread(target=self.download_verify, args=(dP,)).start()
+
+    def download_verify(self, dP):
+        m = hashlib.md5()
+        with open(dP["partPath"], "rb") as f:
+            for chunk in iter(lambda: f.read(1048576), b""):
+                m.update(chunk)
+        error = None
+        if m.hexdigest() != dP["remoteMd5"].lower():
+            error = "Checksum mismatch (%s locally, %s on the server)" % (
+                m.hexdigest(),
+                dP["remoteMd5"]
+            )
+        sublime.set_timeout(lambda: self.download_complete(dP, error), 0)
+
+    def download_complete(self, dP, error=None):
+        if not error:
+            try:
+                if os.path.exists(dP["localPath"]):
+                    os.remove(dP["localPath"])
+                os.rename(dP["partPath"], dP["localPath"])
+            except OSError as e:
+                error = "Unable to move the download into place: %s" % e
+        if error:
+            warning(error)
+            try:
+                os.remove(dP["partPath"])
+            except OSError:
+                pass
+        info(
+            "Downloaded %s bytes in %.1fs",
+            dP["size"],
+            time.time() - dP["started"]
+        )
+        dP["callback"](
+            {
+                "success": not error,
+                "out": "",
+                "err": error or "",
+                "exit_status": 1 if error else 0
+            },
+            dP["cP"]
+        )
+
     def list_directory(self, d, dontLoop=False, forceReload=False, foldersOnly=False, skipOptions=False, callback=None, doCat=None, acceptNew=False):
         self.items = []
         self.itemPaths = []
@@ -1980,7 +2337,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
         if not forceReload and self.cat:
             # Display options based on the catalogue and self.lastDir
             try:
-                debug("Trying cat for folder \"%s\"" % d)
+                debug("Trying cat for folder \"%s\"", d)
                 found = True
                 fldr = self.get_file_from_cat(d)
                 if "/NO_INDEX/" in fldr:
@@ -1988,12 +2345,15 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                     raise Exception("Path not in catalogue")
                 # debug("D is: %s" % d)
                 # debug("Fldr is: %s" % fldr)
-                for f in sorted(filter(self.remove_stats, fldr), reverse=self.orderReverse, key=lambda x: fldr[x]["/"][self.orderBy] if self.orderBy not in [self.SORT_BY_NAME, self.SORT_BY_EXT] else (x.lower() if self.orderBy == self.SORT_BY_NAME else (x.split(".")[-1] if "." in x and fldr[x]["/"][self.STAT_KEY_TYPE] == self.FILE_TYPE_FILE else ("zzzzzz" + x if fldr[x]["/"][self.STAT_KEY_TYPE] == self.FILE_TYPE_FILE else "zzzzzzzzz" + x)))):
+                # Each entry's stats just the once, they're built on demand
+                # from a compact catalogue
+                stats = dict([(f, e["/"]) for (f, e) in fldr.items() if self.remove_stats(f)])
+                for f in sorted(stats, reverse=self.orderReverse, key=lambda x: stats[x][self.orderBy] if self.orderBy not in [self.SORT_BY_NAME, self.SORT_BY_EXT] else (x.lower() if self.orderBy == self.SORT_BY_NAME else (x.split(".")[-1] if "." in x and stats[x][self.STAT_KEY_TYPE] == self.FILE_TYPE_FILE else ("zzzzzz" + x if stats[x][self.STAT_KEY_TYPE] == self.FILE_TYPE_FILE else "zzzzzzzzz" + x)))):
                     # debug("F is: %s" % f)
                     if self.showHidden or (not self.showHidden and f[0] != "."):
-                        if fldr[f]["/"][self.STAT_KEY_TYPE] == self.FILE_TYPE_FOLDER:
+                        if stats[f][self.STAT_KEY_TYPE] == self.FILE_TYPE_FOLDER:
                             fileName = "%s/" % f
-                        elif fldr[f]["/"][self.STAT_KEY_TYPE] == self.FILE_TYPE_FILE:
+                        elif stats[f][self.STAT_KEY_TYPE] == self.FILE_TYPE_FILE:
                             fileName = f
                             if foldersOnly or f.split(".")[-1] in self.dontListExt:
                                 continue
@@ -2002,7 +2362,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                             if sftpMode:
                                 fileName = "%s (Symlink)" % (f)
                             else:
-                                fileName = "%s (Symlink to: %s)" % (f, fldr[f]["/"][self.STAT_KEY_DESTINATION])
+                                fileName = "%s (Symlink to: %s)" % (f, stats[f][self.STAT_KEY_DESTINATION])
                             if foldersOnly:
                                 continue
                         if self.fileInfo:
@@ -2010,11 +2370,11 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                                 [
                                     "  %s" % fileName,
                                     "  %s  %s %s %s %s" % (
-                                        oct(fldr[f]["/"][self.STAT_KEY_PERMISSIONS])[2:5],
-                                        self.cat["/CAT_DATA/"]["users"][fldr[f]["/"][self.STAT_KEY_USER]],
-                                        self.cat["/CAT_DATA/"]["groups"][fldr[f]["/"][self.STAT_KEY_GROUP]],
-                                        "" if fldr[f]["/"][self.STAT_KEY_TYPE] == self.FILE_TYPE_FOLDER else " %s " % self.display_size(fldr[f]["/"][self.STAT_KEY_SIZE]),
-                                        self.display_time(fldr[f]["/"][self.STAT_KEY_MODIFIED])
+                                        oct(stats[f][self.STAT_KEY_PERMISSIONS])[2:5],
+                                        self.cat["/CAT_DATA/"]["users"][stats[f][self.STAT_KEY_USER]],
+                                        self.cat["/CAT_DATA/"]["groups"][stats[f][self.STAT_KEY_GROUP]],
+                                        "" if stats[f][self.STAT_KEY_TYPE] == self.FILE_TYPE_FOLDER else " %s " % self.display_size(stats[f][self.STAT_KEY_SIZE]),
+                                        self.display_time(stats[f][self.STAT_KEY_MODIFIED])
                                     )
                                 ]
                             )
@@ -2023,7 +2383,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                             self.items.append("  %s" % fileName)
                         self.itemPaths.append(f)
             except Exception as e:
-                debug("\"%s\" not in catalogue. Exception: %s" % (d, e))
+                debug("\"%s\" not in catalogue. Exception: %s", d, e)
                 found = False
         if not found:
             if dontLoop:
@@ -2045,7 +2405,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             cP["doCat"] = doCat
             if not callback:
                 callback = self.list_directory_callback
-            return self.do_ls(d, callback, cP, acceptNew=acceptNew)
+            return self.supersede(self.do_ls(d, callback, cP, acceptNew=acceptNew))
         reData = self.window.active_view().settings().get("reData", None)
         if reData and self.serverName == reData["serverName"]:
             reData["browse_path"] = self.lastDir
@@ -2062,14 +2422,41 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
     def parse_list_only_callback(self, results, cP=None):
         if "Not a directory" not in results["out"] and "Permission denied" not in results["out"]:
             # Parse the ls and add to the catalogue (but don't save the file)
-            darwin = "darwin" in self.get_settings().get("%s:os" % self.serverName)
-            self.cat = self.parse_ls(
+            self.add_listing_to_cat(results, cP["folder"], cP["sftpMode"])
+
+    def add_listing_to_cat(self, results, folder, sftpMode):
+        if results.get("entries") is not None:
+            # Structured data from the sftp protocol worker, nothing to guess
+            self.cat = self.parse_sftp_entries(
                 self.cat,
-                "./:\n%s" % (results["out"]),
-                cP["folder"],
-                sftpMode=cP["sftpMode"],
-                darwin=darwin
+                results["entries"],
+                folder
             )
+            return
+        darwin = "darwin" in self.get_settings().get("%s:os" % self.serverName)
+        self.cat = self.parse_ls(
+            self.cat,
+            "./:\n%s" % (results["out"]),
+            folder,
+            sftpMode=sftpMode,
+            darwin=darwin
+        )
+
+    def refresh_folders(self, folders):
+        # Re-list each folder in one round trip then show self.lastDir
+        cP = {}
+        cP["folders"] = folders
+        cP["sftpMode"] = self.get_server_setting("sftp_only", False)
+        self.do_ls_batch(folders, self.refresh_folders_callback, cP)
+
+    def refresh_folders_callback(self, results, cP):
+        if results["success"]:
+            for (folder, result) in zip(cP["folders"], results["batch"]):
+                self.parse_list_only_callback(
+                    result,
+                    {"folder": folder, "sftpMode": cP["sftpMode"]}
+                )
+        self.show_current_path_panel(forceReload=not results["success"])
 
     def list_directory_callback(self, results, cP=None, calledBack=True):
         if not results["success"]:
@@ -2114,14 +2501,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             (self.lastDir, tail) = self.split_path(cP["folder"])
             return self.show_current_path_panel()
         # Parse the ls and add to the catalogue (but don't save the file)
-        darwin = "darwin" in self.get_settings().get("%s:os" % self.serverName)
-        self.cat = self.parse_ls(
-            self.cat,
-            "./:\n%s" % (results["out"]),
-            cP["folder"],
-            sftpMode=cP["sftpMode"],
-            darwin=darwin
-        )
+        self.add_listing_to_cat(results, cP["folder"], cP["sftpMode"])
         s = self.list_directory(
             cP["folder"],
             dontLoop=True,
@@ -2190,10 +2570,12 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             stale = self.get_settings().get("cat_stale_after_hours", 24) * 3600
         except:
             mTime = stale = 0
+        # Whatever we have is likely better than nothing, load it even if
+        # it needs a refresh. Stale if there's nothing to load.
+        if not self.load_cat():
+            mTime = 0
         # And it's recent...
         if mTime + stale < time.time():
-            # Needs a refresh, leave our current catalogue where it is for now
-            # though as it's likely better than nothing and we know to update it
             # Let's see if we're already cataloguing...
             catTimeout = 60 * 3
             if self.bgCat and self.bgCat + catTimeout > time.time():
@@ -2201,175 +2583,305 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                 return
             # Use the below flag to indicate we will be cataloguing in the BG
             self.bgCat = time.time()
-            # Create an extra ssh and sftp thread so that we don't interrupt
+            # The worker pools grow as work backs up so this won't hold up
             # the user browsing the server (which is likely what triggered the
             # catalogue download in the first place).
-            # self.create_ssh_thread()
-            # self.create_sftp_thread()
             ## GO!
-            self.cat_server()
-        self.load_cat()
-
-    def cat_server(self, results=None, cp=None):
-        if not cp:
-            self.bgCatStep = 0
-            cp = {}
-            cp["server"] = self.serverName
-            cp["step"] = 0
-        debug("Cat server called for %s, step is %s" % (
-            cp["server"],
-            self.bgCatStep
-        ))
+            self.refresh_cat()
+
+    def cat_server(self):
+        # Catalogue the whole of cat_path with a recursive ls, gzipped and
+        # streamed back over the ssh connection. It's parsed as it arrives
+        # (see RemoteEditCatStream) so once it's all in there's nothing left
+        # but to save it. With cat_workers over 1 the top level is listed on
+        # its own and its folders shared out between that many listings run
+        # at the same time, see cat_top_callback.
+        debug("Cat server called for %s", self.serverName)
+        self.catFile = os.path.join(
+            self.get_cat_path(),
+            "%s.cat" % self.serverName
+        )
+        cp = {}
+        cp["server"] = self.serverName
+        cp["startedAt"] = int(time.time())
+        cp["workers"] = self.get_server_setting(
+            "cat_workers",
+            self.get_settings().get("cat_workers", 1)
+        )
+        if cp["workers"] > 1:
+            cp["stream"] = self.run_cat_listing(
+                [],
+                False,
+                self.cat_top_callback,
+                cp
+            )
+        else:
+            cp["stream"] = self.run_cat_listing(
+                [],
+                True,
+                self.cat_server_callback,
+                cp
+            )
 
-        # TODO: Replace magic numbers
-        # Put in some retrys
-        # Make individual bits callable manually (refresh from... etc)
+    def run_cat_listing(self, folders, recursive, callback, cP, cat=None):
+        # ls folders (relative to cat_path, all of it if empty) into a new
+        # RemoteEditCatStream, which is returned. The exit status is gzip's,
+        # ls complaining about a folder it can't read doesn't fail the lot.
+        catPath = self.get_server_setting("cat_path")
+        stream = RemoteEditCatStream(self, catPath, cat)
+        cmd = "cd %s && ls %s%s%s | gzip -c" % (
+            self.escape_remote_path(catPath),
+            self.get_ls_params(),
+            " -R" if recursive else "",
+            "".join([" %s" % self.escape_remote_path("./%s" % f) for f in folders])
+        )
+        self.run_ssh_command(
+            cmd,
+            callback=callback,
+            cP=cP,
+            priority="background",
+            stream=stream
+        )
+        return stream
 
+    def finish_cat_listing(self, results, cp):
+        # The catalogue cp["stream"] built, None if it failed
         if cp["server"] != self.serverName:
+            return None
+        cat = None
+        if results["success"] and not results["exit_status"]:
+            cat = cp["stream"].finish()
+            err = cp["stream"].error
+        else:
+            err = results["err"]
+        if cat is None:
+            warning("Cataloguing %s failed: %s", cp["server"], err)
+        return cat
+
+    def cat_server_callback(self, results, cp):
+        cat = self.finish_cat_listing(results, cp)
+        if cat is None:
             return self.tidy_cat_process()
+        self.use_new_cat(cat, cp)
 
-        # STEP 1
-        if self.bgCatStep is 0:
-            # TODO, Much better error messages
-            self.bgCatStep += 1
-            cp["server"] = self.serverName
-            cp["step"] = self.bgCatStep
+    def cat_top_callback(self, results, cp):
+        cat = self.finish_cat_listing(results, cp)
+        if cat is None:
+            return self.tidy_cat_process()
+        cp["cat"] = cat
+        top = self.get_cat_node(cat, self.get_server_setting("cat_path"))
+        folders = sorted([
+            f for f in filter(self.remove_stats, top)
+            if top[f]["/"][self.STAT_KEY_TYPE] == self.FILE_TYPE_FOLDER and
+            f not in self.catExcludeFolders
+        ])
+        # A few shards for each worker so that one big folder doesn't leave
+        # the rest with nothing to do. Shards are started as others finish.
+        count = min(len(folders), cp["workers"] * self.catShardsPerWorker)
+        cp["shards"] = [folders[i::count] for i in range(count)]
+        cp["running"] = 0
+        cp["failed"] = False
+        debug(
+            "Cataloguing %s folders in %s shards, %s at a time",
+            len(folders),
+            count,
+            cp["workers"]
+        )
+        if not cp["shards"]:
+            return self.use_new_cat(cat, cp)
+        for i in range(min(cp["workers"], count)):
+            self.next_cat_shard(cp)
+
+    def next_cat_shard(self, cp):
+        sP = {}
+        sP["server"] = cp["server"]
+        sP["cat"] = cp
+        sP["folders"] = cp["shards"].pop(0)
+        # Every shard shares the one list of users and groups so that the
+        # indexes in their stats agree. Appending to a list is safe from the
+        # workers' threads, a name added twice only ever gets the first
+        # index.
+        catData = cp["cat"]["/CAT_DATA/"]
+        sP["stream"] = self.run_cat_listing(
+            sP["folders"],
+            True,
+            self.cat_shard_callback,
+            sP,
+            {"/CAT_DATA/": {"users": catData["users"], "groups": catData["groups"]}}
+        )
+        cp["running"] += 1
 
-            self.catFile = os.path.join(
-                self.get_cat_path(),
-                "%s.cat" % self.serverName
-            )
-            try:
-                os.makedirs(self.get_local_tmp_path())
-            except FileExistsError:
-                # Directory already exists
-                pass
-            except Exception as e:
-                debug("Exception when making local folder: %s" % e)
-                return False
-
-            # We should be at a prompt
-            if "csh" in self.get_settings().get("%s:shell" % self.serverName):
-                cmd = "cd %s && ( ls %s -R > %s/%sSub.cat ) >&/dev/null; cd %s && rm -f %sSub.tar.gz; tar cfz %sSub.tar.gz %sSub.cat && rm -f %sSub.cat" % (
-                    self.escape_remote_path(self.get_server_setting("cat_path")),
-                    self.get_ls_params(),
-                    self.escape_remote_path(self.tempPath),
-                    self.serverName,
-                    self.escape_remote_path(self.tempPath),
-                    self.serverName,
-                    self.serverName,
-                    self.serverName,
-                    self.serverName
-                )
-            else:
-                cmd = "cd %s && ls %s -R > %s/%sSub.cat 2>/dev/null; cd %s && rm -f %sSub.tar.gz; tar cfz %sSub.tar.gz %sSub.cat && rm -f %sSub.cat" % (
-                    self.escape_remote_path(self.get_server_setting("cat_path")),
-                    self.get_ls_params(),
-                    self.escape_remote_path(self.tempPath),
-                    self.serverName,
-                    self.escape_remote_path(self.tempPath),
-                    self.serverName,
-                    self.serverName,
-                    self.serverName,
-                    self.serverName
-                )
-            self.run_ssh_command(
-                cmd,
-                listenAttempts=10,
-                callback=self.cat_server,
-                cP=cp
-            )
-        elif self.bgCatStep is 1:
-            if cp["step"] is not 1:
-                return self.tidy_cat_process()
-            if not results["success"]:
-                return self.tidy_cat_process()
-            self.bgCatStep += 1
-            cp["server"] = self.serverName
-            cp["step"] = self.bgCatStep
-            cp["remoteCatGzPath"] = "%s/%s" % (self.tempPath, "%sSub.tar.gz" % self.serverName)
-            cp["localCatGzPath"] = os.path.join(
-                self.get_local_tmp_path(),
-                "%sSub.tar.gz" % self.serverName
-            )
-            # Now grab the file
-            cmd = "get %s %s" % (
-                self.escape_remote_path(cp["remoteCatGzPath"]),
-                self.escape_remote_path(cp["localCatGzPath"])
+    def cat_shard_callback(self, results, sP):
+        cp = sP["cat"]
+        cp["running"] -= 1
+        if cp["failed"]:
+            return
+        cat = self.finish_cat_listing(results, sP)
+        if cat is None:
+            # Keep what we have rather than save a catalogue with holes
+            cp["failed"] = True
+            return self.tidy_cat_process()
+        # Graft the shard's folders onto the top level
+        catPath = self.get_server_setting("cat_path")
+        top = self.get_cat_node(cp["cat"], catPath)
+        shardTop = self.get_cat_node(cat, catPath)
+        for f in sP["folders"]:
+            if f in shardTop:
+                top[f] = shardTop[f]
+        if cp["shards"]:
+            self.next_cat_shard(cp)
+        elif not cp["running"]:
+            self.use_new_cat(cp["cat"], cp)
+
+    def get_cat_node(self, cat, path):
+        node = cat
+        for f in filter(bool, path.split("/")):
+            node = node[f]
+        return node
+
+    def use_new_cat(self, cat, cp):
+        # Anything changed since we started listing is for refresh_cat
+        cat["/CAT_DATA/"]["refreshed"] = cp["startedAt"]
+        info("Catalogued. :)")
+        # It's what we'd load
+        self.cat = self.save_cat(cat)
+        self.cat["/CAT_DATA/"]["loaded"] = time.time()
+        self.forceReloadCat = False
+
+    def refresh_cat(self):
+        # Bring the catalogue up to date without listing the whole tree again.
+        # find gives us the folders changed since it was last refreshed (an
+        # entry added, removed or renamed) and those holding modified files,
+        # then just those folders are listed and merged in. It's rebuilt with
+        # cat_server if there's no catalogue to refresh or more than
+        # cat_refresh_max_changes have been made.
+        catData = self.cat.get("/CAT_DATA/", {}) if self.cat else {}
+        since = catData.get("refreshed", catData.get("created"))
+        if not since or not os.path.exists(self.catFile):
+            return self.cat_server()
+        cp = {}
+        cp["server"] = self.serverName
+        cp["startedAt"] = int(time.time())
+        cp["maxChanges"] = self.get_settings().get(
+            "cat_refresh_max_changes",
+            5000
+        )
+        # -mmin is against the server's clock so the two needn't agree. The
+        # slack covers however long the listing took that we're refreshing.
+        minutes = (cp["startedAt"] - since) // 60 + self.catRefreshSlack
+        prune = ""
+        if self.catExcludeFolders:
+            prune = "\\( %s \\) -prune -o " % " -o ".join(
+                ["-name %s" % self.escape_remote_path(f) for f in self.catExcludeFolders]
             )
-            self.run_sftp_command(
-                cmd,
-                callback=self.cat_server,
-                cP=cp
+        # Folders come back with a trailing slash, files without
+        cmd = "cd %s && find . %s-mmin -%s \\( -type d -exec printf '%%s/\\n' {} + -o -type f -print \\) | head -n %s" % (
+            self.escape_remote_path(self.get_server_setting("cat_path")),
+            prune,
+            minutes,
+            cp["maxChanges"] + 1
+        )
+        self.run_ssh_command(
+            cmd,
+            callback=self.refresh_cat_callback,
+            cP=cp,
+            priority="background"
+        )
+
+    def refresh_cat_callback(self, results, cp):
+        if cp["server"] != self.serverName or not results["success"]:
+            return self.tidy_cat_process()
+        changes = [l for l in results["out"].split("\n") if l[0:2] == "./"]
+        if len(changes) > cp["maxChanges"]:
+            info(
+                "Over %s changes since the catalogue was refreshed, rebuilding it",
+                cp["maxChanges"]
             )
+            return self.cat_server()
+        catPath = self.get_server_setting("cat_path")
+        folders = set()
+        for change in changes:
+            if change[-1] == "/":
+                folder = change[2:-1]
+            else:
+                folder = change[2:change.rfind("/")]
+            folders.add(self.join_path(catPath, folder) if folder else catPath)
+        # Parents first
+        cp["folders"] = sorted(folders)
+        if not cp["folders"]:
+            return self.refresh_cat_listings_callback({"batch": []}, cp)
+        cmds = [self.get_ls_command(folder) for folder in cp["folders"]]
+        self.run_ssh_batch(
+            cmds,
+            callback=self.refresh_cat_listings_callback,
+            cP=cp,
+            priority="background"
+        )
 
-        elif self.bgCatStep is 2:
-            if cp["step"] is not 2:
-                return self.tidy_cat_process()
-            if not results["success"]:
-                return self.tidy_cat_process()
-            self.bgCatStep += 1
-            cp["server"] = self.serverName
-            cp["step"] = self.bgCatStep
+    def refresh_cat_listings_callback(self, results, cp):
+        if cp["server"] != self.serverName or not self.cat:
+            return self.tidy_cat_process()
+        if results.get("success") is False:
+            return self.tidy_cat_process()
+        for (folder, result) in zip(cp["folders"], results["batch"]):
+            # Gone since find saw it, its parent's listing says so
+            if self.is_folder_listing(result):
+                self.add_listing_to_cat(result, folder, False)
+        self.cat["/CAT_DATA/"]["refreshed"] = cp["startedAt"]
+        self.cat = self.save_cat(self.cat)
+        info(
+            "Catalogue refreshed, %s changed folders relisted",
+            len(cp["folders"])
+        )
 
-            # delete tmp file from server
-            cmd = "rm %s" % (
-                self.escape_remote_path(cp["remoteCatGzPath"])
-            )
-            self.run_sftp_command(
-                cmd,
-                callback=self.cat_server,
-                cP=cp
-            )
-        elif self.bgCatStep is 3:
-            # split this one up more
-            if cp["step"] is not 3:
-                return self.tidy_cat_process()
-            if not results["success"]:
-                return self.tidy_cat_process()
-            self.bgCatStep += 1
-            cp["server"] = self.serverName
-            cp["step"] = self.bgCatStep
-
-            # Check local file exists
-            try:
-                f = tarfile.open(cp["localCatGzPath"], "r:gz")
-                f.extractall(self.get_local_tmp_path())
-            except Exception as e:
-                debug("Gzip fail: \"%s\"" % e)
-                return False
-            finally:
-                f.close()
-            lsDataFile = os.path.join(
-                self.get_local_tmp_path(),
-                "%sSub.cat" % self.serverName
-            )
-            cat = self.create_cat(
-                lsDataFile,
-                self.get_server_setting("cat_path")
-            )
-            # Delete the local files we downloaded and untarred
-            os.remove(cp["localCatGzPath"])
-            os.remove(lsDataFile)
-            # Save our python dict catalogue by pickleing it in some tangy,
-            # slightly sweet, pickling vinegar.
-            f = open(self.catFile, "wb")
-            # Pickled egg?
-            pickle.dump(cat, f)
-            # Yes please! Don't mind if I do.
-            f.close()
-            debug("Catalogued. :)")
-            # Now load it!
-            self.load_cat()
+    def save_cat(self, cat):
+        # Pack the catalogue into a RemoteEditCompactCat, save that and hand
+        # back the saved one mapped from the file. Use it rather than cat from
+        # here on, the catalogue it replaces is closed (though its nodes
+        # still work, see RemoteEditCompactCat.close).
+        compact = RemoteEditCompactCat.RemoteEditCompactCat.build(cat)
+        # Windows won't replace a file that's mapped
+        for old in [cat, self.cat]:
+            if isinstance(old, RemoteEditCompactCat.RemoteEditCatNode):
+                old.compact.close()
+        try:
+            compact.save(self.catFile)
+            return RemoteEditCompactCat.RemoteEditCompactCat.load(
+                self.catFile
+            ).root()
+        except (EnvironmentError, ValueError) as e:
+            warning("Unable to save the catalogue to %s: %s", self.catFile, e)
+            return compact.root()
 
     def load_cat(self):
         if os.path.exists(self.catFile):
-            debug("Loading catalogue from %s." % self.catFile)
-            self.cat = pickle.load(open(self.catFile, "rb"))
+            debug("Loading catalogue from %s.", self.catFile)
+            if RemoteEditCompactCat.is_compact_cat(self.catFile):
+                # Mapped, it's read as it's used
+                try:
+                    cat = RemoteEditCompactCat.RemoteEditCompactCat.load(
+                        self.catFile
+                    ).root()
+                except (EnvironmentError, ValueError) as e:
+                    # Gone, cat_server will build a new one
+                    warning("Discarding catalogue %s: %s", self.catFile, e)
+                    try:
+                        os.remove(self.catFile)
+                    except OSError:
+                        pass
+                    return False
+            else:
+                # One pickled before they were compact, a dict of dicts
+                cat = pickle.load(open(self.catFile, "rb"))
+                if "/CAT_DATA/" not in cat:
+                    return False
+            self.cat = cat
             # Flag to indicate that a full cat is loaded
             self.cat["/CAT_DATA/"]["loaded"] = time.time()
             debug("I've reloaded! Catalogue loaded from disk.")
             self.forceReloadCat = False
+            return True
+        return False
 
     def tidy_cat_process(self, resultServer=None):
         # Remove the extra threads
@@ -2378,35 +2890,6 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
         # retry's here too
         debug("Tidy")
 
-    def create_cat(self, fileName, startAt):
-        # Build our catalogue dictionary from one big recursive ls of the root
-        # (or cat_path) folder. The structure of the dict will be something
-        # like:
-        #
-        # cat["/CAT_DATA/"]["server"] = server name
-        # cat["/CAT_DATA/"]["created"] = unixtime created
-        # cat["/CAT_DATA/"]["updated"] = unixtime updated
-        # cat["/CAT_DATA/"]["users"] = users dict int -> user name
-        # cat["/CAT_DATA/"]["groups"] = groups dict int -> group name
-        # cat["folder1"]["/"] = [list of stat info on folder 1]
-        # cat["folder1"]["folder2"]["/"] = [list of stat info on folder 2]
-        # cat["folder1"]["file1"]["/"] = [list of stat info on file 1]
-        #
-        # Stat info is a list of data:
-        # [0] - 0 = file, 1 = folder, 2 = symlink (see self.FILE_TYPE_FILE etc)
-        # [1] - convert to octal for file perms
-        # [2] - key of user dict to convert this id to a string user name
-        # [3] - key of group dict to convert this id to a string group name
-        # [4] - filesize in bytes
-        # [5] - date as unixtime
-        # [6] - if it's a symlink then record the full destination path
-        cat = {}
-        catFile = open(fileName, "r", encoding="utf-8", errors="ignore")
-        darwin = "darwin" in self.get_settings().get("%s:os" % self.serverName)
-        cat = self.parse_ls(cat, catFile.read(), startAt, darwin=darwin)
-        catFile.close()
-        return cat
-
     def parse_ls(self, cat, lsData, startAt, users=[], groups=[], sftpMode=False, darwin=False):
         # Build a lookup dict for quickly converting rwxrwxrwx to an integer
         if not self.permsLookup:
@@ -2519,7 +3002,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                     # Skip the "Total BYTES" message
                     pass
                 elif (not charsIn1 or not charsIn2 or charsIn1 != charsIn2) and not nixSftp:
-                    debug("Error parsing ls output at line: \"%s\"" % line)
+                    debug("Error parsing ls output at line: \"%s\"", line)
                 else:
                     if nixSftp:
                         cName = name
@@ -2557,8 +3040,8 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                         continue
                     else:
                         debug(
-                            "Unknown type (\"d\", \"-\" etc) at line: \"%s\""
-                            % line
+                            "Unknown type (\"d\", \"-\" etc) at line: \"%s\"",
+                            line
                         )
                     try:
                         peaky = sl[0][1:10]
@@ -2571,8 +3054,8 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                             # SUIG, GUID and sticky bits should work, anything
                             # else will be skipped
                             debug(
-                                "Can't parse perms at line: \"%s\""
-                                % line
+                                "Can't parse perms at line: \"%s\"",
+                                line
                             )
                             continue
                     if sl[2] not in users:
@@ -2597,7 +3080,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                         elif sl[4][-1] == "T":
                             s = int(float(sl[4][0:-1]) * 1024 * 1024 * 1024 * 1024)
                         else:
-                            debug("Error parsing file size in line: %s" % line)
+                            debug("Error parsing file size in line: %s", line)
                             s = 0
                     # If we're in sftp mode then the filename won't necessarily
                     # be at position X but *will* be the last in the list. Date
@@ -2637,7 +3120,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                                     "%Y-%m-%d %H:%M"
                                 )))
                         except:
-                            debug("Can't parse date at line: \"%s\"" % line)
+                            debug("Can't parse date at line: \"%s\"", line)
                             continue
                     stats = [t, p, u, g, s, d]
                     # If we have a symlink
@@ -2690,6 +3173,68 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
         cat["/CAT_DATA/"]["groups"] = groups
         return cat
 
+    def parse_sftp_entries(self, cat, entries, startAt):
+        # The same as parse_ls for a single folder but from the attributes the
+        # sftp protocol hands back
+        if "/CAT_DATA/" not in cat:
+            cat["/CAT_DATA/"] = {"created": int(time.time())}
+        catData = cat["/CAT_DATA/"]
+        users = catData.setdefault("users", [])
+        groups = catData.setdefault("groups", [])
+        tmpCat = cat
+        for f in filter(bool, startAt.split("/")):
+            if f not in tmpCat:
+                tmpCat[f] = {"/NO_INDEX/": True}
+            tmpCat = tmpCat[f]
+        options = {}
+        for e in entries:
+            mode = e.get("permissions", 0)
+            if stat.S_ISDIR(mode):
+                t = self.FILE_TYPE_FOLDER
+            elif stat.S_ISLNK(mode):
+                t = self.FILE_TYPE_SYMLINK
+            elif stat.S_ISREG(mode):
+                t = self.FILE_TYPE_FILE
+            else:
+                continue
+            # Names where the server gives them (OpenSSH's longname is ls -l
+            # style), ids if not
+            sl = e.get("longname", "").split()
+            user = sl[2] if len(sl) > 3 else str(e.get("uid", ""))
+            group = sl[3] if len(sl) > 3 else str(e.get("gid", ""))
+            if user not in users:
+                users.append(user)
+            if group not in groups:
+                groups.append(group)
+            stats = [
+                t,
+                stat.S_IMODE(mode) & 0o777,
+                users.index(user),
+                groups.index(group),
+                e.get("size", 0),
+                e.get("mtime", 0)
+            ]
+            if t == self.FILE_TYPE_SYMLINK and "link_dest" in e:
+                stats.append(e["link_dest"])
+            options[e["name"]] = {"/": stats}
+            if t == self.FILE_TYPE_FOLDER:
+                options[e["name"]]["/NO_INDEX/"] = True
+        # Remove files that have been deleted since last time
+        for o in [o for o in filter(self.remove_stats, tmpCat) if o not in options]:
+            del tmpCat[o]
+        for o in options:
+            if o in tmpCat:
+                tmpCat[o]["/"] = options[o]["/"]
+            else:
+                tmpCat[o] = options[o]
+        try:
+            del tmpCat["/NO_INDEX/"]
+        except:
+            pass
+        catData["server"] = self.serverName
+        catData["updated"] = int(time.time())
+        return cat
+
     def up_dir_to_path(self, symlinkDest, prepend):
         # debug("To: %s, path: %s" % (symlinkDest, prepend))
         if len(prepend) > 1 and prepend[-1] == "/":
@@ -2708,6 +3253,21 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             val = default
         return val
 
+    def get_connection_settings(self, serverName=None):
+        # The server's settings for the connector, with the transport profile
+        # from check_transport filled in for anything left as "auto"
+        if serverName is None:
+            (serverName, settings) = (self.serverName, self.server["settings"])
+        else:
+            settings = self.servers[serverName]["settings"]
+        settings = dict(settings)
+        for key in ["compression", "cipher"]:
+            if settings.get(key, "auto") == "auto":
+                settings[key] = self.get_settings().get(
+                    "%s:transport_%s" % (serverName, key)
+                )
+        return settings
+
     def parse_order_by_setting(self, setting):
         setting = str(setting).lower()
         value = self.SORT_BY_NAME
@@ -2769,7 +3329,7 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             return json.loads(data, strict=False)
         except Exception as e:
             self.lastJsonifyError = "Error parsing JSON: %s" % str(e)
-            debug(self.lastJsonifyError)
+            warning(self.lastJsonifyError)
             return False
 
     def get_server_config_path(self):
@@ -2793,6 +3353,65 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             self.settings = sublime.load_settings(self.settingFile)
         return self.settings
 
+    def show_jobs(self):
+        # Everything queued or running with the option to cancel it
+        jobs = self.connector.jobs()
+        if not jobs:
+            return sublime.status_message("RemoteEdit: Nothing running")
+        now = time.time()
+        items = []
+        for job in jobs:
+            cmd = job["cmd"]
+            if isinstance(cmd, list):
+                cmd = "%s (+%s more)" % (cmd[0], len(cmd) - 1)
+            if "started_at" in job:
+                state = "Running %ds" % (now - job["started_at"])
+            else:
+                state = "Queued %ds" % (now - job["queued_at"])
+            items.append([
+                "  %s" % cmd.split("\n")[0][0:100],
+                "  %s, %s on %s" % (state, job["priority"], job["server_name"])
+            ])
+        self.show_quick_panel(
+            items,
+            lambda selection: self.handle_job_select(jobs, selection)
+        )
+
+    def handle_job_select(self, jobs, selection):
+        if selection != -1:
+            self.connector.cancel(jobs[selection]["future"])
+            self.show_jobs()
+
+    def show_stats(self):
+        # Percentiles of the time spent in each stage (see RemoteEditStats)
+        # per server and command type
+        lines = []
+        for s in self.connector.stats.summary():
+            lines.append("%s  %s  (%s commands)" % (s["server"], s["command"], s["count"]))
+            lines.append("    %-12s%10s%10s%10s%10s" % ("", "p50", "p95", "p99", "max"))
+            for (stage, start, end) in RemoteEditStats.STAGES + [("bytes", None, None)]:
+                if stage not in s["stages"]:
+                    continue
+                p = s["stages"][stage]
+                lines.append("    %-12s%10s%10s%10s%10s" % ((stage,) + tuple(
+                    [self.display_stat(stage, p[k]) for k in ["p50", "p95", "p99", "max"]]
+                )))
+            lines.append("")
+        if not lines:
+            return sublime.status_message("RemoteEdit: No commands run yet")
+        self.window.run_command(
+            "remote_edit_show_text",
+            {
+                "title": "RemoteEdit performance stats",
+                "contents": "Times in ms\n\n%s" % "\n".join(lines)
+            }
+        )
+
+    def display_stat(self, stage, value):
+        if stage == "bytes":
+            return self.display_size(value)
+        return "%.1f" % value
+
     def show_quick_panel(self, options, done):
         sublime.set_timeout(
             lambda: self.window.show_quick_panel(options, done),
@@ -2853,7 +3472,11 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
 
         if cmd:
             if self.serverName:
-                self.run_ssh_command(cmd, callback=self.update_status_bar)
+                self.run_ssh_command(
+                    cmd,
+                    callback=self.update_status_bar,
+                    priority="background"
+                )
             else:
                 self.window.active_view().set_status(
                     "RemoteEditStatus",
@@ -2940,26 +3563,26 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
                 if fullPath not in openFiles:
                     if os.path.getmtime(fullPath) < oldIfTouchedBefore:
                         os.remove(fullPath)
-                        debug("Deleting file: %s " % (fullPath))
+                        debug("Deleting file: %s", fullPath)
             # Now directories
             for d in dirs:
                 fullPath = os.path.join(root, d)
                 folders.append(fullPath)
             # Check to see if we're past our timeout
             if expireAt < time.time():
-                debug("tidy_local_tmp_path() is out of time, we took: %s seconds" % (time.time() - startAt))
+                debug("tidy_local_tmp_path() is out of time, we took: %s seconds", time.time() - startAt)
                 return
         folders.reverse()
         for d in folders:
             if expireAt < time.time():
-                debug("tidy_local_tmp_path() is out of time, we took: %s seconds" % (time.time() - startAt))
+                debug("tidy_local_tmp_path() is out of time, we took: %s seconds", time.time() - startAt)
                 return
             try:
                 os.rmdir(d)
-                debug("Deleting empty folder: %s" % d)
+                debug("Deleting empty folder: %s", d)
             except:
                 pass
-        debug("tidy_local_tmp_path() finished in %s seconds" % (time.time() - startAt))
+        debug("tidy_local_tmp_path() finished in %s seconds", time.time() - startAt)
 
     def make_local_folder(self):
         # file selected, ensure local folder is available
@@ -2976,9 +3599,6 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
             pass
         return localFolder
 
-    def get_arithmetic(self):
-        return ("echo \"uneeq\"`expr 66666666 + 44444445`\"uneeq\"", "uneeq111111111uneeq")
-
     def get_ls_params(self):
         if self.get_settings().get("%s:ls_version" % self.serverName) == "UNIX":
             if "darwin" in self.get_settings().get("%s:os" % self.serverName):
@@ -2992,151 +3612,608 @@ class RemoteEditCommand(sublime_plugin.WindowCommand):
         self,
         cmd,
         checkReturn=None,
-        listenAttempts=5,
         timeout=None,
         callback=None,
         cP=None,
         dropResults=False,
-        acceptNew=False
+        acceptNew=False,
+        priority=None,
+        stream=None
     ):
         if self.get_server_setting("sftp_only", False):
             return self.error_message("This method is not supported under sftp_only mode. You may enable /disable this setting in your per server settings file.")
-        (q, a) = self.get_arithmetic()
         return self.connector.run_remote_command(
             "ssh",
-            cmd + "; " + q,
-            a,
-            listenAttempts,
+            cmd,
+            checkReturn,
             timeout,
             callback,
             cP,
             dropResults,
             acceptNew,
             serverName=self.serverName,
-            serverSettings=self.server["settings"]
+            serverSettings=self.get_connection_settings(),
+            priority=priority,
+            stream=stream
         )
 
     def run_sftp_command(
         self,
         cmd,
         checkReturn=None,
-        listenAttempts=5,
         timeout=None,
         callback=None,
         cP=None,
         dropResults=False,
-        acceptNew=False
+        acceptNew=False,
+        priority=None
     ):
         return self.connector.run_remote_command(
-            "sftp",
+            self.get_sftp_app_type(),
             cmd,
             checkReturn,
-            listenAttempts,
             timeout,
             callback,
             cP,
             dropResults,
             acceptNew,
             serverName=self.serverName,
-            serverSettings=self.server["settings"]
+            serverSettings=self.get_connection_settings(),
+            priority=priority
+        )
+
+    def get_sftp_app_type(self):
+        # Talk the SFTP protocol ourselves rather than drive the sftp binary
+        if self.get_server_setting("sftp_protocol", False):
+            return "sftpv3"
+        return "sftp"
+
+    def run_ssh_batch(self, cmds, timeout=None, callback=None, cP=None, priority=None):
+        if self.get_server_setting("sftp_only", False):
+            return self.error_message("This method is not supported under sftp_only mode. You may enable /disable this setting in your per server settings file.")
+        return self.connector.run_remote_batch(
+            "ssh",
+            cmds,
+            timeout,
+            callback,
+            cP,
+            serverName=self.serverName,
+            serverSettings=self.get_connection_settings(),
+            priority=priority
+        )
+
+    def run_sftp_batch(self, cmds, timeout=None, callback=None, cP=None, priority=None):
+        return self.connector.run_remote_batch(
+            self.get_sftp_app_type(),
+            cmds,
+            timeout,
+            callback,
+            cP,
+            serverName=self.serverName,
+            serverSettings=self.get_connection_settings(),
+            priority=priority
         )
 
 
+class RemoteEditDispatcher(object):
+    # Takes the results of commands run with a callback to the main thread.
+    # Workers complete futures on their own threads, each one that lands is
+    # queued and a single set_timeout fires the lot. While anything is
+    # pending one ticker animates the status bar and gives up on anything
+    # that's gone well past its timeout, calling back with a failure.
+    # Results that turn up after that are orphans, only the last maxOrphans
+    # are kept (for the console).
+
+    window = None
+    stats = None
+    pending = None
+    completed = None
+    orphans = None
+    maxOrphans = 20
+    lock = None
+    draining = False
+    ticking = False
+    statusState = 0
+    statusDir = 1
+
+    def __init__(self, window, stats=None):
+        self.window = window
+        self.stats = stats
+        self.pending = {}
+        self.completed = collections.deque()
+        self.orphans = collections.deque(maxlen=self.maxOrphans)
+        self.lock = threading.Lock()
+
+    def add(self, future, expireTime, callback, cP, work=None):
+        with self.lock:
+            self.pending[future.key] = (expireTime, callback, cP, future, work)
+            startTicking = not self.ticking
+            self.ticking = True
+        future.add_done_callback(self.complete)
+        if startTicking:
+            sublime.set_timeout(self.tick, 100)
+
+    def complete(self, future):
+        # Called on the worker's thread
+        with self.lock:
+            self.completed.append(future)
+            startDraining = not self.draining
+            self.draining = True
+        if startDraining:
+            sublime.set_timeout(self.drain, 0)
+
+    def drain(self):
+        with self.lock:
+            futures = list(self.completed)
+            self.completed.clear()
+            self.draining = False
+            callbacks = []
+            for future in futures:
+                if future.cancelled:
+                    # Whoever cancelled it has moved on, no callback
+                    self.pending.pop(future.key, None)
+                elif future.key in self.pending:
+                    callbacks.append((self.pending.pop(future.key), future.results))
+                else:
+                    info("Results arrived after giving up on them: %s", future.key)
+                    self.orphans.append(future.results)
+        for ((expireTime, callback, cP, future, work), results) in callbacks:
+            debug("Results found, firing the callback")
+            self.fire(callback, cP, results)
+            if work is not None and self.stats:
+                work["timings"]["callback"] = time.time()
+                self.stats.record(work)
+
+    def tick(self):
+        now = time.time()
+        with self.lock:
+            # Give the command a little longer to timeout (15s) as the time it
+            # went on the queue wasn't necessarily the same time that it
+            # started processing
+            expired = [k for k in self.pending if now > self.pending[k][0] + 15]
+            expired = [self.pending.pop(k) for k in expired]
+            self.ticking = bool(self.pending)
+        for (expireTime, callback, cP, future, work) in expired:
+            warning("Timeout")
+            # Don't leave it on the queue, or running, with nobody waiting
+            future.cancel()
+            self.fire(callback, cP, {"success": False, "out": "", "err": ""})
+        self.update_status()
+        if self.ticking:
+            sublime.set_timeout(self.tick, 100)
+
+    def update_status(self):
+        if not self.ticking:
+            self.window.active_view().set_status("remoteedit", "")
+            return
+        before = self.statusState % 8
+        after = 7 - before
+        if not after:
+            self.statusDir = -1
+        elif not before:
+            self.statusDir = 1
+        self.statusState += self.statusDir
+        self.window.active_view().set_status("remoteedit", "RemoteEdit [%s=%s]" % (" " * before, " " * after))
+
+    def fire(self, callback, cP, results):
+        if cP is None:
+            callback(results)
+        else:
+            callback(results, cP)
+
+
+class RemoteEditCatStream(object):
+    # Builds the catalogue from the gzipped recursive ls cat_server streams
+    # back, as it arrives on the worker's thread. Whole folders are parsed at
+    # a time, anything after the last blank line waits for the rest. The
+    # structure of the catalogue dict is something like:
+    #
+    # cat["/CAT_DATA/"]["server"] = server name
+    # cat["/CAT_DATA/"]["created"] = unixtime created
+    # cat["/CAT_DATA/"]["updated"] = unixtime updated
+    # cat["/CAT_DATA/"]["refreshed"] = unixtime the whole tree was last
+    #   brought up to date, see RemoteEditCommand.refresh_cat
+    # cat["/CAT_DATA/"]["users"] = users dict int -> user name
+    # cat["/CAT_DATA/"]["groups"] = groups dict int -> group name
+    # cat["folder1"]["/"] = [list of stat info on folder 1]
+    # cat["folder1"]["folder2"]["/"] = [list of stat info on folder 2]
+    # cat["folder1"]["file1"]["/"] = [list of stat info on file 1]
+    #
+    # Stat info is a list of data:
+    # [0] - 0 = file, 1 = folder, 2 = symlink (see self.FILE_TYPE_FILE etc)
+    # [1] - convert to octal for file perms
+    # [2] - key of user dict to convert this id to a string user name
+    # [3] - key of group dict to convert this id to a string group name
+    # [4] - filesize in bytes
+    # [5] - date as unixtime
+    # [6] - if it's a symlink then record the full destination path
+    #
+    # Once saved it's kept as a RemoteEditCompactCat, which reads the same
+    # and is mapped from the file rather than loaded.
+
+    command = None
+    startAt = None
+    darwin = False
+    cat = None
+    decompressor = None
+    decoder = None
+    pending = ""
+    error = None
+
+    def __init__(self, command, startAt, cat=None):
+        self.command = command
+        self.startAt = startAt
+        self.darwin = "darwin" in command.get_settings().get(
+            "%s:os" % command.serverName
+        )
+        self.cat = cat if cat is not None else {}
+        # gzip rather than zlib headers
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+    def put(self, data):
+        if self.error:
+            return
+        try:
+            self.pending += self.decoder.decode(
+                self.decompressor.decompress(data)
+            )
+        except zlib.error as e:
+            self.error = str(e)
+            return
+        i = self.pending.rfind("\n\n")
+        if i != -1:
+            self.parse(self.pending[0:i + 1])
+            self.pending = self.pending[i + 2:]
+
+    def finish(self):
+        # Returns the catalogue, None if we didn't get all of it
+        if not self.error and not self.decompressor.eof:
+            self.error = "Listing cut short"
+        if self.error:
+            return None
+        self.pending += self.decoder.decode(self.decompressor.flush(), True)
+        self.parse(self.pending)
+        self.pending = ""
+        return self.cat
+
+    def parse(self, lsData):
+        if lsData.strip() or not self.cat:
+            self.cat = self.command.parse_ls(
+                self.cat,
+                lsData,
+                self.startAt,
+                darwin=self.darwin
+            )
+
+
+class RemoteEditTail(object):
+    # Where the output for one tail tab goes. The first chunk of a burst
+    # schedules a flush one frame later, which takes everything that has
+    # arrived by then to the view in a single remote_edit_tail.
+
+    window = None
+    viewId = None
+    path = None
+    serverName = None
+    chunks = None
+    lock = None
+    flushing = False
+    closed = False
+    frame = 16
+
+    def __init__(self, window, viewId, path, serverName):
+        self.window = window
+        self.viewId = viewId
+        self.path = path
+        self.serverName = serverName
+        self.chunks = []
+        self.lock = threading.Lock()
+
+    def put(self, data):
+        # Called on the worker's thread
+        with self.lock:
+            self.chunks.append(data)
+            startFlushing = not self.flushing
+            self.flushing = True
+        if startFlushing:
+            sublime.set_timeout(self.flush, self.frame)
+
+    def flush(self):
+        with self.lock:
+            data = "".join(self.chunks)
+            self.chunks = []
+            self.flushing = False
+        if data and not self.closed:
+            self.window.run_command(
+                "remote_edit_tail",
+                {"viewId": self.viewId, "data": data}
+            )
+
+
+class RemoteEditTailSession(object):
+    # Every file being tailed on a server, each followed by a tail -F of its
+    # own in the background of a single ssh shell. A tail's lines come back
+    # tagged with its file's id so that the worker's output (see put) can be
+    # split back up between the RemoteEditTails of each file, and the first
+    # thing it says is its pid so that it can be killed when the file is
+    # dropped.
+    #
+    # Adding or dropping a file only starts or kills that file's tail, see
+    # next_command, the others carry on untouched. The last 10 lines of a
+    # file are shown when it is first added.
+
+    line = re.compile(r"^(\d+)([:!])(.*)$")
+    tails = None
+    escapedPaths = None
+    # File id by path and path by id. Ids aren't reused so that anything
+    # still to come from a dropped file's tail can be told apart.
+    ids = None
+    paths = None
+    nextId = 1
+    # The pid of each file's tail once we've heard it
+    pids = None
+    # Files yet to be started and pids of tails yet to be killed
+    added = None
+    stale = None
+    changed = False
+    future = None
+    lock = None
+    partial = ""
+
+    def __init__(self):
+        self.tails = {}
+        self.escapedPaths = {}
+        self.ids = {}
+        self.paths = {}
+        self.pids = {}
+        self.added = []
+        self.stale = []
+        self.lock = threading.Lock()
+
+    def add(self, tail, escapedPath):
+        with self.lock:
+            if tail.path not in self.tails:
+                self.tails[tail.path] = []
+                self.escapedPaths[tail.path] = escapedPath
+                self.ids[tail.path] = self.nextId
+                self.paths[self.nextId] = tail.path
+                self.nextId += 1
+                self.added.append(tail.path)
+                self.changed = True
+            self.tails[tail.path].append(tail)
+
+    def remove(self, tail):
+        with self.lock:
+            path = tail.path
+            tails = self.tails.get(path, [])
+            if tail in tails:
+                tails.remove(tail)
+            if tails or path not in self.tails:
+                return
+            del self.tails[path]
+            del self.escapedPaths[path]
+            del self.paths[self.ids.pop(path)]
+            if path in self.added:
+                self.added.remove(path)
+            elif path in self.pids:
+                self.stale.append(self.pids.pop(path))
+                self.changed = True
+            # Otherwise its pid is still to come, see split
+
+    def is_empty(self):
+        with self.lock:
+            return not self.tails
+
+    def next_command(self):
+        # Called by the worker, returns what to write to the shell to bring
+        # the running tails up to date or None if they already are
+        with self.lock:
+            if not self.changed:
+                return None
+            self.changed = False
+            cmds = ["kill %s" % pid for pid in self.stale]
+            cmds += [self.tail_command(path, 10) for path in self.added]
+            self.stale = []
+            self.added = []
+            return "\n".join(cmds) or None
+
+    def restart_command(self):
+        # Called by the worker when the shell has died, returns what to run
+        # in a new one to start every tail again. The old tails may well
+        # have outlived their shell so they're killed first.
+        with self.lock:
+            cmds = [
+                "kill %s 2>/dev/null" % pid
+                for pid in list(self.pids.values()) + self.stale
+            ]
+            cmds += [
+                self.tail_command(path, 10 if path in self.added else 0)
+                for path in sorted(self.tails)
+            ]
+            self.pids = {}
+            self.stale = []
+            self.added = []
+            self.changed = False
+            self.partial = ""
+            return "\n".join(cmds)
+
+    def tail_command(self, path, lines):
+        # sh gives us its pid before becoming tail, then each line is
+        # tagged with the file's id
+        fileId = self.ids[path]
+        return (
+            "sh -c 'echo $$; exec tail -n %d -F \"$1\"' tail %s | "
+            "{ read -r pid; printf '%d!%%s\\n' \"$pid\"; "
+            "while IFS= read -r l; do printf '%d:%%s\\n' \"$l\"; done; } &"
+        ) % (lines, self.escapedPaths[path], fileId, fileId)
+
+    def put(self, data):
+        # Called on the worker's thread with whatever the tails wrote
+        with self.lock:
+            chunks = [
+                (list(self.tails.get(path, [])), text)
+                for (path, text) in self.split(data)
+            ]
+        for (tails, text) in chunks:
+            for tail in tails:
+                tail.put(text)
+
+    def split(self, data):
+        # Returns a list of (path, text), noting the pids as they turn up.
+        # Anything after the last newline is kept until the line is whole.
+        chunks = []
+        self.partial += data
+        lines = self.partial.split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            m = self.line.match(line)
+            if not m:
+                continue
+            path = self.paths.get(int(m.group(1)))
+            if m.group(2) == ":":
+                if path:
+                    chunks.append((path, m.group(3) + "\n"))
+            elif not m.group(3).isdigit():
+                continue
+            elif path:
+                self.pids[path] = m.group(3)
+            else:
+                # Dropped before we knew who to kill
+                self.stale.append(m.group(3))
+                self.changed = True
+        return chunks
+
+
 class RemoteEditConnector(object):
     window = None
-    appResults = {}
-    sshQueue = None
-    sshThreads = []
-    sftpQueue = None
-    sftpThreads = []
+    dispatcher = None
+    stats = None
+    pools = None
+    keepWarm = None
     timeout = 60
-    tailClosedTabs = []
+    tails = None
+    engine = None
+    # Servers we've talked to over a multiplexed connection, their masters
+    # are stopped when we go away
+    multiplexed = {}
 
-    def __init__(self, window):
+    def __init__(self, window, engine="threads", maxWorkers=4, idleTimeout=60, serverIdleTimeout=600, reserveInteractive=False, keepAlive=60):
         self.window = window
-        # Fire up a ssh and sftp thread and queue. Will immediately block the
-        # queue waiting on first job.
-        if not self.sftpQueue:
-            self.sftpQueue = queue.Queue()
-        if not self.sshQueue:
-            self.sshQueue = queue.Queue()
-        if not self.sshThreads:
-            self.create_ssh_thread()
-        if not self.sftpThreads:
-            self.create_sftp_thread()
+        self.stats = RemoteEditStats.RemoteEditStats()
+        self.dispatcher = RemoteEditDispatcher(window, self.stats)
+        # Worker pools are made as needed, one per server and appType. See
+        # get_pool
+        self.pools = {}
+        self.maxWorkers = maxWorkers
+        self.idleTimeout = idleTimeout
+        self.serverIdleTimeout = serverIdleTimeout
+        self.reserveInteractive = reserveInteractive
+        self.keepAlive = keepAlive or None
+        self.keepWarm = []
+        # RemoteEditTail by view id, RemoteEditTailSession by server
+        self.tails = {}
+        self.tailSessions = {}
+        if engine == "asyncio":
+            # One event loop thread drives every ssh / sftp process. Imported
+            # here as it needs a newer python than ST3 ships with.
+            from .remote_edit import RemoteEditAsyncConnector
+            self.engine = RemoteEditAsyncConnector.RemoteEditAsyncConnector(
+                sublime.platform(),
+                evictAfter=self.serverIdleTimeout,
+                keepWarm=self.keepWarm,
+                reserveInteractive=reserveInteractive,
+                keepAlive=self.keepAlive
+            )
+
+    def get_pool_key(self, appType, serverName, serverSettings):
+        m = hashlib.md5()
+        m.update(json.dumps(serverSettings, sort_keys=True).encode("utf-8"))
+        return (appType, serverName, m.hexdigest())
+
+    def get_pool(self, appType, serverName, serverSettings):
+        # A pool per server (and version of its settings) so that work always
+        # goes to a worker already connected to the right host. Each keeps a
+        # worker warm until it's been unused for serverIdleTimeout seconds.
+        # The asyncio engine keeps its sessions by the same key.
+        key = self.get_pool_key(appType, serverName, serverSettings)
+        # Forget any pools whose workers have all gone
+        for k in [k for k in self.pools if k != key and self.pools[k].is_empty()]:
+            del self.pools[k]
+        if key not in self.pools:
+            if appType == "sftpv3":
+                # Always threads, the protocol worker blocks on its own reads
+                workerClass = RemoteEditSftpWorker.RemoteEditSftpWorker
+            else:
+                workerClass = RemoteEditConnectionWorker.RemoteEditConnectionWorker
+            self.pools[key] = RemoteEditWorkerPool.RemoteEditWorkerPool(
+                appType,
+                workerClass,
+                sublime.platform(),
+                minWorkers=1,
+                maxWorkers=self.maxWorkers,
+                idleTimeout=self.idleTimeout,
+                serverName=serverName,
+                evictAfter=None if serverName in self.keepWarm else self.serverIdleTimeout,
+                reserveInteractive=self.reserveInteractive,
+                keepAlive=self.keepAlive
+            )
+        return self.pools[key]
+
+    def preconnect(self, appTypes, serverName, serverSettings):
+        # Queue an empty command for each appType, the worker that picks it
+        # up connects and stays connected. These pools are never evicted.
+        if serverName not in self.keepWarm:
+            self.keepWarm.append(serverName)
+        for appType in appTypes:
+            self.run_remote_command(
+                appType,
+                "",
+                dropResults=True,
+                serverName=serverName,
+                serverSettings=serverSettings
+            )
 
     def killTab(self, viewId):
-        self.tailClosedTabs.append(viewId)
-
-    def create_sftp_thread(self):
-        key = len(self.sftpThreads)
-        self.sftpThreads.append(
-            RemoteEditConnectionWorker.RemoteEditConnectionWorker()
-        )
-        self.sftpThreads[key].start()
-        self.sftpThreads[key].config(
-            key,
-            "sftp",
-            self.sftpQueue,
-            self.appResults,
-            sublime.platform()
-        )
+        # A tail tab has been closed, stop tailing its file. The session goes
+        # once it has nothing left to tail.
+        tail = self.tails.pop(viewId, None)
+        if not tail:
+            return
+        tail.closed = True
+        session = self.tailSessions.get(tail.serverName)
+        if not session:
+            return
+        session.remove(tail)
+        if session.is_empty():
+            debug("Killing SSH thread for %s", tail.serverName)
+            del self.tailSessions[tail.serverName]
+            self.cancel(session.future)
 
-    def create_ssh_thread(self):
-        key = len(self.sshThreads)
-        self.sshThreads.append(
-            RemoteEditConnectionWorker.RemoteEditConnectionWorker()
-        )
-        self.sshThreads[key].start()
-        self.sshThreads[key].config(
-            key,
-            "ssh",
-            self.sshQueue,
-            self.appResults,
-            sublime.platform()
-        )
+    def pool_stats(self):
+        return [self.pools[key].stats() for key in sorted(self.pools)]
 
     def __del__(self):
         debug("__del__ called")
-        self.remove_ssh_thread(len(self.sshThreads))
-        self.remove_sftp_thread(len(self.sftpThreads))
-
-    def remove_ssh_thread(self, threadsToRemove=1):
-        tc = len(self.sshThreads)
-        if tc > 0:
-            index = tc - 1
-            threadsToRemove -= 1
-            debug("Popping ssh")
-            self.sshThreads.pop()
-            # We need to send tc * messages down the wire so that each thread
-            # gets a copy of the message. The threadId of each thread is its
-            # key on the list.
-            for i in range(tc):
-                self.sshQueue.put({"KILL": index})
-            if threadsToRemove > 0:
-                self.remove_ssh_thread(threadsToRemove)
-
-    def remove_sftp_thread(self, threadsToRemove=1):
-        tc = len(self.sftpThreads)
-        if tc > 0:
-            index = tc - 1
-            threadsToRemove -= 1
-            debug("Popping sftp")
-            self.sftpThreads.pop()
-            # We need to send tc * messages down the wire so that each thread
-            # gets a copy of the message. The threadId of each thread is its
-            # key on the list.
-            for i in range(tc):
-                self.sftpQueue.put({"KILL": index})
-            if threadsToRemove > 0:
-                self.remove_sftp_thread(threadsToRemove)
+        self.stop_control_masters()
+        for key in self.pools:
+            self.pools[key].stop()
+        if self.engine:
+            self.engine.stop()
+
+    def stop_control_masters(self):
+        for serverName in list(self.multiplexed):
+            info("Stopping control master for %s", serverName)
+            RemoteEditConnectionWorker.stop_control_master(
+                self.multiplexed.pop(serverName),
+                sublime.platform()
+            )
 
     def run_remote_command(
         self,
         appType,
         cmd,
-        checkReturn,
-        listenAttempts=5,
+        checkReturn=None,
         timeout=None,
         callback=None,
         cP=None,
@@ -3144,122 +4221,125 @@ class RemoteEditConnector(object):
         acceptNew=False,
         serverName=None,
         serverSettings=None,
-        q=None
+        q=None,
+        progress=None,
+        priority=None,
+        stream=None
     ):
-        debug("run %s command called with cmd: \"%s\"" % (
+        debug(
+            "run %s command called with cmd: \"%s\"",
             appType,
             cmd
-        ))
+        )
         if timeout is None:
             timeout = self.timeout
         expireTime = time.time() + timeout
+        if serverSettings and serverSettings.get("multiplex"):
+            self.multiplexed[serverName] = serverSettings
         work = {}
+        work["app_type"] = appType
+        work["timings"] = {"enqueued": time.time()}
         work["server_name"] = serverName
         work["settings"] = serverSettings
         work["cmd"] = cmd
         work["prompt_contains"] = checkReturn
-        work["listen_attempts"] = listenAttempts
         work["drop_results"] = dropResults
         work["timeout"] = timeout
         work["accept_new_host"] = acceptNew
         work["queue"] = q
-        # Generate a unique key to listen for results on
+        work["progress"] = progress
+        work["stream"] = stream
+        # "interactive" for anything the user is sat waiting on, "background"
+        # for work nobody is waiting on. See RemoteEditWorkQueue.
+        if priority is None:
+            priority = "background" if dropResults else "normal"
+        work["priority"] = priority
+        # Generate a unique key for the command. Whichever worker runs it
+        # completes the future with the results.
         m = hashlib.md5()
         m.update(("%s%s" % (cmd, str(time.time()))).encode('utf-8'))
         key = m.hexdigest()
         work["key"] = key
-        if appType == "sftp":
-            self.sftpQueue.put(work)
+        future = RemoteEditFuture.RemoteEditFuture(key)
+        work["future"] = future
+        if self.engine and appType != "sftpv3":
+            self.engine.put(
+                self.get_pool_key(appType, serverName, serverSettings),
+                work
+            )
         else:
-            self.sshQueue.put(work)
+            self.get_pool(appType, serverName, serverSettings).put(work)
         debug("....now on the queue.....")
-        if q:
-            return
+        if q or dropResults:
+            future.add_done_callback(lambda f: self.record_stats(f, work))
+            return future
         elif callback:
-            debug("Calling set_timeout to check for results")
-            # TODO: This should be totally events driven, have a thread block
-            # on a queue and on return of data call a callback. Once we've
-            # moved at least a bit towards that from where we are now it should
-            # be a much easier task. For now we'll just have to check the
-            # results dict regularly with set timeouts.
-            sublime.set_timeout(
-                lambda: self.handle_callbacks(
-                    key,
-                    expireTime,
-                    callback,
-                    cP
-                ),
-                100
-            )
-            return
-        elif dropResults:
-            return
-        while True:
-            # Give the command a little longer to timeout (15s) as the time it
-            # went on the queue wasn't necessarily the same time that it started
-            # processing
-            if time.time() > (expireTime + 15):
-                debug("Timeout")
-                return False
-            if key in self.appResults:
-                results = self.appResults[key]
-                del self.appResults[key]
-                debug("Result found for cmd: %s" % cmd)
-                break
-            else:
-                time.sleep(0.1)
-        if not callback:
-            return results["success"]
-
-    def handle_callbacks(self, key, expireTime, callback, cP, statusState=0, statusDir=1):
-        before = statusState % 8
-        after = 7 - before
-        if not after:
-            statusDir = -1
-        elif not before:
-            statusDir = 1
-        statusState += statusDir
-        self.window.active_view().set_status("remoteedit", "RemoteEdit [%s=%s]" % (" " * before, " " * after))
-        if key in self.appResults:
-            self.window.active_view().set_status("remoteedit", "")
-            debug("Results found in callback handler, firing the callback")
-            results = self.appResults[key]
-            if results["prompt_contains"]:
-                results["out"] = results["out"].replace(results["prompt_contains"], "")
-            del self.appResults[key]
-            if cP is None:
-                callback(results)
-            else:
-                callback(results, cP)
+            # The callback is fired on the main thread once the results are in
+            self.dispatcher.add(future, expireTime, callback, cP, work)
+            return future
         # Give the command a little longer to timeout (15s) as the time it
         # went on the queue wasn't necessarily the same time that it started
         # processing
-        elif time.time() > (expireTime + 15):
-            self.window.active_view().set_status("remoteedit", "")
-            if cP is None:
-                callback(
-                    {"success": False, "out": "", "err": ""}
-                )
-            else:
-                callback(
-                    {"success": False, "out": "", "err": ""},
-                    cP
-                )
-        else:
-            sublime.set_timeout(
-                lambda: self.handle_callbacks(
-                    key,
-                    expireTime,
-                    callback,
-                    cP,
-                    statusState,
-                    statusDir
-                ),
-                100
-            )
+        results = future.result(max(expireTime + 15 - time.time(), 0))
+        if results is None:
+            warning("Timeout")
+            future.cancel()
+            return False
+        debug("Result found for cmd: %s", cmd)
+        self.record_stats(future, work)
+        if isinstance(cmd, list):
+            return results["success"] and results["batch"]
+        if not callback:
+            return results["success"]
+
+    def record_stats(self, future, work):
+        # Cancelled work never finished so tells us nothing
+        if not future.cancelled:
+            self.stats.record(work)
+
+    def cancel(self, future):
+        # Queued work is dropped, running work interrupted where the worker
+        # can (see RemoteEditConnectionWorker.await_response). Callbacks for
+        # it are never fired.
+        if future and future.cancel():
+            debug("Cancelled %s", future.key)
+
+    def jobs(self):
+        # Work queued or running in any pool or the asyncio engine
+        jobs = []
+        for pool in list(self.pools.values()):
+            jobs.extend(pool.jobs())
+        if self.engine:
+            jobs.extend(self.engine.jobs())
+        return [work for work in jobs if not work["future"].cancelled]
+
+    def run_remote_batch(
+        self,
+        appType,
+        cmds,
+        timeout=None,
+        callback=None,
+        cP=None,
+        serverName=None,
+        serverSettings=None,
+        priority=None
+    ):
+        # Send every command to one worker in a single write rather than one
+        # queue trip (and network round trip) each. The results dict gains a
+        # "batch" list holding the out, err and exit_status of each command.
+        # Without a callback that list is returned, False on failure.
+        return self.run_remote_command(
+            appType,
+            list(cmds),
+            timeout=timeout,
+            callback=callback,
+            cP=cP,
+            serverName=serverName,
+            serverSettings=serverSettings,
+            priority=priority
+        )
 
     def tail(self, path, escapedPath, serverName, serverSettings):
-        q = queue.Queue()
         tab = self.window.new_file()
         tab.set_scratch(True)
         tab.set_name("Tailing %s..." % path)
@@ -3267,44 +4347,29 @@ class RemoteEditConnector(object):
         reTailData["path"] = path
         reTailData["pos"] = 0
         tab.settings().set("reTailData", reTailData)
-        self.create_ssh_thread()
-        self.run_remote_command(
+        tail = RemoteEditTail(self.window, tab.id(), path, serverName)
+        self.tails[tab.id()] = tail
+        # Every tail on a server shares the one session
+        session = self.tailSessions.get(serverName)
+        if session and not session.future.done():
+            session.add(tail, escapedPath)
+            return
+        if self.engine:
+            # The pools give a tail a worker of its own, the engine doesn't
+            self.engine.create_worker(
+                self.get_pool_key("ssh", serverName, serverSettings)
+            )
+        session = RemoteEditTailSession()
+        session.add(tail, escapedPath)
+        self.tailSessions[serverName] = session
+        session.future = self.run_remote_command(
             "ssh",
-            "tail -f %s" % escapedPath,
-            checkReturn="",
+            session.next_command(),
             serverName=serverName,
             serverSettings=serverSettings,
-            q=q,
+            q=session,
             dropResults=True
         )
-        sublime.set_timeout(
-            lambda: self.tail_updater(
-                tab.id(), q
-            ), 1000
-        )
-
-    def tail_updater(self, viewId, q):
-        try:
-            data = q.get_nowait()
-            # While we're here, check to see if the tab has been closed
-            if viewId in self.tailClosedTabs:
-                q.put("{{%%KILL%%}}")
-                debug("Killing SSH thread for view id %s" % viewId)
-                # Remove viewId from list
-                self.tailClosedTabs.remove(viewId)
-                return
-        except queue.Empty:
-            data = ""
-        if data:
-            sublime.active_window().run_command(
-                "remote_edit_tail",
-                {"viewId": viewId, "data": data}
-            )
-        sublime.set_timeout(
-            lambda: self.tail_updater(
-                viewId, q
-            ), 1000
-        )
 
 
 class RemoteEditTailCommand(sublime_plugin.TextCommand):
@@ -3343,13 +4408,23 @@ class RemoteEditMarkDirtyCommand(sublime_plugin.TextCommand):
 
 class RemoteEditListFolderCommand(sublime_plugin.TextCommand):
     def run(self, edit, path="", contents=""):
-        debug("Listing folder %s" % path, "LIST")
+        debug("Listing folder %s", path, app="LIST")
         results = self.view.window().new_file()
         results.set_name("Files and folders at %s" % path)
         newRegion = sublime.Region(1, 0)
         results.replace(edit, newRegion, contents)
 
 
+class RemoteEditShowTextCommand(sublime_plugin.TextCommand):
+    def run(self, edit, title="", contents="", syntax=None):
+        view = self.view.window().new_file()
+        view.set_name(title)
+        view.set_scratch(True)
+        if syntax:
+            view.set_syntax_file(syntax)
+        view.insert(edit, 0, contents)
+
+
 class RemoteEditDisplaySearchCommand(sublime_plugin.TextCommand):
     def run(self, edit, search="", serverName="", filePath="", baseDir=""):
         try:
@@ -3375,9 +4450,6 @@ class RemoteEditDisplaySearchCommand(sublime_plugin.TextCommand):
             if i is 1:
                 # First line is our search command
                 continue
-            if "uneeq111111111uneeq" in line:
-                # We're done
-                break
             if line and line[0:2] == "--":
                 inResult = False
                 continue
@@ -3556,9 +4628,13 @@ class RemoteEditMouseCommand(sublime_plugin.TextCommand):
                 break
         if not fileName:
             return
-        debug("Server: %s, File: %s, Line: %s" % (
-            serverName, fileName, lineNumber
-        ), "MOUSE")
+        debug(
+            "Server: %s, File: %s, Line: %s",
+            serverName,
+            fileName,
+            lineNumber,
+            app="MOUSE"
+        )
         # Now just to open fileName at lineNumber
         self.view.window().run_command("remote_edit", {
             "serverName": serverName,
@@ -3567,14 +4643,49 @@ class RemoteEditMouseCommand(sublime_plugin.TextCommand):
         })
 
 
-def debug(data, app="MAIN"):
-    if len(data) > 3000:
-        print("%s %s: %s" % (app, time.strftime("%H:%M:%S"), data[0:3000]))
-    else:
-        print("%s %s: %s" % (app, time.strftime("%H:%M:%S"), data))
+def debug(msg, *args, app="MAIN"):
+    # Formatted (msg % args) only if debug logging is on, see RemoteEditLog
+    RemoteEditLog.log.write(RemoteEditLog.DEBUG, app, msg, args)
+
+
+def info(msg, *args, app="MAIN"):
+    RemoteEditLog.log.write(RemoteEditLog.INFO, app, msg, args)
+
+
+def warning(msg, *args, app="MAIN"):
+    RemoteEditLog.log.write(RemoteEditLog.WARNING, app, msg, args)
+
+
+def configure_log():
+    settings = sublime.load_settings(RemoteEditCommand.settingFile)
+    logFile = settings.get("log_file", "")
+    if logFile:
+        logFile = os.path.expanduser(os.path.expandvars(logFile))
+    RemoteEditLog.log.configure(
+        settings.get("log_level", "info"),
+        settings.get("log_buffer_lines", 1000),
+        logFile or None,
+        settings.get("log_file_max_bytes", 1048576),
+        settings.get("log_file_backups", 3)
+    )
+
+
+def plugin_unloaded():
+    # Don't leave ssh masters running once we've gone
+    multiplexed = RemoteEditConnector.multiplexed
+    for serverName in list(multiplexed):
+        RemoteEditConnectionWorker.stop_control_master(
+            multiplexed.pop(serverName),
+            sublime.platform()
+        )
 
 
 def plugin_loaded():
+    configure_log()
+    sublime.load_settings(RemoteEditCommand.settingFile).add_on_change(
+        "remote_edit_log",
+        configure_log
+    )
     sublime.active_window().run_command(
         "remote_edit",
         {"action": "on_app_start"}
@@ -0,0 +1,562 @@
+# coding=utf-8
+import os
+import sys
+import stat
+import struct
+import signal
+import subprocess
+import threading
+import queue
+import time
+import pwd
+import grp
+
+
+# A stand-in for ssh that never leaves the machine. run_bench.py puts a
+# wrapper called ssh in front of RemoteEdit (see get_bin_path) that runs
+#
+#   fakessh.py ssh [ssh options] user@host [command]
+#
+# Options are accepted and ignored. With -s we run the sftp subsystem
+# (sftp-server below), with a command we run that, otherwise a shell. Either
+# way it runs locally in RE_BENCH_ROOT and everything going in or out passes
+# through a Link that plays the part of the network:
+#
+#   RE_BENCH_CONNECT = ms to sleep before anything happens (handshake / auth)
+#   RE_BENCH_LATENCY = round trip in ms, each direction is delayed by half
+#   RE_BENCH_BANDWIDTH = bytes a second each way, 0 for no limit
+#
+# The sftp wrapper runs the real sftp client with -S pointing at the ssh
+# wrapper so it talks to sftp-server the same way.
+#
+# sftp-server is a minimal SFTP version 3 server working on the local
+# filesystem, relative paths from RE_BENCH_ROOT.
+
+
+# ssh options that take a value
+SSH_VALUE_OPTIONS = "BbcDEeFIiJLlmOopQRSWw"
+# What -Q cipher lists, see get_fast_ciphers
+CIPHERS = [
+    "aes128-ctr",
+    "aes256-ctr",
+    "aes128-gcm@openssh.com",
+    "aes256-gcm@openssh.com",
+    "chacha20-poly1305@openssh.com"
+]
+
+SSH_FXP_INIT = 1
+SSH_FXP_VERSION = 2
+SSH_FXP_OPEN = 3
+SSH_FXP_CLOSE = 4
+SSH_FXP_READ = 5
+SSH_FXP_WRITE = 6
+SSH_FXP_LSTAT = 7
+SSH_FXP_FSTAT = 8
+SSH_FXP_SETSTAT = 9
+SSH_FXP_FSETSTAT = 10
+SSH_FXP_OPENDIR = 11
+SSH_FXP_READDIR = 12
+SSH_FXP_REMOVE = 13
+SSH_FXP_MKDIR = 14
+SSH_FXP_RMDIR = 15
+SSH_FXP_REALPATH = 16
+SSH_FXP_STAT = 17
+SSH_FXP_RENAME = 18
+SSH_FXP_READLINK = 19
+SSH_FXP_STATUS = 101
+SSH_FXP_HANDLE = 102
+SSH_FXP_DATA = 103
+SSH_FXP_NAME = 104
+SSH_FXP_ATTRS = 105
+
+SSH_FX_OK = 0
+SSH_FX_EOF = 1
+SSH_FX_NO_SUCH_FILE = 2
+SSH_FX_PERMISSION_DENIED = 3
+SSH_FX_FAILURE = 4
+SSH_FX_OP_UNSUPPORTED = 8
+
+SSH_FILEXFER_ATTR_SIZE = 0x01
+SSH_FILEXFER_ATTR_UIDGID = 0x02
+SSH_FILEXFER_ATTR_PERMISSIONS = 0x04
+SSH_FILEXFER_ATTR_ACMODTIME = 0x08
+SSH_FILEXFER_ATTR_EXTENDED = 0x80000000
+
+SSH_FXF_READ = 0x01
+SSH_FXF_WRITE = 0x02
+SSH_FXF_APPEND = 0x04
+SSH_FXF_CREAT = 0x08
+SSH_FXF_TRUNC = 0x10
+SSH_FXF_EXCL = 0x20
+
+
+class Link(object):
+    # One direction of the pretend connection. Whatever is read from src
+    # turns up on dst delay seconds later and no quicker than bandwidth bytes
+    # a second.
+
+    src = None
+    dst = None
+    delay = 0
+    bandwidth = 0
+    queue = None
+    writer = None
+
+    def __init__(self, src, dst, delay=0, bandwidth=0):
+        self.src = src
+        self.dst = dst
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.queue = queue.Queue()
+
+    def start(self):
+        reader = threading.Thread(target=self.read)
+        reader.daemon = True
+        reader.start()
+        self.writer = threading.Thread(target=self.write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def join(self):
+        self.writer.join()
+
+    def read(self):
+        while True:
+            try:
+                data = os.read(self.src, 65536)
+            except OSError:
+                data = b""
+            self.queue.put((time.time() + self.delay, data))
+            if not data:
+                return
+
+    def write(self):
+        while True:
+            (dueAt, data) = self.queue.get()
+            wait = dueAt - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            if not data:
+                break
+            if self.bandwidth:
+                time.sleep(float(len(data)) / self.bandwidth)
+            try:
+                while data:
+                    data = data[os.write(self.dst, data):]
+            except OSError:
+                break
+        try:
+            os.close(self.dst)
+        except OSError:
+            pass
+
+
+def parse_ssh_args(args):
+    # Returns (options dict, host, command). Only the last of each option
+    # is kept, which is all we need.
+    options = {}
+    positional = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if positional or arg == "--" or arg[0:1] != "-" or arg == "-":
+            if arg != "--" or positional:
+                positional.append(arg)
+            else:
+                positional.extend(args[i:])
+                break
+            continue
+        for (j, flag) in enumerate(arg[1:]):
+            if flag in SSH_VALUE_OPTIONS:
+                value = arg[j + 2:]
+                if not value and i < len(args):
+                    value = args[i]
+                    i += 1
+                options[flag] = value
+                break
+            options[flag] = True
+    host = positional[0] if positional else None
+    return (options, host, " ".join(positional[1:]))
+
+
+def get_env_number(name, default=0):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def run_ssh(args):
+    (options, host, command) = parse_ssh_args(args)
+    if options.get("Q"):
+        if options["Q"] == "cipher":
+            sys.stdout.write("\n".join(CIPHERS) + "\n")
+        return 0
+    if options.get("O"):
+        # Control master commands, there's never a master to talk to
+        return 0
+    if not host:
+        sys.stderr.write("usage: ssh [options] destination [command]\n")
+        return 255
+    time.sleep(get_env_number("RE_BENCH_CONNECT") / 1000)
+    if options.get("s"):
+        child = [sys.executable, os.path.abspath(__file__), "sftp-server"]
+    elif command:
+        child = ["bash", "-c", command]
+    else:
+        child = ["bash", "--norc", "--noprofile"]
+    process = subprocess.Popen(
+        child,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=os.environ.get("RE_BENCH_ROOT", os.getcwd())
+    )
+
+    def hang_up(signum, frame):
+        # The worker closing its connection, take the far end with us
+        process.kill()
+        os._exit(255)
+
+    signal.signal(signal.SIGTERM, hang_up)
+    delay = get_env_number("RE_BENCH_LATENCY") / 2000
+    bandwidth = get_env_number("RE_BENCH_BANDWIDTH")
+    links = [
+        Link(sys.stdin.fileno(), process.stdin.fileno(), delay, bandwidth),
+        Link(process.stdout.fileno(), sys.stdout.fileno(), delay, bandwidth),
+        Link(process.stderr.fileno(), sys.stderr.fileno(), delay, bandwidth)
+    ]
+    for link in links:
+        link.start()
+    status = process.wait()
+    # Let whatever is still in flight arrive
+    links[1].join()
+    links[2].join()
+    return status
+
+
+class SftpServer(object):
+    # Requests are handled one at a time in the order they arrive, which is
+    # all a client can rely on anyway.
+
+    inp = None
+    out = None
+    handles = None
+    nextHandle = 0
+    users = None
+    groups = None
+
+    def __init__(self, inp, out):
+        self.inp = inp
+        self.out = out
+        self.handles = {}
+        self.users = {}
+        self.groups = {}
+
+    def serve(self):
+        while True:
+            header = self.read_exactly(4)
+            if header is None:
+                return
+            packet = self.read_exactly(struct.unpack(">I", header)[0])
+            if not packet:
+                return
+            self.handle(packet[0], Reader(packet[1:]))
+
+    def read_exactly(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.inp.read(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def send(self, packetType, payload):
+        self.out.write(struct.pack(">IB", len(payload) + 1, packetType) + payload)
+        self.out.flush()
+
+    def send_status(self, requestId, code, message=""):
+        self.send(
+            SSH_FXP_STATUS,
+            struct.pack(">II", requestId, code) + string(message) + string("")
+        )
+
+    def send_names(self, requestId, names):
+        # names is a list of (filename, longname, attrs bytes)
+        payload = struct.pack(">II", requestId, len(names))
+        for (name, longName, attrs) in names:
+            payload += string(name) + string(longName) + attrs
+        self.send(SSH_FXP_NAME, payload)
+
+    def handle(self, packetType, r):
+        if packetType == SSH_FXP_INIT:
+            return self.send(SSH_FXP_VERSION, struct.pack(">I", 3))
+        requestId = r.u32()
+        try:
+            if packetType == SSH_FXP_OPEN:
+                path = r.string()
+                pflags = r.u32()
+                attrs = r.attrs()
+                self.open_file(requestId, path, pflags, attrs)
+            elif packetType == SSH_FXP_CLOSE:
+                handle = self.handles.pop(r.string())
+                if handle[0] == "file":
+                    os.close(handle[1])
+                self.send_status(requestId, SSH_FX_OK)
+            elif packetType == SSH_FXP_READ:
+                fd = self.get_fd(r.string())
+                offset = r.u64()
+                data = os.pread(fd, r.u32(), offset)
+                if data:
+                    self.send(
+                        SSH_FXP_DATA,
+                        struct.pack(">I", requestId) + string(data)
+                    )
+                else:
+                    self.send_status(requestId, SSH_FX_EOF, "EOF")
+            elif packetType == SSH_FXP_WRITE:
+                fd = self.get_fd(r.string())
+                offset = r.u64()
+                os.pwrite(fd, r.string(), offset)
+                self.send_status(requestId, SSH_FX_OK)
+            elif packetType in [SSH_FXP_LSTAT, SSH_FXP_STAT, SSH_FXP_FSTAT]:
+                if packetType == SSH_FXP_FSTAT:
+                    st = os.fstat(self.get_fd(r.string()))
+                elif packetType == SSH_FXP_LSTAT:
+                    st = os.lstat(r.path())
+                else:
+                    st = os.stat(r.path())
+                self.send(
+                    SSH_FXP_ATTRS,
+                    struct.pack(">I", requestId) + encode_attrs(st)
+                )
+            elif packetType == SSH_FXP_SETSTAT:
+                path = r.path()
+                self.set_attrs(path, r.attrs())
+                self.send_status(requestId, SSH_FX_OK)
+            elif packetType == SSH_FXP_FSETSTAT:
+                fd = self.get_fd(r.string())
+                self.set_attrs(fd, r.attrs())
+                self.send_status(requestId, SSH_FX_OK)
+            elif packetType == SSH_FXP_OPENDIR:
+                path = r.path()
+                names = [".", ".."] + sorted(os.listdir(path))
+                self.send(
+                    SSH_FXP_HANDLE,
+                    struct.pack(">I", requestId) + string(self.add_handle(["dir", path, names]))
+                )
+            elif packetType == SSH_FXP_READDIR:
+                self.read_dir(requestId, self.handles[r.string()])
+            elif packetType == SSH_FXP_REMOVE:
+                os.remove(r.path())
+                self.send_status(requestId, SSH_FX_OK)
+            elif packetType == SSH_FXP_MKDIR:
+                path = r.path()
+                attrs = r.attrs()
+                os.mkdir(path, attrs.get("permissions", 0o777) & 0o7777)
+                self.send_status(requestId, SSH_FX_OK)
+            elif packetType == SSH_FXP_RMDIR:
+                os.rmdir(r.path())
+                self.send_status(requestId, SSH_FX_OK)
+            elif packetType == SSH_FXP_REALPATH:
+                path = os.path.realpath(r.path() or ".")
+                self.send_names(
+                    requestId,
+                    [(path, path, struct.pack(">I", 0))]
+                )
+            elif packetType == SSH_FXP_RENAME:
+                old = r.path()
+                new = r.path()
+                if os.path.exists(new):
+                    return self.send_status(requestId, SSH_FX_FAILURE, "File exists")
+                os.rename(old, new)
+                self.send_status(requestId, SSH_FX_OK)
+            elif packetType == SSH_FXP_READLINK:
+                target = os.readlink(r.path())
+                self.send_names(
+                    requestId,
+                    [(target, target, struct.pack(">I", 0))]
+                )
+            else:
+                self.send_status(requestId, SSH_FX_OP_UNSUPPORTED, "Unsupported")
+        except (IOError, OSError) as e:
+            self.send_status(requestId, error_code(e), e.strerror or str(e))
+        except KeyError:
+            self.send_status(requestId, SSH_FX_FAILURE, "Invalid handle")
+
+    def add_handle(self, handle):
+        self.nextHandle += 1
+        key = str(self.nextHandle).encode("utf-8")
+        self.handles[key] = handle
+        return key
+
+    def get_fd(self, key):
+        handle = self.handles[key]
+        if handle[0] != "file":
+            raise KeyError(key)
+        return handle[1]
+
+    def open_file(self, requestId, path, pflags, attrs):
+        if pflags & SSH_FXF_READ and pflags & SSH_FXF_WRITE:
+            flags = os.O_RDWR
+        elif pflags & SSH_FXF_WRITE:
+            flags = os.O_WRONLY
+        else:
+            flags = os.O_RDONLY
+        if pflags & SSH_FXF_APPEND:
+            flags |= os.O_APPEND
+        if pflags & SSH_FXF_CREAT:
+            flags |= os.O_CREAT
+        if pflags & SSH_FXF_TRUNC:
+            flags |= os.O_TRUNC
+        if pflags & SSH_FXF_EXCL:
+            flags |= os.O_EXCL
+        fd = os.open(
+            path.decode("utf-8", "surrogateescape"),
+            flags,
+            attrs.get("permissions", 0o666) & 0o7777
+        )
+        self.send(
+            SSH_FXP_HANDLE,
+            struct.pack(">I", requestId) + string(self.add_handle(["file", fd]))
+        )
+
+    def read_dir(self, requestId, handle):
+        if handle[0] != "dir":
+            raise KeyError(handle)
+        if not handle[2]:
+            return self.send_status(requestId, SSH_FX_EOF, "EOF")
+        (batch, handle[2]) = (handle[2][0:100], handle[2][100:])
+        names = []
+        for name in batch:
+            try:
+                st = os.lstat(os.path.join(handle[1], name))
+            except OSError:
+                continue
+            names.append((name, self.long_name(name, st), encode_attrs(st)))
+        self.send_names(requestId, names)
+
+    def long_name(self, name, st):
+        # As ls -l, which is what sftp shows for ls -l
+        if st.st_uid not in self.users:
+            try:
+                self.users[st.st_uid] = pwd.getpwuid(st.st_uid).pw_name
+            except KeyError:
+                self.users[st.st_uid] = str(st.st_uid)
+        if st.st_gid not in self.groups:
+            try:
+                self.groups[st.st_gid] = grp.getgrgid(st.st_gid).gr_name
+            except KeyError:
+                self.groups[st.st_gid] = str(st.st_gid)
+        if abs(time.time() - st.st_mtime) < 182 * 86400:
+            when = time.strftime("%b %e %H:%M", time.localtime(st.st_mtime))
+        else:
+            when = time.strftime("%b %e  %Y", time.localtime(st.st_mtime))
+        return "%-10s %4d %-8s %-8s %8d %s %s" % (
+            stat.filemode(st.st_mode),
+            st.st_nlink,
+            self.users[st.st_uid],
+            self.groups[st.st_gid],
+            st.st_size,
+            when,
+            name
+        )
+
+    def set_attrs(self, target, attrs):
+        # target is a path or an open fd
+        if "size" in attrs:
+            os.truncate(target, attrs["size"])
+        if "permissions" in attrs:
+            if isinstance(target, int):
+                os.fchmod(target, attrs["permissions"] & 0o7777)
+            else:
+                os.chmod(target, attrs["permissions"] & 0o7777)
+        if "mtime" in attrs:
+            os.utime(target, (attrs["atime"], attrs["mtime"]))
+
+
+class Reader(object):
+
+    data = None
+    pos = 0
+
+    def __init__(self, data):
+        self.data = data
+
+    def u32(self):
+        self.pos += 4
+        return struct.unpack(">I", self.data[self.pos - 4:self.pos])[0]
+
+    def u64(self):
+        self.pos += 8
+        return struct.unpack(">Q", self.data[self.pos - 8:self.pos])[0]
+
+    def string(self):
+        n = self.u32()
+        self.pos += n
+        return self.data[self.pos - n:self.pos]
+
+    def path(self):
+        return self.string().decode("utf-8", "surrogateescape")
+
+    def attrs(self):
+        attrs = {}
+        flags = self.u32()
+        if flags & SSH_FILEXFER_ATTR_SIZE:
+            attrs["size"] = self.u64()
+        if flags & SSH_FILEXFER_ATTR_UIDGID:
+            attrs["uid"] = self.u32()
+            attrs["gid"] = self.u32()
+        if flags & SSH_FILEXFER_ATTR_PERMISSIONS:
+            attrs["permissions"] = self.u32()
+        if flags & SSH_FILEXFER_ATTR_ACMODTIME:
+            attrs["atime"] = self.u32()
+            attrs["mtime"] = self.u32()
+        if flags & SSH_FILEXFER_ATTR_EXTENDED:
+            for i in range(self.u32()):
+                self.string()
+                self.string()
+        return attrs
+
+
+def string(data):
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8", "surrogateescape")
+    return struct.pack(">I", len(data)) + data
+
+
+def encode_attrs(st):
+    return struct.pack(
+        ">IQIIIII",
+        SSH_FILEXFER_ATTR_SIZE | SSH_FILEXFER_ATTR_UIDGID | SSH_FILEXFER_ATTR_PERMISSIONS | SSH_FILEXFER_ATTR_ACMODTIME,
+        st.st_size,
+        st.st_uid,
+        st.st_gid,
+        st.st_mode,
+        int(st.st_atime) & 0xffffffff,
+        int(st.st_mtime) & 0xffffffff
+    )
+
+
+def error_code(e):
+    if isinstance(e, FileNotFoundError):
+        return SSH_FX_NO_SUCH_FILE
+    if isinstance(e, PermissionError):
+        return SSH_FX_PERMISSION_DENIED
+    return SSH_FX_FAILURE
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "ssh":
+        return run_ssh(argv[2:])
+    if len(argv) > 1 and argv[1] == "sftp-server":
+        SftpServer(sys.stdin.buffer, sys.stdout.buffer).serve()
+        return 0
+    sys.stderr.write("usage: fakessh.py ssh [options] host [command] | sftp-server\n")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
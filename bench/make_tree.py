@@ -0,0 +1,100 @@
+# coding=utf-8
+import os
+import sys
+import json
+import random
+import shutil
+
+
+# Builds the synthetic trees run_bench.py lists, greps and catalogues. The
+# same files and seed always give the same tree (names, sizes, contents and
+# modified times) so that runs can be compared. Trees are kept and reused,
+# a 1M file tree takes a while to write and around 4GB of disk.
+#
+# Folders hold filesPerFolder files each and hang off each other fanOut to
+# a parent, so a tree of n files is roughly log(n / filesPerFolder, fanOut)
+# deep. About one file in needleEvery contains NEEDLE for grep to find.
+
+VERSION = 1
+NEEDLE = "RE_BENCH_NEEDLE"
+WORDS = [
+    "alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf",
+    "hotel", "india", "juliet", "kilo", "lima", "mike", "november",
+    "oscar", "papa", "quebec", "romeo", "sierra", "tango", "uniform",
+    "victor", "whiskey", "xray", "yankee", "zulu"
+]
+EXTENSIONS = ["py", "js", "php", "css", "html", "txt", "md", "json", "log"]
+# Modified times start here (2020-01-01) and step on a minute a file
+EPOCH = 1577836800
+
+
+def make_tree(root, files, seed=1, filesPerFolder=40, fanOut=6, needleEvery=100, quiet=False):
+    # Returns root, only writing the tree if what's there isn't the one
+    # asked for
+    manifestPath = root.rstrip("/") + ".json"
+    manifest = {
+        "version": VERSION,
+        "files": files,
+        "seed": seed,
+        "files_per_folder": filesPerFolder,
+        "fan_out": fanOut,
+        "needle_every": needleEvery
+    }
+    try:
+        with open(manifestPath) as f:
+            if json.load(f) == manifest and os.path.isdir(root):
+                return root
+    except (IOError, OSError, ValueError):
+        pass
+    if os.path.exists(manifestPath):
+        os.remove(manifestPath)
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    rand = random.Random(seed)
+    folders = [root]
+    for i in range(1, max(1, (files + filesPerFolder - 1) // filesPerFolder)):
+        parent = folders[(i - 1) // fanOut]
+        folders.append(os.path.join(parent, "%s%04d" % (rand.choice(WORDS), i)))
+    for folder in folders:
+        os.makedirs(folder)
+    modified = EPOCH
+    for n in range(files):
+        folder = folders[n // filesPerFolder]
+        name = "%s_%s%06d.%s" % (
+            rand.choice(WORDS),
+            rand.choice(WORDS),
+            n,
+            rand.choice(EXTENSIONS)
+        )
+        if rand.random() < 0.05:
+            name = "." + name
+        lines = [
+            " ".join([rand.choice(WORDS) for w in range(rand.randint(2, 12))])
+            for l in range(rand.randint(0, 24))
+        ]
+        if n % needleEvery == 0:
+            lines.insert(rand.randint(0, len(lines)), "found %s here" % NEEDLE)
+        path = os.path.join(folder, name)
+        with open(path, "w") as f:
+            f.write("\n".join(lines))
+        modified += 60
+        os.utime(path, (modified, modified))
+        if not quiet and n and n % 50000 == 0:
+            sys.stderr.write("  %s files written\n" % n)
+    # Deepest first as adding to a folder touches it
+    for folder in reversed(folders):
+        os.utime(folder, (EPOCH, EPOCH))
+    with open(manifestPath, "w") as f:
+        json.dump(manifest, f)
+    return root
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: make_tree.py ROOT FILES [SEED]\n")
+        sys.exit(2)
+    make_tree(
+        os.path.abspath(sys.argv[1]),
+        int(sys.argv[2]),
+        int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    )
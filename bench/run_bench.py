@@ -0,0 +1,490 @@
+# coding=utf-8
+import argparse
+import getpass
+import importlib
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+# Our stand-in sublime / sublime_plugin first, then the folder holding the
+# package so that RemoteEdit.py's relative imports work
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(1, os.path.dirname(REPO_DIR))
+
+import sublime  # noqa: E402
+import make_tree  # noqa: E402
+
+
+# End to end benchmarks for RemoteEdit against a local stand-in server (see
+# fakessh.py), run outside of Sublime Text on a POSIX machine:
+#
+#   python3 bench/run_bench.py --sizes 1k,10k --latency 20 --bandwidth 5000000
+#
+# Each benchmark drives RemoteEditCommand / RemoteEditConnector the way the
+# plugin does, callbacks and all, for every tree size given:
+#
+#   connect_*   first command to a fresh connector, so connect included
+#   list_*      list the top of the tree and parse it into the catalogue
+#   open_*      download (sftp get) a transfer_size file
+#   save_*      upload (sftp put) one
+#   grep        handle_grep for make_tree.NEEDLE from the top of the tree,
+#               through to the results being downloaded
+#   catalogue   cat_server from nothing to the catalogue being loaded
+#   refresh     refresh_cat of the catalogue with a few files modified
+#   fuzzy       build the fuzzy file list from the catalogue
+#
+# where * is ssh, sftp (the sftp binary, needs a real sftp client) or sftpv3
+# (the protocol worker). Every benchmark runs --repeats times after a warm
+# up and the median is what counts.
+#
+# Results go to bench_output.txt as JSON. Pass an earlier one as --baseline
+# to see what changed, anything slower by more than --threshold (and
+# --floor ms) is a regression and we exit with 1. Only compare runs made
+# with the same conditions on the same machine.
+
+BENCHMARKS = [
+    "connect_ssh",
+    "connect_sftp",
+    "connect_sftpv3",
+    "list_ssh",
+    "list_sftp",
+    "list_sftpv3",
+    "open_sftp",
+    "open_sftpv3",
+    "save_sftp",
+    "save_sftpv3",
+    "grep",
+    "catalogue",
+    "refresh",
+    "fuzzy"
+]
+SERVER_NAME = "bench"
+RemoteEdit = None
+
+
+class BenchError(Exception):
+    pass
+
+
+class Bench(object):
+    # One synthetic tree served through fakessh with a RemoteEditCommand
+    # pointed at it
+
+    root = None
+    workDir = None
+    timeout = 600
+    command = None
+    baseSettings = None
+    remoteTmp = None
+    remoteFile = None
+    localFile = None
+
+    def __init__(self, root, workDir, transferSize, timeout=600):
+        self.root = root
+        self.workDir = workDir
+        self.timeout = timeout
+        self.remoteTmp = os.path.join(workDir, "remote_tmp")
+        os.makedirs(self.remoteTmp)
+        os.makedirs(os.path.join(workDir, "local"))
+        # Random so that compression can't flatter it
+        rand = random.Random(transferSize)
+        data = bytes(bytearray(rand.getrandbits(8) for i in range(transferSize)))
+        self.remoteFile = os.path.join(workDir, "transfer.bin")
+        self.localFile = os.path.join(workDir, "local", "transfer.bin")
+        for path in [self.remoteFile, self.localFile]:
+            with open(path, "wb") as f:
+                f.write(data)
+        self.baseSettings = {
+            "host": "localhost",
+            "user": getpass.getuser(),
+            "port": "22",
+            "remote_path": root,
+            "cat_path": root,
+            "enable_cat": True,
+            "compression": False,
+            "cipher": None
+        }
+        settings = sublime.load_settings("RemoteEdit.sublime-settings")
+        settings.set("%s:shell" % SERVER_NAME, "/bin/bash")
+        settings.set("%s:os" % SERVER_NAME, "linux")
+        settings.set("%s:ls_version" % SERVER_NAME, "GNU")
+        settings.set("%s:grep_version" % SERVER_NAME, "3.0")
+        self.command = RemoteEdit.RemoteEditCommand(sublime.active_window())
+        self.command.serverName = SERVER_NAME
+        self.command.tempPath = self.remoteTmp
+        self.command.lastDir = root
+        self.use()
+        try:
+            os.makedirs(self.command.get_cat_path())
+        except OSError:
+            pass
+
+    def use(self, **overrides):
+        settings = dict(self.baseSettings)
+        settings.update(overrides)
+        self.command.server = {"settings": settings}
+        self.command.servers = {SERVER_NAME: self.command.server}
+
+    def reset(self):
+        # Drop every connection
+        if self.command.connector:
+            for pool in list(self.command.connector.pools.values()):
+                pool.stop()
+        sublime.clear_timeouts()
+        self.command.connector = RemoteEdit.RemoteEditConnector(
+            sublime.active_window(),
+            "threads",
+            4,
+            60,
+            600,
+            False,
+            0
+        )
+        self.command.connector.timeout = self.timeout
+
+    def stop(self):
+        if self.command.connector:
+            for pool in list(self.command.connector.pools.values()):
+                pool.stop()
+            self.command.connector = None
+
+    def wait(self, done, what):
+        if not sublime.run_until(done, self.timeout):
+            raise BenchError("Timed out waiting for %s" % what)
+        if sublime.errors:
+            raise BenchError(sublime.errors.pop())
+
+    def call(self, method, *args, **kwargs):
+        # Run a RemoteEditCommand run_*_command / do_* method that takes a
+        # callback and wait for it
+        box = []
+        method(*args, callback=lambda results, cP=None: box.append(results), **kwargs)
+        self.wait(lambda: box, args[0])
+        if not box[0]["success"]:
+            raise BenchError("%s failed: %s" % (args[0], box[0].get("err")))
+        return box[0]
+
+    def sftp_settings(self, appType):
+        return {
+            "sftp_only": appType != "ssh",
+            "sftp_protocol": appType == "sftpv3"
+        }
+
+    def connect(self, appType):
+        self.use(**self.sftp_settings(appType))
+        self.reset()
+        startAt = time.time()
+        if appType == "ssh":
+            self.call(self.command.run_ssh_command, ":")
+        else:
+            self.call(self.command.run_sftp_command, "")
+        return (time.time() - startAt, None)
+
+    def list(self, appType):
+        path = self.root + "/"
+        self.command.cat = {}
+        startAt = time.time()
+        results = self.call(self.command.do_ls, path, cP={})
+        self.command.add_listing_to_cat(results, path, appType != "ssh")
+        elapsed = time.time() - startAt
+        listed = self.command.get_file_from_cat(path) or {}
+        return (elapsed, {"entries": len(list(filter(self.command.remove_stats, listed)))})
+
+    def open(self, appType):
+        localPath = os.path.join(self.workDir, "local", "opened.bin")
+        if os.path.exists(localPath):
+            os.remove(localPath)
+        startAt = time.time()
+        self.call(self.command.run_sftp_command, "get %s %s" % (
+            self.command.escape_remote_path(self.remoteFile),
+            self.command.escape_remote_path(localPath)
+        ))
+        elapsed = time.time() - startAt
+        if os.path.getsize(localPath) != os.path.getsize(self.remoteFile):
+            raise BenchError("Downloaded file is the wrong size")
+        return (elapsed, {"bytes": os.path.getsize(localPath)})
+
+    def save(self, appType):
+        remotePath = os.path.join(self.remoteTmp, "saved.bin")
+        startAt = time.time()
+        self.call(self.command.run_sftp_command, "put %s %s" % (
+            self.command.escape_remote_path(self.localFile),
+            self.command.escape_remote_path(remotePath)
+        ))
+        elapsed = time.time() - startAt
+        if os.path.getsize(remotePath) != os.path.getsize(self.localFile):
+            raise BenchError("Uploaded file is the wrong size")
+        return (elapsed, {"bytes": os.path.getsize(remotePath)})
+
+    def grep(self, appType):
+        window = sublime.active_window()
+        del window.commands[:]
+        self.command.lastDir = self.root
+        startAt = time.time()
+        self.command.handle_grep(make_tree.NEEDLE)
+        self.wait(
+            lambda: [c for c in window.commands if c[0] == "remote_edit_display_search"],
+            "grep"
+        )
+        elapsed = time.time() - startAt
+        args = [c for c in window.commands if c[0] == "remote_edit_display_search"][0][1]
+        with open(args["filePath"], encoding="utf-8", errors="ignore") as f:
+            matches = len([l for l in f if make_tree.NEEDLE in l])
+        os.remove(args["filePath"])
+        return (elapsed, {"matches": matches})
+
+    def catalogue(self, appType):
+        self.command.cat = {}
+        startAt = time.time()
+        self.command.cat_server()
+        self.wait(
+            lambda: "loaded" in self.command.cat.get("/CAT_DATA/", {}),
+            "the catalogue"
+        )
+        return (time.time() - startAt, None)
+
+    def refresh(self, appType):
+        if "loaded" not in self.command.cat.get("/CAT_DATA/", {}):
+            self.catalogue(appType)
+        # The first file in each of the first few folders, their times are
+        # put back after so that the tree stays the same
+        touched = []
+        for (folder, folders, files) in os.walk(self.root):
+            folders.sort()
+            if files:
+                path = os.path.join(folder, sorted(files)[0])
+                st = os.stat(path)
+                touched.append((path, st.st_atime, st.st_mtime))
+            if len(touched) == 10:
+                break
+        catData = self.command.cat["/CAT_DATA/"]
+        since = catData["refreshed"] = int(time.time()) - 60
+        try:
+            for (path, atime, mtime) in touched:
+                os.utime(path, None)
+            startAt = time.time()
+            self.command.refresh_cat()
+            self.wait(
+                lambda: self.command.cat["/CAT_DATA/"]["refreshed"] != since,
+                "the catalogue refresh"
+            )
+            elapsed = time.time() - startAt
+        finally:
+            for (path, atime, mtime) in touched:
+                os.utime(path, (atime, mtime))
+        return (elapsed, {"touched": len(touched)})
+
+    def fuzzy(self, appType):
+        if "loaded" not in self.command.cat.get("/CAT_DATA/", {}):
+            self.catalogue(appType)
+        self.command.items = []
+        startAt = time.time()
+        self.command.append_files_from_path(
+            self.command.get_file_from_cat(self.root),
+            self.root
+        )
+        return (time.time() - startAt, {"items": len(self.command.items)})
+
+    def run(self, name, repeats):
+        # Returns the timings in ms, with anything else the benchmark
+        # reported about its last run
+        (method, appType) = (name.split("_") + ["ssh"])[0:2]
+        self.use(**self.sftp_settings(appType))
+        if method != "connect":
+            # Connect, and warm any caches, outside the timings
+            self.reset()
+            getattr(self, method)(appType)
+        runs = []
+        for i in range(repeats):
+            (elapsed, meta) = getattr(self, method)(appType)
+            runs.append(elapsed * 1000)
+        result = {
+            "median": median(runs),
+            "min": min(runs),
+            "max": max(runs),
+            "runs": runs
+        }
+        result.update(meta or {})
+        return result
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def parse_size(size):
+    size = size.strip().lower()
+    for (suffix, scale) in [("k", 1000), ("m", 1000000)]:
+        if size.endswith(suffix):
+            return int(float(size[0:-1]) * scale)
+    return int(size)
+
+
+def load_remote_edit(binDir, verbose=False):
+    package = os.path.basename(REPO_DIR)
+    module = importlib.import_module("%s.RemoteEdit" % package)
+    worker = importlib.import_module(
+        "%s.remote_edit.RemoteEditConnectionWorker" % package
+    )
+    # get_bin_path, where the worker finds ssh / sftp
+    worker.RemoteEditConnectionBase.binPath = binDir
+    importlib.import_module("%s.remote_edit.RemoteEditLog" % package).log.configure(
+        "debug" if verbose else "error"
+    )
+    return module
+
+
+def make_bin(binDir):
+    # ssh is always fakessh. sftp is the real client (if there is one) using
+    # fakessh to reach the server. Returns False if there's no sftp.
+    sftp = shutil.which("sftp")
+    scripts = {
+        "ssh": "exec %s %s ssh \"$@\"" % (
+            shlex.quote(sys.executable),
+            shlex.quote(os.path.join(BENCH_DIR, "fakessh.py"))
+        )
+    }
+    if sftp:
+        scripts["sftp"] = "exec %s -S %s \"$@\"" % (
+            shlex.quote(sftp),
+            shlex.quote(os.path.join(binDir, "ssh"))
+        )
+    for (name, script) in scripts.items():
+        path = os.path.join(binDir, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n%s\n" % script)
+        os.chmod(path, 0o755)
+    return bool(sftp)
+
+
+def compare(output, baseline, threshold, floor):
+    # Prints each result against the baseline, returns the regressions
+    if baseline["conditions"] != output["conditions"]:
+        print("Warning: the baseline was run under different conditions %s" % json.dumps(baseline["conditions"], sort_keys=True))
+    regressions = []
+    print("%-8s %-16s %10s %10s %8s" % ("files", "benchmark", "ms", "was", "change"))
+    for size in sorted(output["results"], key=int):
+        for name in BENCHMARKS:
+            result = output["results"][size].get(name)
+            if not result or "median" not in result:
+                continue
+            was = baseline["results"].get(size, {}).get(name, {}).get("median")
+            if was is None:
+                print("%-8s %-16s %10.1f %10s %8s" % (size, name, result["median"], "-", "new"))
+                continue
+            change = (result["median"] - was) / max(was, 0.001)
+            flag = ""
+            if change > threshold and result["median"] - was > floor:
+                flag = " REGRESSION"
+                regressions.append((size, name))
+            print("%-8s %-16s %10.1f %10.1f %+7.0f%%%s" % (
+                size,
+                name,
+                result["median"],
+                was,
+                change * 100,
+                flag
+            ))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="RemoteEdit end to end benchmarks")
+    parser.add_argument("--sizes", default="1k,10k", help="tree sizes in files, e.g. 1k,10k,100k,1m")
+    parser.add_argument("--only", default=None, help="comma separated benchmarks to run")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0, help="round trip in ms")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes a second each way, 0 for no limit")
+    parser.add_argument("--connect", type=float, default=None, help="connect time in ms, 3 round trips if not given")
+    parser.add_argument("--transfer-size", type=int, default=1048576, help="bytes opened / saved")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trees", default=os.path.join(tempfile.gettempdir(), "re_bench_trees"), help="where to keep the synthetic trees")
+    parser.add_argument("--timeout", type=int, default=600, help="seconds to give any one step")
+    parser.add_argument("--output", default=os.path.join(REPO_DIR, "bench_output.txt"))
+    parser.add_argument("--baseline", default=None, help="an earlier output to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slow down that counts as a regression")
+    parser.add_argument("--floor", type=float, default=5, help="ignore differences under this many ms")
+    parser.add_argument("--verbose", action="store_true", help="show RemoteEdit's debug output")
+    args = parser.parse_args(argv)
+    if os.name != "posix":
+        sys.stderr.write("The benchmarks need a POSIX shell and python's os.pread\n")
+        return 2
+    global RemoteEdit
+    benchmarks = args.only.split(",") if args.only else BENCHMARKS
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark %s, pick from %s" % (name, ", ".join(BENCHMARKS)))
+    connect = args.connect if args.connect is not None else args.latency * 3
+    os.environ["RE_BENCH_LATENCY"] = str(args.latency)
+    os.environ["RE_BENCH_BANDWIDTH"] = str(args.bandwidth)
+    os.environ["RE_BENCH_CONNECT"] = str(connect)
+    binDir = tempfile.mkdtemp(prefix="re_bench_bin_")
+    if not make_bin(binDir):
+        sys.stderr.write("No sftp client found, skipping the sftp benchmarks\n")
+        benchmarks = [b for b in benchmarks if not b.endswith("_sftp")]
+    RemoteEdit = load_remote_edit(binDir, args.verbose)
+    output = {
+        "generated": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "conditions": {
+            "latency_ms": args.latency,
+            "bandwidth": args.bandwidth,
+            "connect_ms": connect,
+            "transfer_size": args.transfer_size,
+            "repeats": args.repeats,
+            "seed": args.seed
+        },
+        "results": {}
+    }
+    try:
+        for size in [parse_size(s) for s in args.sizes.split(",")]:
+            root = os.path.join(args.trees, "tree_%s_%s" % (size, args.seed))
+            sys.stderr.write("Tree of %s files at %s\n" % (size, root))
+            make_tree.make_tree(root, size, args.seed)
+            os.environ["RE_BENCH_ROOT"] = root
+            workDir = tempfile.mkdtemp(prefix="re_bench_work_")
+            bench = Bench(root, workDir, args.transfer_size, args.timeout)
+            results = output["results"][str(size)] = {}
+            try:
+                for name in benchmarks:
+                    sys.stderr.write("  %s... " % name)
+                    sys.stderr.flush()
+                    try:
+                        results[name] = bench.run(name, args.repeats)
+                        sys.stderr.write("%.1fms\n" % results[name]["median"])
+                    except BenchError as e:
+                        results[name] = {"error": str(e)}
+                        sys.stderr.write("failed: %s\n" % e)
+            finally:
+                bench.stop()
+                shutil.rmtree(workDir, ignore_errors=True)
+    finally:
+        shutil.rmtree(binDir, ignore_errors=True)
+        if sublime.packagesPath:
+            shutil.rmtree(sublime.packagesPath, ignore_errors=True)
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=4, sort_keys=True)
+    sys.stderr.write("Results written to %s\n" % args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(output, baseline, args.threshold, args.floor):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
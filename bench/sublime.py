@@ -0,0 +1,212 @@
+# coding=utf-8
+import heapq
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+# Just enough of Sublime Text's API to load RemoteEdit.py outside of the
+# editor, for run_bench.py only. set_timeout callbacks are queued until
+# run_until runs them on the calling thread, which stands in for the main
+# thread. Settings are kept in memory, packages_path is a temp folder and
+# messages / dialogs are recorded rather than shown.
+
+timers = []
+counter = itertools.count()
+cond = threading.Condition()
+settings = {}
+messages = []
+errors = []
+packagesPath = None
+window = None
+
+
+def platform():
+    if sys.platform.startswith("win"):
+        return "windows"
+    if sys.platform == "darwin":
+        return "osx"
+    return "linux"
+
+
+def set_timeout(callback, delay=0):
+    with cond:
+        heapq.heappush(
+            timers,
+            (time.time() + delay / 1000.0, next(counter), callback)
+        )
+        cond.notify()
+
+
+def run_until(done, timeout=60):
+    # Run timers as they fall due until done() is true, False if it isn't
+    # within timeout seconds
+    giveUpAt = time.time() + timeout
+    while True:
+        if done():
+            return True
+        now = time.time()
+        if now >= giveUpAt:
+            return False
+        with cond:
+            if timers and timers[0][0] <= now:
+                callback = heapq.heappop(timers)[2]
+            else:
+                callback = None
+                nextAt = timers[0][0] if timers else giveUpAt
+                # Short waits so that done() is checked when workers finish
+                cond.wait(max(0, min(nextAt, giveUpAt, now + 0.005) - now))
+        if callback:
+            callback()
+
+
+def clear_timeouts():
+    with cond:
+        del timers[:]
+
+
+def status_message(msg):
+    messages.append(msg)
+
+
+def error_message(msg):
+    errors.append(msg)
+
+
+def message_dialog(msg):
+    messages.append(msg)
+
+
+def ok_cancel_dialog(msg, ok_title=""):
+    messages.append(msg)
+    return False
+
+
+def packages_path():
+    global packagesPath
+    if not packagesPath:
+        packagesPath = tempfile.mkdtemp(prefix="re_bench_packages_")
+    return packagesPath
+
+
+def load_settings(name):
+    if name not in settings:
+        settings[name] = Settings()
+    return settings[name]
+
+
+def save_settings(name):
+    pass
+
+
+def load_resource(name):
+    with open(os.path.join(packages_path(), name.split("/", 1)[-1])) as f:
+        return f.read()
+
+
+def active_window():
+    global window
+    if not window:
+        window = Window()
+    return window
+
+
+class Settings(object):
+
+    values = None
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def has(self, key):
+        return key in self.values
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+
+class Region(object):
+
+    a = 0
+    b = 0
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+
+class View(object):
+
+    viewIds = itertools.count(1)
+
+    def __init__(self):
+        self.viewId = next(self.viewIds)
+        self.viewSettings = Settings()
+        self.status = {}
+        self.name = None
+
+    def id(self):
+        return self.viewId
+
+    def settings(self):
+        return self.viewSettings
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def set_scratch(self, scratch):
+        pass
+
+    def set_name(self, name):
+        self.name = name
+
+    def file_name(self):
+        return None
+
+    def window(self):
+        return active_window()
+
+
+class Window(object):
+    # Commands run and quick panels shown are recorded in order
+
+    def __init__(self):
+        self.view = View()
+        self.commands = []
+        self.panels = []
+
+    def active_view(self):
+        return self.view
+
+    def views(self):
+        return [self.view]
+
+    def new_file(self):
+        return View()
+
+    def run_command(self, name, args=None):
+        self.commands.append((name, args))
+
+    def show_quick_panel(self, items, on_done, *args, **kwargs):
+        self.panels.append(items)
+
+    def show_input_panel(self, caption, initial, on_done, on_change, on_cancel):
+        self.panels.append([caption])
+
+    def status_message(self, msg):
+        messages.append(msg)
@@ -0,0 +1,20 @@
+# coding=utf-8
+
+
+# The base classes RemoteEdit.py derives from, see sublime.py
+
+
+class WindowCommand(object):
+
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(object):
+
+    def __init__(self, view):
+        self.view = view
+
+
+class EventListener(object):
+    pass
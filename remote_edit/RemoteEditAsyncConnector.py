@@ -0,0 +1,543 @@
+# coding=utf-8
+import asyncio
+import queue
+import threading
+import time
+from .RemoteEditConnectionWorker import RemoteEditConnectionBase, next_read_size
+from .RemoteEditWorkerPool import RemoteEditWorkQueue
+
+
+# An alternative to one RemoteEditConnectionWorker thread (plus two pipe
+# reader threads) per ssh / sftp process. Every process is driven by a
+# coroutine on a single event loop running in one background thread and
+# reads from its pipes are awaited rather than polled.
+#
+# Work dicts and results are exactly the same as for the threaded workers
+# (see RemoteEditConnectionWorker) and results come back through the same
+# futures so RemoteEditConnector doesn't know the difference.
+#
+# Needs Python 3.5+ (Sublime Text 4), only import it if it's been asked for.
+
+
+class RemoteEditAsyncConnector(object):
+    # Work is kept apart by server as it is with RemoteEditConnector's pools,
+    # a session per key (appType, server and a hash of its settings, see
+    # RemoteEditConnector.get_pool_key) with a queue and workers of its own.
+    # Each starts with one worker, tails add another. Sessions stay connected
+    # until they've been unused for evictAfter seconds, never if their server
+    # is in keepWarm.
+    #
+    # Queues are RemoteEditWorkQueues as with the pools, so work is taken in
+    # priority order with the same aging, and with reserveInteractive each
+    # session keeps a worker back for interactive work. Idle workers ping
+    # their connection every keepAlive seconds as the pools' do.
+
+    loop = None
+    thread = None
+    sessions = None
+    platform = None
+    evictAfter = None
+    keepWarm = None
+    reserveInteractive = False
+    keepAlive = None
+
+    def __init__(self, platform, evictAfter=None, keepWarm=None, reserveInteractive=False, keepAlive=None):
+        self.platform = platform
+        self.evictAfter = evictAfter
+        self.reserveInteractive = reserveInteractive
+        self.keepAlive = keepAlive
+        self.keepWarm = keepWarm if keepWarm is not None else []
+        self.sessions = {}
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run_loop,
+            args=(ready,)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+
+    def run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        ready.set()
+        self.loop.run_forever()
+
+    def put(self, key, work):
+        self.loop.call_soon_threadsafe(self.put_work, key, work)
+
+    def put_work(self, key, work):
+        self.evict(key)
+        session = self.get_session(key)
+        work["queued_at"] = session.lastUsed = time.time()
+        session.queue.put(work)
+        session.wake.set()
+
+    def get_session(self, key):
+        if key not in self.sessions:
+            self.sessions[key] = RemoteEditAsyncSession(key)
+            if self.reserveInteractive:
+                self.start_worker(key, reserved=True)
+            self.start_worker(key)
+        return self.sessions[key]
+
+    def create_worker(self, key):
+        self.loop.call_soon_threadsafe(self.start_worker, key)
+
+    def start_worker(self, key, reserved=False):
+        session = self.get_session(key)
+        worker = RemoteEditAsyncWorker()
+        worker.reserved = reserved
+        worker.keepAlive = self.keepAlive
+        worker.config(
+            session.nextId,
+            key[0],
+            session.queue,
+            self.platform
+        )
+        session.nextId += 1
+        worker.session = session
+        worker.task = self.loop.create_task(worker.run())
+        session.workers.append(worker)
+
+    def evict(self, keep):
+        now = time.time()
+        for (key, session) in list(self.sessions.items()):
+            if (
+                key != keep and
+                self.evictAfter is not None and
+                key[1] not in self.keepWarm and
+                not session.running and
+                session.queue.empty() and
+                now - session.lastUsed > self.evictAfter
+            ):
+                self.stop_session(key)
+
+    def stop_session(self, key):
+        session = self.sessions.pop(key)
+        for worker in session.workers:
+            worker.stop()
+            worker.task.cancel()
+        session.workers = []
+
+    def jobs(self):
+        # As RemoteEditWorkerPool.jobs, called from other threads
+        jobs = []
+        for session in list(self.sessions.values()):
+            jobs.extend(list(session.running) + session.queue.items())
+        return jobs
+
+    def stop_all(self):
+        for key in list(self.sessions):
+            self.stop_session(key)
+        self.loop.stop()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stop_all)
+
+
+class RemoteEditAsyncSession(object):
+    # A server's queue and workers, only changed on the loop's thread. wake
+    # is set as work is queued for workers waiting on it.
+
+    key = None
+    queue = None
+    wake = None
+    workers = None
+    running = None
+    lastUsed = 0
+    nextId = 0
+
+    def __init__(self, key):
+        self.key = key
+        self.queue = RemoteEditWorkQueue()
+        self.wake = asyncio.Event()
+        self.workers = []
+        self.running = []
+        self.lastUsed = time.time()
+
+
+class RemoteEditAsyncWorker(RemoteEditConnectionBase):
+
+    process = None
+    queueIn = None
+    readers = None
+    task = None
+    session = None
+    reserved = False
+    # See get_work
+    keepAlive = None
+    nextPingAt = None
+    keepAliveTimeout = 15
+    interruptTimeout = 5
+    # The ssh sending the interrupt, see interrupt
+    interrupter = None
+
+    async def get_work(self):
+        # The queue's own get would block the loop, wait on the session's
+        # wake instead. Stops on the way to ping the connection whenever
+        # nextPingAt comes round, as RemoteEditWorkerPool.get_work.
+        while True:
+            try:
+                work = self.queue.get(0, interactiveOnly=self.reserved)
+            except queue.Empty:
+                self.session.wake.clear()
+                timeout = None
+                if self.keepAlive:
+                    now = time.time()
+                    if self.nextPingAt is None:
+                        self.nextPingAt = now + self.keepAlive
+                    if now >= self.nextPingAt:
+                        await self.keep_alive()
+                        self.nextPingAt = time.time() + self.keepAlive
+                        continue
+                    timeout = self.nextPingAt - now
+                try:
+                    await asyncio.wait_for(self.session.wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if work is not None:
+                # The work keeps the connection busy, count from when it's done
+                self.nextPingAt = None
+                return work
+
+    async def keep_alive(self):
+        # As RemoteEditConnectionWorker.keep_alive
+        if not self.process or not self.work:
+            return
+        self.debug("Keep alive")
+        self.work = dict(
+            self.work,
+            expire_at=time.time() + self.keepAliveTimeout,
+            future=None,
+            timings=None,
+            stream=None
+        )
+        self.framedErr = False
+        self.discard_output()
+        marker = self.get_marker()
+        if self.write_command(self.frame_command("", marker)) and await self.await_response(marker):
+            return
+        self.info("Keep alive failed, reconnecting")
+        self.close_connection()
+        await self.connect(False)
+
+    async def run(self):
+        try:
+            while not self.quit:
+                self.debug("Start work loop")
+                self.work = await self.get_work()
+                if self.is_cancelled():
+                    self.queue.task_done()
+                    continue
+                if "timeout" in self.work:
+                    self.work["expire_at"] = self.work["timeout"] + time.time()
+                work = self.work
+                work["started_at"] = time.time()
+                self.session.running.append(work)
+                try:
+                    await self.process_work_and_respond()
+                finally:
+                    self.session.running.remove(work)
+                    self.session.lastUsed = time.time()
+                self.queue.task_done()
+                self.debug("End work loop")
+        except asyncio.CancelledError:
+            pass
+        if self in self.session.workers:
+            # A tail's worker, done with once the tail is
+            self.session.workers.remove(self)
+        self.debug("He killed me with a sword. How weird is that?")
+
+    async def process_work_and_respond(self):
+        self.stamp("dequeued")
+        # If we're connected to a different server then disconnect
+        if self.server_changed():
+            self.close_connection()
+        success = await self.run_command(
+            self.work["cmd"],
+            self.work["prompt_contains"],
+            self.work["accept_new_host"],
+            self.work["queue"]
+        )
+        self.respond(success)
+
+    def stop(self):
+        self.quit = True
+        self.close_connection()
+        self.debug("Worker %s has left the building.", self.threadId)
+
+    async def run_command(self, cmd, checkReturn=None, acceptNew=False, q=None):
+        self.hostUnknown = False
+        self.exitStatus = None
+        self.framedErr = False
+        self.batchResults = None
+        self.serverName = self.work["server_name"]
+        self.attempt = 0
+        if q:
+            if not await self.reconnect(acceptNew):
+                return False
+            self.discard_output()
+            if cmd and not self.write_command(cmd):
+                self.debug("Error writing")
+                return False
+            return await self.read_forever(q)
+        # Same back off and replay as the threaded worker
+        while True:
+            if not await self.reconnect(acceptNew):
+                return False
+            self.lostConnection = 0
+            self.discard_output()
+            # Everything goes in one write, a batch costs a single round trip
+            (framed, markers) = self.frame_commands(cmd)
+            if self.write_command(framed):
+                found = await self.await_response(markers[-1])
+                if found or not self.lostConnection or not self.is_idempotent(cmd):
+                    break
+                self.debug("Lost connection")
+            else:
+                self.debug("Error writing")
+                found = False
+            delay = self.retry_delay()
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        if not found:
+            self.debug("End marker not found")
+            self.close_connection()
+            return False
+        self.split_response(markers)
+        if checkReturn is not None and checkReturn not in self.lastOut:
+            self.debug("Expected return data not found")
+            return False
+        return True
+
+    async def reconnect(self, acceptNew):
+        while not await self.connect(acceptNew):
+            delay = None if self.hostUnknown else self.retry_delay()
+            if delay is None:
+                self.debug("Error connecting")
+                return False
+            await asyncio.sleep(delay)
+        self.stamp("connected")
+        return True
+
+    async def connect(self, acceptNew):
+        if self.process and self.process.returncode is None:
+            self.debug(":o) Process alive and well")
+            return True
+        await self.create_process(acceptNew)
+        if acceptNew and self.platform == "windows":
+            self.write_command("y")
+        # A shell tells us its pid on the way, see interrupt
+        marker = self.get_marker()
+        self.write_command(
+            self.frame_command("echo $$" if self.appType == "ssh" else "", marker)
+        )
+        found = await self.await_response(marker, stopOn=["Password:"])
+        if not found and "Password:" in self.lastOut and self.get_server_setting("password", None):
+            self.write_command(self.get_server_setting("password"), mask=True)
+            found = await self.await_response(marker)
+        if not found:
+            if "host key is not cached" in self.lastErr:
+                self.hostUnknown = True
+            self.warning("Connect failed: %s", self.lastErr)
+            self.close_connection()
+            return False
+        if self.appType == "ssh":
+            pid = self.cut_response(self.lastOut, "", marker)[0].strip()
+            self.shellPid = pid if pid.isdigit() else None
+        self.debug("Connection OK")
+        return True
+
+    def write_command(self, cmd, mask=False):
+        try:
+            self.debug("Sending command: %s", "*" * len(cmd) if mask else cmd)
+            self.process.stdin.write(bytes("%s\n" % (cmd), "utf-8"))
+            return True
+        except Exception as e:
+            self.debug("Command failed: %s", e)
+            return False
+
+    def discard_output(self):
+        (outB, errB) = self.read_pipes()
+        if outB or errB:
+            self.debug("Discarded output: %s%s", outB, errB)
+            self.reset_decoders()
+
+    def read_pipes(self):
+        out = bytearray()
+        err = bytearray()
+        while self.queueIn and not self.queueIn.empty():
+            (stream, data) = self.queueIn.get_nowait()
+            if stream == "out":
+                out.extend(data)
+            else:
+                err.extend(data)
+        return (out, err)
+
+    async def interrupt(self):
+        # As RemoteEditConnectionWorker.interrupt
+        if not self.shellPid:
+            return False
+        if self.interrupter and self.interrupter.returncode == 255:
+            self.warning("Interrupt failed, ssh couldn't connect")
+            return False
+        self.debug("Interrupting children of %s", self.shellPid)
+        try:
+            self.interrupter = await asyncio.create_subprocess_exec(
+                *(self.get_local_command() + ["pkill -INT -P %s" % self.shellPid]),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+                close_fds=False,
+                **self.get_process_kwargs()
+            )
+        except Exception as e:
+            self.warning("Interrupt failed: %s", e)
+            return False
+        return True
+
+    def interrupting(self):
+        return self.interrupter is not None and self.interrupter.returncode is None
+
+    async def stop_interrupting(self):
+        if self.interrupting():
+            try:
+                self.interrupter.kill()
+            except ProcessLookupError:
+                pass
+            await self.interrupter.wait()
+        self.interrupter = None
+
+    async def await_response(self, marker=None, stopOn=None):
+        self.debug("Waiting for output...")
+        self.reset_response()
+        found = False
+        interruptAt = None
+        while True:
+            if marker and self.find_end_marker(marker):
+                self.debug("Found response")
+                found = True
+                break
+            if stopOn and self.response_contains(stopOn):
+                self.debug("Found interactive prompt")
+                break
+            if self.is_cancelled() and self.shellPid and not self.interrupting() and (interruptAt is None or time.time() > interruptAt):
+                # As RemoteEditConnectionWorker.await_response, interrupt
+                # until the end marker turns up and the connection is kept
+                if interruptAt is None:
+                    self.work["expire_at"] = min(
+                        self.work["expire_at"],
+                        time.time() + self.interruptTimeout
+                    )
+                if not await self.interrupt():
+                    self.debug("Cancelled")
+                    break
+                interruptAt = time.time() + 1
+            remaining = self.work["expire_at"] - time.time()
+            if remaining <= 0:
+                self.warning("Connection timed out")
+                break
+            try:
+                (stream, data) = await asyncio.wait_for(
+                    self.queueIn.get(),
+                    min(remaining, 1)
+                )
+            except asyncio.TimeoutError:
+                data = None
+            if data:
+                self.add_response(stream, data)
+            elif self.process.returncode is not None or not [r for r in self.readers if not r.done()]:
+                # Both pipes are closed, wait for the process to be reaped
+                await self.process.wait()
+                (outB, errB) = self.read_pipes()
+                self.add_response("out", outB)
+                self.add_response("err", errB)
+                self.debug("Process died")
+                self.lostConnection += 1
+                found = bool(marker and self.find_end_marker(marker))
+                break
+        await self.stop_interrupting()
+        self.decode_response()
+        self.log_response()
+        return found
+
+    async def read_forever(self, q):
+        keepAliveAt = time.time() + 60
+        while True:
+            # Send a keep alive every minute
+            if time.time() > keepAliveAt:
+                self.process.stdin.write(bytes(" ", "utf-8"))
+                keepAliveAt = time.time() + 60
+            try:
+                (stream, data) = await asyncio.wait_for(self.queueIn.get(), 0.4)
+            except asyncio.TimeoutError:
+                (stream, data) = ("out", b"")
+            if stream == "err":
+                data = b""
+            data = self.decoders["out"].decode(data)
+            if data:
+                q.put(data)
+            self.update_command(q)
+            if self.is_cancelled():
+                self.close_connection()
+                self.quit = True
+                return True
+            if self.process.returncode is not None:
+                self.debug("Process died, starting again")
+                if hasattr(q, "restart_command"):
+                    self.work["cmd"] = q.restart_command()
+                return await self.run_command(
+                    self.work["cmd"],
+                    self.work["prompt_contains"],
+                    self.work["accept_new_host"],
+                    self.work["queue"]
+                )
+
+    def update_command(self, q):
+        if not hasattr(q, "next_command"):
+            return
+        cmd = q.next_command()
+        if cmd:
+            self.write_command(cmd)
+
+    def close_connection(self):
+        self.shellPid = None
+        try:
+            self.process.terminate()
+        except:
+            pass
+        self.process = None
+        for r in self.readers or []:
+            r.cancel()
+        self.readers = None
+
+    async def create_process(self, acceptNew=False):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.get_local_command(acceptNew),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            close_fds=False,
+            **self.get_process_kwargs()
+        )
+        # Reader tasks rather than threads, both feed the one queue
+        self.queueIn = asyncio.Queue()
+        self.reset_decoders()
+        self.readers = [
+            asyncio.ensure_future(enqueue_output(self.process.stdout, self.queueIn, "out")),
+            asyncio.ensure_future(enqueue_output(self.process.stderr, self.queueIn, "err"))
+        ]
+        return self.process
+
+
+async def enqueue_output(out, q, stream):
+    size = 1024
+    while True:
+        data = await out.read(size)
+        q.put_nowait((stream, data))
+        if not len(data):
+            break
+        size = next_read_size(size, len(data))
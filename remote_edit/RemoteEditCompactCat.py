@@ -0,0 +1,485 @@
+# coding=utf-8
+import array
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections.abc import MutableMapping
+
+
+# The catalogue (see RemoteEditCatStream for its layout) packed into a
+# handful of arrays rather than a dict and a stats list per entry, which
+# for big trees is most of the plugin's memory and most of loading it.
+#
+# Entries are numbered breadth first from the root, 0, so that the children
+# of entry i, sorted by name, are first[i] to first[i] + counts[i] - 1 and
+# can be looked up with a binary search. The name of entry i is
+# names[offsets[i]:offsets[i + 1]], its parent is parents[i] (-1 for the
+# root) and its stats are spread over types, modes, users, groups, sizes and
+# mtimes with symlink destinations kept in a dict. flags says if it has
+# stats at all and if it's a folder we've not listed yet (/NO_INDEX/).
+#
+# root() gives a RemoteEditCatNode, which reads like the nested dicts so
+# get_file_from_cat, list_directory etc. work on either. The arrays are
+# never changed, changing a node (a listing merged in, a delete, a rename)
+# thaws it into a real dict of its contents that the node then defers to.
+# build packs the lot, thawed or not, into a new one when it's saved.
+#
+# save writes it to a file that load maps rather than reads, the arrays
+# being views of the mapping. Nothing's read until it's looked at, names
+# are UTF-8 there and only become strings a folder at a time as they're
+# listed, so opening even a big catalogue is a few milliseconds. The file is
+#
+#   HEADER, magic / version / checksum / meta length / file length
+#   meta, JSON: catData, destinations and where and what each array is
+#   names then each of ARRAYS, every one starting on an 8 byte boundary
+#
+# the checksum being the crc32 of the meta, which has one of its own for
+# each array. load raises ValueError for a file that's truncated, has
+# damaged meta or was written by another version / a machine of the other
+# byte order. An array is checked the first time it's used (see
+# RemoteEditCatSection) and raises ValueError then if it's damaged.
+# is_compact_cat says if a file's meant to be one at all.
+
+VERSION = 3
+MAGIC = b"RE_CAT\r\n"
+HEADER = struct.Struct("<8sIIQQ")
+
+# Name and typecode of each array, after names
+ARRAYS = [
+    ("offsets", "I"),
+    ("parents", "i"),
+    ("first", "i"),
+    ("counts", "i"),
+    ("types", "b"),
+    ("modes", "H"),
+    ("users", "i"),
+    ("groups", "i"),
+    ("sizes", "q"),
+    ("mtimes", "q"),
+    ("flags", "b")
+]
+
+# flags
+HAS_STATS = 1
+NO_INDEX = 2
+
+
+def is_compact_cat(path):
+    # Or what's left of one, so that load can say it's truncated
+    with open(path, "rb") as f:
+        return MAGIC.startswith(f.read(len(MAGIC)))
+
+
+class RemoteEditCatSection(object):
+    # One of the arrays of a RemoteEditCompactCat. Those of a loaded one are
+    # left in unchecked until first used, when they're checked against their
+    # checksum and set on the catalogue, which then shadows us.
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, compact, owner):
+        if compact is None:
+            return self
+        (section, typecode, crc) = compact.unchecked[self.name]
+        if zlib.crc32(section) & 0xffffffff != crc:
+            raise ValueError("Checksum mismatch in %s" % self.name)
+        del compact.unchecked[self.name]
+        data = section.cast(typecode) if typecode != "B" else section
+        setattr(compact, self.name, data)
+        return data
+
+
+class RemoteEditCompactCat(object):
+
+    names = RemoteEditCatSection("names")
+    offsets = RemoteEditCatSection("offsets")
+    parents = RemoteEditCatSection("parents")
+    first = RemoteEditCatSection("first")
+    counts = RemoteEditCatSection("counts")
+    types = RemoteEditCatSection("types")
+    modes = RemoteEditCatSection("modes")
+    users = RemoteEditCatSection("users")
+    groups = RemoteEditCatSection("groups")
+    sizes = RemoteEditCatSection("sizes")
+    mtimes = RemoteEditCatSection("mtimes")
+    flags = RemoteEditCatSection("flags")
+    destinations = None
+    catData = None
+    thawed = None
+    # Sections of the file yet to be checked, see RemoteEditCatSection
+    unchecked = None
+    mapped = None
+    view = None
+
+    def __init__(self):
+        self.names = b""
+        self.offsets = array.array("I", [0, 0])
+        self.parents = array.array("i", [-1])
+        self.first = array.array("i")
+        self.counts = array.array("i")
+        self.types = array.array("b")
+        self.modes = array.array("H")
+        self.users = array.array("i")
+        self.groups = array.array("i")
+        self.sizes = array.array("q")
+        self.mtimes = array.array("q")
+        self.flags = array.array("b")
+        self.destinations = {}
+        self.catData = {}
+        self.thawed = {}
+        self.unchecked = {}
+
+    @classmethod
+    def build(cls, cat):
+        # From a nested dict catalogue or a partly thawed compact one
+        compact = cls()
+        compact.catData = cat.get("/CAT_DATA/", {})
+        names = []
+        length = 0
+        nodes = collections.deque([cat])
+        nextIndex = 1
+        index = 0
+        while nodes:
+            node = nodes.popleft()
+            stats = None
+            flags = 0
+            children = []
+            for (k, v) in node.items():
+                if k == "/":
+                    stats = v
+                elif k == "/NO_INDEX/":
+                    flags |= NO_INDEX
+                elif k != "/CAT_DATA/":
+                    children.append((k, v))
+            children.sort(key=lambda c: c[0])
+            compact.first.append(nextIndex)
+            compact.counts.append(len(children))
+            nextIndex += len(children)
+            if stats:
+                flags |= HAS_STATS
+                compact.types.append(stats[0] or 0)
+                compact.modes.append(stats[1] or 0)
+                compact.users.append(stats[2] or 0)
+                compact.groups.append(stats[3] or 0)
+                compact.sizes.append(stats[4] or 0)
+                compact.mtimes.append(stats[5] or 0)
+                if len(stats) > 6:
+                    compact.destinations[index] = stats[6]
+            else:
+                compact.types.append(0)
+                compact.modes.append(0)
+                compact.users.append(0)
+                compact.groups.append(0)
+                compact.sizes.append(0)
+                compact.mtimes.append(0)
+            compact.flags.append(flags)
+            for (name, child) in children:
+                name = name.encode("utf-8", "surrogatepass")
+                names.append(name)
+                length += len(name)
+                compact.offsets.append(length)
+                compact.parents.append(index)
+                nodes.append(child)
+            index += 1
+        compact.names = b"".join(names)
+        return compact
+
+    def save(self, path):
+        # To one side then moved into place, the file we're replacing may be
+        # mapped (by another window say) and mustn't change under it
+        sections = [("names", "B")] + ARRAYS
+        meta = {
+            "byteorder": sys.byteorder,
+            "catData": self.catData,
+            "destinations": list(self.destinations.items()),
+            "sections": []
+        }
+        at = 0
+        for (name, typecode) in sections:
+            data = memoryview(getattr(self, name))
+            crc = zlib.crc32(data) & 0xffffffff
+            meta["sections"].append([name, typecode, at, data.nbytes, crc])
+            at += data.nbytes + -data.nbytes % 8
+        meta = json.dumps(meta).encode("utf-8")
+        meta += b" " * (-(HEADER.size + len(meta)) % 8)
+        tmpPath = "%s.tmp" % path
+        f = open(tmpPath, "wb")
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+            f.write(meta)
+            crc = zlib.crc32(meta)
+            for (name, typecode) in sections:
+                data = memoryview(getattr(self, name))
+                f.write(data)
+                f.write(b"\0" * (-data.nbytes % 8))
+            length = f.tell()
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, crc & 0xffffffff, len(meta), length))
+        finally:
+            f.close()
+        os.replace(tmpPath, path)
+
+    @classmethod
+    def load(cls, path):
+        f = open(path, "rb")
+        try:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise ValueError("Truncated, it's smaller than the header")
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        view = memoryview(mapped)
+        try:
+            meta = cls.check(view)
+        except ValueError:
+            # So that it can be deleted, even on Windows
+            view.release()
+            mapped.close()
+            raise
+        dataAt = HEADER.size + meta["length"]
+        compact = cls()
+        compact.mapped = mapped
+        compact.view = view
+        compact.catData = meta["catData"]
+        compact.destinations = dict(meta["destinations"])
+        for (name, typecode, at, nbytes, crc) in meta["sections"]:
+            section = view[dataAt + at:dataAt + at + nbytes]
+            compact.unchecked[name] = (section, typecode, crc)
+            delattr(compact, name)
+        return compact
+
+    @classmethod
+    def check(cls, view):
+        # The file's meta if it's sound
+        (magic, version, crc, metaLength, length) = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("Not a catalogue")
+        if version != VERSION:
+            raise ValueError("Version %s, not %s" % (version, VERSION))
+        if len(view) != length:
+            raise ValueError("%s bytes long rather than %s" % (len(view), length))
+        # Only the meta, the arrays are checked as they're used
+        metaView = view[HEADER.size:HEADER.size + metaLength]
+        try:
+            if zlib.crc32(metaView) & 0xffffffff != crc:
+                raise ValueError("Checksum mismatch")
+            meta = json.loads(str(metaView, "utf-8"))
+        finally:
+            # Or the mapping couldn't be closed
+            metaView.release()
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError("Written on a %s endian machine" % meta["byteorder"])
+        dataLength = length - HEADER.size - metaLength
+        for (name, typecode, at, nbytes, crc) in meta["sections"]:
+            if at + nbytes > dataLength:
+                raise ValueError("%s runs off the end" % name)
+        meta["length"] = metaLength
+        return meta
+
+    def close(self):
+        # Let go of the file if it's mapped. Nodes already handed out (to a
+        # quick panel say) may outlive it so the arrays are copied to memory
+        # first, to go along with them.
+        if not self.mapped:
+            return
+        for (name, typecode) in [("names", "B")] + ARRAYS:
+            if name in self.unchecked:
+                (section, typecode, crc) = self.unchecked[name]
+                self.unchecked[name] = (memoryview(bytes(section)), typecode, crc)
+            else:
+                section = getattr(self, name)
+                data = memoryview(bytes(section))
+                setattr(self, name, data.cast(typecode) if typecode != "B" else data)
+            section.release()
+        self.view.release()
+        self.mapped.close()
+        self.mapped = None
+
+    def __len__(self):
+        return len(self.flags)
+
+    def root(self):
+        return self.node(0)
+
+    def node(self, index):
+        if index in self.thawed:
+            return self.thawed[index]
+        return RemoteEditCatNode(self, index)
+
+    def name(self, index):
+        return str(
+            self.names[self.offsets[index]:self.offsets[index + 1]],
+            "utf-8",
+            "surrogatepass"
+        )
+
+    def path(self, index):
+        parts = []
+        while index > 0:
+            parts.append(self.name(index))
+            index = self.parents[index]
+        return "/" + "/".join(reversed(parts))
+
+    def find(self, index, name):
+        # The index of the child of index called name, -1 if there isn't one
+        lo = self.first[index]
+        end = lo + self.counts[index]
+        hi = end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < end and self.name(lo) == name:
+            return lo
+        return -1
+
+    def stats(self, index):
+        if not self.flags[index] & HAS_STATS:
+            return None
+        stats = [
+            self.types[index],
+            self.modes[index],
+            self.users[index],
+            self.groups[index],
+            self.sizes[index],
+            self.mtimes[index]
+        ]
+        if index in self.destinations:
+            stats.append(self.destinations[index])
+        return stats
+
+    def child_names(self, index):
+        start = self.first[index]
+        return [self.name(i) for i in range(start, start + self.counts[index])]
+
+    def keys(self, index):
+        keys = []
+        if self.flags[index] & HAS_STATS:
+            keys.append("/")
+        if self.flags[index] & NO_INDEX:
+            keys.append("/NO_INDEX/")
+        if index == 0:
+            keys.append("/CAT_DATA/")
+        return keys + self.child_names(index)
+
+    def get(self, index, key):
+        if key == "/":
+            stats = self.stats(index)
+            if stats is not None:
+                return stats
+        elif key == "/NO_INDEX/":
+            if self.flags[index] & NO_INDEX:
+                return True
+        elif key == "/CAT_DATA/":
+            if index == 0:
+                return self.catData
+        else:
+            child = self.find(index, key)
+            if child >= 0:
+                return self.node(child)
+        raise KeyError(key)
+
+    def has(self, index, key):
+        if key == "/":
+            return bool(self.flags[index] & HAS_STATS)
+        if key == "/NO_INDEX/":
+            return bool(self.flags[index] & NO_INDEX)
+        if key == "/CAT_DATA/":
+            return index == 0
+        return self.find(index, key) >= 0
+
+    def items(self, index):
+        items = []
+        stats = self.stats(index)
+        if stats is not None:
+            items.append(("/", stats))
+        if self.flags[index] & NO_INDEX:
+            items.append(("/NO_INDEX/", True))
+        if index == 0:
+            items.append(("/CAT_DATA/", self.catData))
+        # node() and name() inlined, this is most of building the fuzzy list
+        names = self.names
+        offsets = self.offsets
+        thawed = self.thawed
+        start = self.first[index]
+        for i in range(start, start + self.counts[index]):
+            items.append((
+                str(names[offsets[i]:offsets[i + 1]], "utf-8", "surrogatepass"),
+                thawed[i] if i in thawed else RemoteEditCatNode(self, i)
+            ))
+        return items
+
+    def thaw(self, index):
+        if index not in self.thawed:
+            self.thawed[index] = dict(self.items(index))
+        return self.thawed[index]
+
+
+class RemoteEditCatNode(MutableMapping):
+    # An entry of a RemoteEditCompactCat as a dict
+
+    __slots__ = ("compact", "index")
+
+    def __init__(self, compact, index):
+        self.compact = compact
+        self.index = index
+
+    def __getitem__(self, key):
+        compact = self.compact
+        index = self.index
+        if index in compact.thawed:
+            return compact.thawed[index][key]
+        if key == "/":
+            # The common case
+            stats = compact.stats(index)
+            if stats is not None:
+                return stats
+        return compact.get(index, key)
+
+    def __contains__(self, key):
+        thawed = self.compact.thawed.get(self.index)
+        if thawed is not None:
+            return key in thawed
+        return self.compact.has(self.index, key)
+
+    def __iter__(self):
+        thawed = self.compact.thawed.get(self.index)
+        if thawed is not None:
+            return iter(list(thawed))
+        return iter(self.compact.keys(self.index))
+
+    def __len__(self):
+        thawed = self.compact.thawed.get(self.index)
+        if thawed is not None:
+            return len(thawed)
+        return len(self.compact.keys(self.index))
+
+    def __setitem__(self, key, value):
+        self.compact.thaw(self.index)[key] = value
+
+    def __delitem__(self, key):
+        del self.compact.thaw(self.index)[key]
+
+    def __bool__(self):
+        # Without counting the keys
+        thawed = self.compact.thawed.get(self.index)
+        if thawed is not None:
+            return bool(thawed)
+        index = self.index
+        return bool(index == 0 or self.compact.flags[index] or self.compact.counts[index])
+
+    def __repr__(self):
+        return "RemoteEditCatNode(%s)" % self.compact.path(self.index)
+
+    def items(self):
+        thawed = self.compact.thawed.get(self.index)
+        if thawed is not None:
+            return list(thawed.items())
+        return self.compact.items(self.index)
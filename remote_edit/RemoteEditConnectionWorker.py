@@ -3,343 +3,431 @@ import subprocess
 import threading
 import queue
 import os
+import re
+import stat
 import time
+import hashlib
+import codecs
+from .RemoteEditLog import log, DEBUG, INFO, WARNING
 
 
 # Command input dict:
 #   work["server_name"] = string server name
 #   work["settings"] = server settings dict
-#   work["cmd"] = command string
-#   work["prompt_contains"] = the string to look for in the response that signals
-#       we have everything we need back and can stop listening when the data stops.
-#   work["listen_attempts"] = how many times to listen for data until we get back
-#       our specified promptContains
-#   work["key"] = uniquely identifying key used to return the result data
-#   work["queue"] = a queue to write data to. If this is specified we run
-#       indefinitely
+#   work["cmd"] = command string, or a list of them to run as one batch
+#   work["prompt_contains"] = optional string that must be present in the
+#       response for the command to be considered a success
+#   work["key"] = uniquely identifying key for the command
+#   work["future"] = a RemoteEditFuture to complete with the results
+#   work["queue"] = something with a put() to hand output to as it arrives.
+#       If this is specified we run until the work is cancelled. Should it
+#       also have a next_command() that's asked for more to send to the
+#       running shell, see update_command, and a restart_command() for what
+#       to run should the shell have to be started again
+#   work["stream"] = optional something with a put() to hand a single ssh
+#       command's stdout to, as bytes, as it arrives rather than it being
+#       kept for the results. See stream_output
+#   work["timings"] = optional dict of timestamps, see stamp and
+#       RemoteEditStats
+#   work["idempotent"] = optional bool, whether the command is safe to run
+#       again if the connection drops part way through. Worked out from the
+#       command if not given, see is_idempotent
+#
+# Every command is framed with unique start / end markers (see frame_command)
+# so we know exactly when it has finished without waiting on silence. ssh
+# commands have their output wrapped in echo'd markers, the end one carrying
+# the exit status. sftp has no echo so the end marker is the error sftp
+# returns when asked to ls a path that can't exist.
+#
+# A batch is written to the process in one go, each command with its own
+# markers, and the response split back up per command. ssh batches echo the
+# markers to stderr as well so that it can be split up too.
+#
+# Should connecting fail, or the connection drop while an idempotent command
+# is running, we back off and try again up to maxRetries times within the
+# work's timeout. Only then does the failure go back to whoever asked.
 #
 # Results return dict:
-#   data["key"] = uniquely identifying key used to return the result data
 #   data["out"] = what stdout spewed
 #   data["err"] = ditto stderr
 #   data["success"] = bool indicating if the expected response was returned
+#   data["exit_status"] = exit status of the command (ssh) or 0 / 1 depending
+#       on whether sftp complained on stderr. None if we never saw the end.
+#       The status of the last command for a batch
+#   data["batch"] = batches only, a list with an out, err and exit_status
+#       dict for each command in the order they were given
 #   data["failure_reason_id"] = TODO: an error reason indicator (timed out,
 #       permission denied etc)
 
 
-class RemoteEditConnectionWorker(threading.Thread):
+class RemoteEditConnectionBase(object):
+    # Everything that doesn't care how the process is driven: building the
+    # local command line, framing commands and picking apart the responses.
+    # Shared by the threaded worker below and the asyncio engine in
+    # RemoteEditAsyncConnector.
 
     threadId = None
-    process = None
-    queueOut = None
-    queueErr = None
-    threadOut = None
-    threadErr = None
     lastErr = None
     lastOut = None
     binPath = None
-    promptContains = None
     quit = False
     lostConnection = 0
 
     serverName = None
     appType = None
     queue = None
-    results = None
     platform = None
     work = None
     hostUnknown = None
+    exitStatus = None
+    markerCount = 0
+    # Raw bytes of the response being collected, only decoded once complete
+    outBuf = None
+    errBuf = None
+    outSearchFrom = 0
+    errSearchFrom = 0
+    decoders = None
+    # The marker of the work's own command when it isn't a batch, the only
+    # output stream_output hands on, and whether it's begun to
+    streamMarker = None
+    streaming = False
+    # Set while running a batch, see frame_commands
+    framedErr = False
+    batchResults = None
+    # Structured listings, only the sftp protocol worker fills this in
+    entries = None
+    # pid of the remote shell (ssh only), see interrupt
+    shellPid = None
+    # Bytes moved by transfers (sftp protocol worker) for the current work
+    transferred = 0
+    # Reconnecting, see back_off
+    attempt = 0
+    maxRetries = 3
+    retryDelay = 0.5
+    # Commands that only read so are safe to run again should the connection
+    # drop half way through
+    idempotentCommands = {
+        "ssh": [
+            "", "cd", "ls", "cat", "echo", "uname", "hostname", "uptime",
+            "grep", "egrep", "find", "stat", "md5sum", "md5", "head", "wc",
+            "readlink", "test", "pwd", "df", "du", "true", ":"
+        ],
+        "sftp": ["", "ls", "stat", "get", "pwd"]
+    }
 
-    def config(self, threadId, appType, queue, results, platform):
+    def config(self, threadId, appType, queue, platform):
         self.threadId = threadId
         self.appType = appType
         self.queue = queue
-        self.results = results
         self.platform = platform
-        if self.appType == "sftp":
-            if self.platform == "windows":
-                self.promptContains = "psftp>"
-            else:
-                self.promptContains = "sftp>"
-        else:
-            self.promptContains = "$"
-
-    def __del__(self):
-        self.quit = True
-        self.close_connection()
-
-    def run(self):
-        holdYerHorses = 0.01
-        while not self.quit:
-            # Can't do anything until we're config'd (above). Tried using
-            # __init__ but the rest of the code had trouble seeing var's
-            # declared there. Bug?
-            if self.queue:
-                self.debug("Start work loop")
-                self.work = self.queue.get()
-                if "timeout" in self.work:
-                    self.work["expire_at"] = self.work["timeout"] + time.time()
-                self.process_work_and_respond()
-                self.queue.task_done()
-                self.debug("End work loop")
-            else:
-                time.sleep(holdYerHorses)
-        self.debug("He killed me with a sword. How weird is that?")
 
-    def process_work_and_respond(self):
-        # Check to see if we've been told to terminate
-        if "KILL" in self.work and self.threadId == self.work["KILL"]:
-            self.debug("Stop called for thread %s, we are %s" % (
-                self.work["KILL"],
-                self.threadId
-            ))
-            self.stop()
-            return
-        # If we're connected to a different server then disconnect
+    def server_changed(self):
         if self.serverName and self.work["server_name"] != self.serverName:
-            self.debug("Server has changed. Before: %s, After: %s" % (
+            self.debug(
+                "Server has changed. Before: %s, After: %s",
                 self.serverName,
                 self.work["server_name"]
-            ))
-            self.close_connection()
-        # Run the command
-        success = self.run_command(
-            self.work["cmd"],
-            self.work["prompt_contains"],
-            self.work["listen_attempts"],
-            self.work["accept_new_host"],
-            self.work["queue"]
-        )
-        # Put together the results object and add it to the dict shated with
-        # the parent
-        if not self.work["drop_results"]:
+            )
+            return True
+        return False
+
+    def is_idempotent(self, cmd):
+        if self.work.get("idempotent") is not None:
+            return self.work["idempotent"]
+        # Whatever was streamed can't be taken back
+        if self.work.get("stream"):
+            return False
+        safe = self.idempotentCommands["ssh" if self.appType == "ssh" else "sftp"]
+        for c in (cmd if isinstance(cmd, list) else [cmd]):
+            if ">>" in c:
+                return False
+            for part in re.split(r"[;&|()\n]+", c):
+                words = part.split()
+                if words and words[0] not in safe:
+                    return False
+        return True
+
+    def retry_delay(self):
+        # Doubles with each attempt. None once we're out of retries or there
+        # isn't the time left for another go.
+        if self.attempt >= self.maxRetries or self.is_cancelled():
+            return None
+        delay = self.retryDelay * 2 ** self.attempt
+        if time.time() + delay >= self.work["expire_at"]:
+            return None
+        self.attempt += 1
+        self.info("Trying again in %ss (attempt %s)", delay, self.attempt)
+        return delay
+
+    def stamp(self, stage, after=None):
+        # Record when the work reached stage, only the first time
+        timings = self.work.get("timings") if self.work else None
+        if timings is None or stage in timings or (after and after not in timings):
+            return
+        timings[stage] = time.time()
+
+    def is_cancelled(self):
+        future = self.work.get("future") if self.work else None
+        return future is not None and future.cancelled
+
+    def respond(self, success):
+        # Put together the results object and hand it back through the
+        # work's future
+        self.stamp("complete")
+        self.work["bytes"] = len(self.lastOut or "") + len(self.lastErr or "") + self.transferred
+        if not self.work.get("future"):
+            return
+        if self.work["drop_results"]:
+            # Just to say it's done
+            self.work["future"].set_result({"success": success})
+        else:
             results = {}
             results["success"] = success
             results["out"] = self.lastOut
             results["err"] = self.lastErr
-            results["prompt_contains"] = self.work["prompt_contains"]
+            results["exit_status"] = self.exitStatus
+            if self.batchResults is not None:
+                results["batch"] = self.batchResults
+            if self.entries is not None:
+                results["entries"] = self.entries
             if self.hostUnknown:
                 results["host_unknown"] = True
             # results["failure_reason_id"]
-            self.results[self.work["key"]] = results
+            self.work["future"].set_result(results)
 
-    def stop(self):
-        self.quit = True
-        self.close_connection()
-        self.debug("Thread %s has left the building." % self.threadId)
+    def get_marker(self):
+        self.markerCount += 1
+        m = hashlib.md5()
+        m.update(("%s%s%s%s" % (
+            self.appType,
+            self.threadId,
+            self.markerCount,
+            str(time.time())
+        )).encode("utf-8"))
+        return "RE%s" % m.hexdigest()[0:16]
 
-    def run_command(self, cmd, checkReturn=None, listenAttempts=5, acceptNew=False, q=None):
-        self.hostUnknown = False
-        # Record which server we're connected to
-        self.serverName = self.work["server_name"]
-        # If checkReturn is overridden on a per command basis then it only
-        # applies to the self.write_command() call. We will still need to look
-        # for the standard prompt text after we connect to the server.
+    def frame_command(self, cmd, marker):
         if self.appType == "ssh":
-            promptContains = self.get_server_setting(
-                "prompt_contains",
-                self.promptContains
-            )
+            # The markers are split in two with quotes so that should the
+            # command ever be echoed back to us it can't match the output.
+            # Built-in echo only, nothing is forked.
+            start = "echo \"%s\"\"S%s\"" % (marker[0:2], marker[2:])
+            end = "echo \"%s\"\"E%s:$?\"" % (marker[0:2], marker[2:])
+            if self.framedErr:
+                start += "; %s >&2" % start
+                end += "; echo \"%s\"\"E%s\" >&2" % (marker[0:2], marker[2:])
+            return "%s\n%s\n%s" % (start, cmd, end)
+        # sftp can't echo, ls'ing a path that can't exist gets an error back
+        # that includes the marker. It is a single round trip, no process.
+        endCmd = "ls /%sE" % marker
+        if cmd:
+            return "%s\n%s" % (cmd, endCmd)
+        return endCmd
+
+    def frame_commands(self, cmd):
+        # Returns the text to write along with the markers to split the
+        # response on, one per command. The last one marks the end of it all.
+        self.framedErr = isinstance(cmd, list)
+        cmds = cmd if self.framedErr else [cmd]
+        markers = [self.get_marker() for c in cmds]
+        self.streamMarker = None if self.framedErr else markers[0]
+        return (
+            "\n".join(
+                [self.frame_command(c, m) for (c, m) in zip(cmds, markers)]
+            ),
+            markers
+        )
+
+    def reset_response(self):
+        self.outBuf = bytearray()
+        self.errBuf = bytearray()
+        self.outSearchFrom = 0
+        self.errSearchFrom = 0
+        self.streaming = False
+
+    def reset_decoders(self):
+        # Incremental so a multibyte character split across two reads comes
+        # out whole rather than being dropped
+        self.decoders = {
+            "out": codecs.getincrementaldecoder("utf-8")(errors="ignore"),
+            "err": codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        }
+
+    def add_response(self, stream, data):
+        if data:
+            self.stamp("first_byte", after="connected")
+        if stream == "out":
+            self.outBuf.extend(data)
         else:
-            promptContains = self.promptContains
-        if checkReturn is None:
-            checkReturn = promptContains
-        if not self.connect(promptContains, acceptNew):
-            self.debug("Error connecting")
-            return False
-        # Write the cmd string to stdin
-        self.lostConnection = 0
-        # Discard any output in the buffers...
-        self.await_response(discard=True)
-        if cmd and not self.write_command(cmd):
-            self.debug("Error writing")
-            return False
-        if q:
-            return self.read_forever(q)
-        buf = ""
-        # If not found then try again.
-        while listenAttempts > 0:
-            self.debug("Now listening")
-            self.await_response()
-            # Ensure we see the command prompt
-            if self.platform != "windows":
-                self.write_command(" ")
-            # If we lost connection after writing then try again
-            # We check for 1 to ensure that we only do this once
-            if self.lostConnection == 1:
-                if self.connect(promptContains):
-                    if cmd:
-                        if not self.write_command(cmd):
-                            self.debug("Error writing after reconnect")
-                            break
-                        self.await_response()
-                else:
-                    self.lastOut = ""
-            # With sftp on nix the prompt isn't shown until you send a command, strip it so it isn't picked up as the checkReturn and we possibly stop collecting too soon
-            if self.appType == "sftp" and self.platform != "windows" and len(self.lastOut) > 10 and self.lastOut[0:len(checkReturn)] == checkReturn:
-                self.lastOut = self.lastOut[len(checkReturn):]
-            buf += self.lastOut
-            if checkReturn in self.lastOut:
-                self.debug("Found checkReturn")
-                break
-            listenAttempts -= 1
-        self.lastOut = buf
-        if checkReturn not in self.lastOut:
-            self.debug("Expected return data not found")
-            return False
-        return True
+            self.errBuf.extend(data)
 
-    def connect(self, promptContains, acceptNew):
-        try:
-            if self.process.poll() is None:
-                self.debug(":o) Polling ok, process alive and well")
+    def decode_response(self):
+        self.lastOut = self.decoders["out"].decode(self.outBuf)
+        self.lastErr = self.decoders["err"].decode(self.errBuf)
+
+    def response_contains(self, strings):
+        for s in strings:
+            b = s.encode("utf-8")
+            if b in self.outBuf or b in self.errBuf:
                 return True
-            else:
-                self.debug("Polling fail, process has died")
-        except Exception as e:
-            self.debug("Process not running: %s" % e)
-        # Need to reconnect
-        self.create_process()
-        # Nix only, we need this as otherwise lastOut is empty
-        if self.appType == "ssh" and self.platform != "windows":
-            self.write_command("echo '%s'" % promptContains)
-        self.await_response()
-        if "Password:" in self.lastOut and self.get_server_setting("password", None):
-            self.write_command(self.get_server_setting("password"), mask=True)
-            self.await_response()
-        if "host key is not cached in the registry" in self.lastErr:
-            if acceptNew:
-                self.write_command("yes")
-                self.await_response()
-                if "Password:" in self.lastOut and self.get_server_setting("password", None):
-                    self.write_command(self.get_server_setting("password"), mask=True)
-                    self.await_response()
-            else:
-                self.process.terminate()
-                self.process = None
-                self.hostUnknown = True
-                return False
-        if promptContains not in self.lastOut and "Connected to" not in self.lastErr:
-            if self.appType == "ssh" and self.platform != "windows":
-                self.write_command("echo '%s'" % promptContains)
-            self.await_response()
-            if promptContains not in self.lastOut:
-                self.await_response()
-                if promptContains not in self.lastOut:
-                    self.debug("Connect failed: %s" % self.lastOut)
-                    return False
-        self.debug("Connection OK")
-        return True
+        return False
 
-    def write_command(self, cmd, mask=False):
-        try:
-            self.debug("Sending command: %s" % ("*" * len(cmd) if mask else cmd))
-            self.process.stdin.write(bytes("%s\n" % (cmd), "utf-8"))
+    def find_end_marker(self, marker):
+        # Called every time a chunk arrives so only search what we haven't
+        # already looked at, less enough overlap to catch a marker that
+        # straddles two chunks.
+        if self.appType == "ssh":
+            endB = ("%sE%s:" % (marker[0:2], marker[2:])).encode("utf-8")
+            i = self.outBuf.find(endB, self.outSearchFrom)
+            if i == -1:
+                self.outSearchFrom = max(0, len(self.outBuf) - len(endB))
+                self.stream_output(marker, self.outSearchFrom)
+                return False
+            i -= self.stream_output(marker, i)
+            self.outSearchFrom = i
+            # Wait for the rest of the line so we have the whole exit status
+            if self.outBuf.find(b"\n", i) == -1:
+                return False
+            if self.framedErr:
+                # stderr is read separately so may not have caught up yet
+                return self.errBuf.find(endB[0:-1]) != -1
             return True
-        except Exception as e:
-            self.debug("Command failed: %s" % e)
-            return False
+        endB = ("%sE" % marker).encode("utf-8")
+        if self.errBuf.find(endB, self.errSearchFrom) != -1:
+            return True
+        self.errSearchFrom = max(0, len(self.errBuf) - len(endB))
+        # sftp echoes each command it reads from a pipe so the marker will
+        # turn up in stdout as well. Only the error counts.
+        i = self.outBuf.find(endB, self.outSearchFrom)
+        while i != -1:
+            if self.outBuf[max(0, i - 4):i] != b"ls /":
+                return True
+            i = self.outBuf.find(endB, i + 1)
+        self.outSearchFrom = max(0, len(self.outBuf) - len(endB))
+        return False
+
+    def stream_output(self, marker, upTo):
+        # For work with a stream, hand it stdout from after the start marker
+        # up to upTo (where the end marker is, or might be starting) and drop
+        # that from the response. ssh single commands only. Returns how much
+        # was dropped.
+        stream = self.work.get("stream") if self.work else None
+        if not stream or marker != self.streamMarker or self.appType != "ssh":
+            return 0
+        dropped = 0
+        if not self.streaming:
+            startB = ("%sS%s" % (marker[0:2], marker[2:])).encode("utf-8")
+            i = self.outBuf.find(startB)
+            dropped = self.outBuf.find(b"\n", i) + 1 if i != -1 else 0
+            if not dropped or dropped > upTo:
+                return 0
+            self.streaming = True
+        if upTo > dropped:
+            stream.put(bytes(self.outBuf[dropped:upTo]))
+        dropped = max(dropped, upTo)
+        del self.outBuf[0:dropped]
+        self.outSearchFrom = max(0, self.outSearchFrom - dropped)
+        return dropped
 
-    def await_response(self, discard=False):
-        if discard:
-            self.debug("Discarding output...")
+    def split_response(self, markers):
+        # Trim stdout / stderr down to what the framed command(s) produced and
+        # pull out the exit status.
+        out = self.lastOut
+        err = self.lastErr
+        responses = []
+        for marker in markers:
+            (cmdOut, cmdErr, exitStatus, out, err) = self.cut_response(
+                out,
+                err,
+                marker
+            )
+            responses.append({
+                "out": cmdOut,
+                "err": cmdErr,
+                "exit_status": exitStatus
+            })
+        if self.framedErr:
+            self.batchResults = responses
+            self.lastOut = "".join([r["out"] for r in responses])
+            self.lastErr = "".join([r["err"] for r in responses])
         else:
-            self.debug("Waiting for output...")
-        self.lastOut = self.lastErr = ""
-        i = 0
-        while True:
-            (outB, errB) = self.read_pipes()
-            self.lastOut += str(outB)
-            self.lastErr += str(errB)
-            if self.process.poll() is not None:
-                self.debug("Process died")
-                self.lostConnection += 1
-                break
-            elif (self.lastOut or self.lastErr) and not outB and not errB:
-                i += 1
-                if i > 10:
-                    self.debug("Found response")
-                    break
-            elif time.time() > self.work["expire_at"]:
-                self.debug("Connection timed out")
-                break
-            elif discard:
-                return
-            time.sleep(0.01)
-        if self.lastOut:
-            self.debug(
-                "--------- stdout ---------\n%s\n%s" % (
-                    "\n".join(map(self.strip, self.lastOut.split("\n"))),
-                    "-" * 44
-                )
+            self.lastOut = responses[-1]["out"]
+            self.lastErr = responses[-1]["err"]
+        self.exitStatus = responses[-1]["exit_status"]
+
+    def cut_response(self, out, err, marker):
+        # Returns the output of the command framed by marker, its exit status
+        # and whatever follows it
+        if self.appType == "ssh":
+            startMarker = "%sS%s" % (marker[0:2], marker[2:])
+            endMatch = re.search(
+                "%sE%s:([0-9]+)" % (marker[0:2], marker[2:]),
+                out
             )
-        if self.lastErr:
-            self.debug(
-                "-------- stderr --------\n%s\n%s" % (
-                    "\n".join(map(self.strip, self.lastErr.split("\n"))),
-                    "-" * 44
-                )
+            if not endMatch:
+                # An earlier command in the batch ate the rest of the input
+                return ("", "", None, out, err)
+            cmdOut = out[0:endMatch.start()]
+            i = cmdOut.find(startMarker)
+            if i != -1:
+                cmdOut = cmdOut[i + len(startMarker):]
+            cmdErr = err
+            err = ""
+            if self.framedErr:
+                endMarker = "%sE%s" % (marker[0:2], marker[2:])
+                j = cmdErr.find(endMarker)
+                if j != -1:
+                    err = cmdErr[j + len(endMarker):]
+                    cmdErr = cmdErr[0:j]
+                i = cmdErr.find(startMarker)
+                if i != -1:
+                    cmdErr = cmdErr[i + len(startMarker):]
+                cmdErr = cmdErr.lstrip("\r\n")
+            return (
+                cmdOut.lstrip("\r\n"),
+                cmdErr,
+                int(endMatch.group(1)),
+                out[endMatch.end():],
+                err
             )
+        cmdOut = out
+        out = ""
+        i = cmdOut.find("ls /%sE" % marker)
+        if i != -1:
+            j = cmdOut.find("\n", i)
+            if j != -1:
+                out = cmdOut[j + 1:]
+            # Cut from the start of the line holding the echo (or prompt)
+            cmdOut = cmdOut[0:cmdOut.rfind("\n", 0, i) + 1]
+        lines = err.split("\n")
+        for (i, l) in enumerate(lines):
+            if marker in l:
+                cmdErr = "\n".join(lines[0:i])
+                err = "\n".join(lines[i + 1:])
+                break
+        else:
+            cmdErr = err
+            err = ""
+        return (cmdOut, cmdErr, 1 if cmdErr.strip() else 0, out, err)
 
-    def read_forever(self, q):
-        i = 0
-        while True:
-            # See if we've been told to quit
-            checkData = ""
-            try:
-                checkData = q.get_nowait()
-                if "{{%%KILL%%}}" in checkData:
-                    self.process.terminate()
-                    self.process = None
-                    self.quit = True
-                    break
-            except queue.Empty:
-                pass
-            # Send a keep alive every minute
-            if i >= 60:
-                self.process.stdin.write(bytes(" ", "utf-8"))
-                i = 0
-            data = checkData + self.read_pipes()[0]
+    def log_response(self):
+        # Only as much as will be logged is tidied up, never the whole of a
+        # large response
+        if not log.is_enabled(DEBUG):
+            return
+        for (name, data) in [("stdout", self.lastOut), ("stderr", self.lastErr)]:
             if data:
-                q.put(data)
-            if self.process.poll() is not None:
-                self.debug("Process died, starting again")
-                self.run_command(
-                    self.work["cmd"],
-                    self.work["prompt_contains"],
-                    self.work["listen_attempts"],
-                    self.work["accept_new_host"].
-                    self.work["queue"]
+                self.debug(
+                    "--------- %s ---------\n%s\n%s",
+                    name,
+                    "\n".join(map(self.strip, data[0:log.maxLength].split("\n"))),
+                    "-" * 44
                 )
-                break
-            time.sleep(0.4)
-            i += 0.4
 
     def strip(self, s):
         return s.strip()
 
-    def read_pipes(self):
-        out = err = ""
-        # Read line without blocking
-        try:
-            err = self.queueErr.get_nowait()
-        except queue.Empty:
-            pass
-        # Read line without blocking
-        try:
-            out = self.queueOut.get_nowait()
-        except queue.Empty:
-            pass
-        return (out, err)
-
-    def close_connection(self):
-        try:
-            self.process.terminate()
-            self.process = None
-        except:
-            pass
-
-    def get_local_command(self):
+    def get_local_command(self, acceptNew=False):
         if self.platform == "windows":
             cmd = [
                 self.get_app_path(),
@@ -348,14 +436,24 @@ class RemoteEditConnectionWorker(threading.Thread):
                 "-l",
                 self.get_server_setting("user")
             ]
-            if self.appType == "ssh":
+            if not acceptNew:
+                # Fail straight away on an unknown host key rather than sit
+                # at a prompt that would swallow our first command
+                cmd.append("-batch")
+            if self.appType != "sftp":
                 cmd.append("-ssh")
+            if self.get_server_setting("multiplex", False):
+                # Share one connection between every plink / psftp for this
+                # host. The first one up becomes the upstream.
+                cmd.append("-share")
             if self.get_server_setting("port", None):
                 cmd.append("-P")
                 cmd.append(self.get_server_setting("port"))
             if self.get_server_setting("password", None):
                 cmd.append("-pw")
                 cmd.append(self.get_server_setting("password"))
+            if self.get_server_setting("compression", False) is True:
+                cmd.append("-C")
             sshKeyFile = self.get_server_setting("ssh_key_file", None)
             if sshKeyFile:
                 if "%" in sshKeyFile:
@@ -368,11 +466,26 @@ class RemoteEditConnectionWorker(threading.Thread):
             cmd = [
                 self.get_app_path()
             ]
-            if self.appType == "ssh":
+            if self.appType != "sftp":
                 cmd.append("-q")
+            # Have ssh notice a dead connection (and a server that isn't
+            # there) in seconds rather than wait on TCP
+            cmd.extend([
+                "-o", "ConnectTimeout=%s" % self.get_server_setting("connect_timeout", 10),
+                "-o", "ServerAliveInterval=%s" % self.get_server_setting("server_alive_interval", 5),
+                "-o", "ServerAliveCountMax=%s" % self.get_server_setting("server_alive_count_max", 3)
+            ])
             if self.get_server_setting("port", None):
-                cmd.append("-P")
+                cmd.append("-P" if self.appType == "sftp" else "-p")
                 cmd.append(self.get_server_setting("port"))
+            # See RemoteEditCommand.check_transport
+            if self.get_server_setting("compression", False) is True:
+                cmd.append("-C")
+            cipher = self.get_server_setting("cipher", None)
+            if cipher and cipher != "auto":
+                cmd.extend(["-c", cipher])
+            if self.get_server_setting("multiplex", False):
+                cmd.extend(self.get_multiplex_options())
             sshKeyFile = self.get_server_setting("ssh_key_file", None)
             if sshKeyFile:
                 if "~" in sshKeyFile:
@@ -385,15 +498,36 @@ class RemoteEditConnectionWorker(threading.Thread):
                     self.get_server_setting("host")
                 )
             )
+        if self.appType == "sftpv3":
+            # The sftp subsystem rather than a shell, see RemoteEditSftpWorker
+            cmd.insert(-1 if self.platform != "windows" else len(cmd), "-s")
+            cmd.append("sftp")
         return cmd
 
+    def get_multiplex_options(self):
+        # Every ssh and sftp for a server opens a channel over one master
+        # connection, so only the first pays for the handshake and auth. The
+        # master lingers for multiplex_persist seconds after the last client
+        # goes unless stop_control_master() gets to it first.
+        controlDir = get_control_dir()
+        if not controlDir:
+            return []
+        return [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % os.path.join(controlDir, "%C"),
+            "-o", "ControlPersist=%s" % self.get_server_setting(
+                "multiplex_persist",
+                300
+            )
+        ]
+
     def get_app_path(self):
         if self.appType == "sftp":
             if self.platform == "windows":
                 app = "psftp.exe"
             else:
                 app = "sftp"
-        elif self.appType == "ssh":
+        elif self.appType in ["ssh", "sftpv3"]:
             if self.platform == "windows":
                 app = "plink.exe"
             else:
@@ -412,31 +546,471 @@ class RemoteEditConnectionWorker(threading.Thread):
             val = default
         return val
 
-    def create_process(self):
+    def get_process_kwargs(self):
         kwargs = {}
-        if subprocess.mswindows:
+        if self.platform == "windows":
             su = subprocess.STARTUPINFO()
             su.dwFlags |= subprocess.STARTF_USESHOWWINDOW
             su.wShowWindow = subprocess.SW_HIDE
             kwargs['startupinfo'] = su
+        return kwargs
+
+    def get_bin_path(self):
+        if not self.binPath:
+            if self.platform == "windows":
+                self.binPath = os.path.join(
+                    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    "bin"
+                )
+            else:
+                self.binPath = "/usr/bin"
+        return self.binPath
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, args)
+
+    def log(self, level, msg, args):
+        # See RemoteEditLog, nothing is formatted unless it's to be logged
+        if log.is_enabled(level):
+            log.write(
+                level,
+                "%s[%s]" % ((self.appType or "").upper(), self.threadId),
+                msg,
+                args
+            )
+
+
+class RemoteEditConnectionWorker(RemoteEditConnectionBase, threading.Thread):
+    # Run by a RemoteEditWorkerPool, which is told when we start and finish
+    # each piece of work and asked whether we should go once we've been idle
+    # for a while
+
+    process = None
+    queueIn = None
+    threadOut = None
+    threadErr = None
+    pool = None
+    dedicated = False
+    reserved = False
+    # When the pool's next to ping our connection, see get_work
+    nextPingAt = None
+    keepAliveTimeout = 15
+    interruptTimeout = 5
+    # The ssh sending the interrupt, see interrupt
+    interrupter = None
+
+    def __del__(self):
+        self.quit = True
+        self.close_connection()
+
+    def run(self):
+        while not self.quit:
+            if self.dedicated:
+                # Work of our own (a tail), we go once it's done
+                self.process_work_and_respond()
+                self.pool.retire(self)
+                break
+            try:
+                if self.pool:
+                    self.work = self.pool.get_work(self)
+                else:
+                    self.work = self.queue.get()
+            except queue.Empty:
+                if self.pool.retire(self):
+                    break
+                continue
+            except Exception as e:
+                # Reconnecting in keep_alive went badly wrong. Leave the pool
+                # rather than stay in it dead, it starts another as needed.
+                self.warning("Leaving the pool after an error while idle: %s", e)
+                self.pool.remove(self)
+                break
+            if self.work is None:
+                # Just woken up to check whether we should quit
+                self.queue.task_done()
+                continue
+            if self.is_cancelled():
+                self.debug("Skipping cancelled work")
+                self.queue.task_done()
+                continue
+            self.debug("Start work loop")
+            if self.pool:
+                self.pool.work_started(self)
+            try:
+                self.process_work_and_respond()
+            finally:
+                if self.pool:
+                    self.pool.work_finished(self)
+            self.queue.task_done()
+            self.debug("End work loop")
+        self.close_connection()
+        self.debug("He killed me with a sword. How weird is that?")
+
+    def process_work_and_respond(self):
+        self.stamp("dequeued")
+        self.transferred = 0
+        if "timeout" in self.work:
+            self.work["expire_at"] = self.work["timeout"] + time.time()
+        # If we're connected to a different server then disconnect
+        if self.server_changed():
+            self.close_connection()
+        # Run the command
+        success = self.run_command(
+            self.work["cmd"],
+            self.work["prompt_contains"],
+            self.work["accept_new_host"],
+            self.work["queue"]
+        )
+        self.respond(success)
+
+    def stop(self):
+        self.quit = True
+        self.close_connection()
+        self.debug("Thread %s has left the building.", self.threadId)
+
+    def keep_alive(self):
+        # Called by the pool while we're waiting for work. Run an empty
+        # command to keep the connection busy, if there's no answer then
+        # reconnect now rather than when there's work waiting.
+        if not self.process or not self.work:
+            return
+        self.debug("Keep alive")
+        self.work = dict(
+            self.work,
+            expire_at=time.time() + self.keepAliveTimeout,
+            future=None,
+            timings=None,
+            stream=None
+        )
+        self.framedErr = False
+        self.discard_output()
+        marker = self.get_marker()
+        if self.write_command(self.frame_command("", marker)) and self.await_response(marker):
+            return
+        self.info("Keep alive failed, reconnecting")
+        self.close_connection()
+        self.connect(False)
+
+    def run_command(self, cmd, checkReturn=None, acceptNew=False, q=None):
+        self.hostUnknown = False
+        self.exitStatus = None
+        self.framedErr = False
+        self.batchResults = None
+        # Record which server we're connected to
+        self.serverName = self.work["server_name"]
+        self.attempt = 0
+        if q:
+            if not self.reconnect(acceptNew):
+                return False
+            self.discard_output()
+            if cmd and not self.write_command(cmd):
+                self.debug("Error writing")
+                return False
+            return self.read_forever(q)
+        while True:
+            if not self.reconnect(acceptNew):
+                return False
+            self.lostConnection = 0
+            # Discard anything left in the buffers from a previous command
+            self.discard_output()
+            # Everything goes in one write, a batch costs a single round trip
+            (framed, markers) = self.frame_commands(cmd)
+            if self.write_command(framed):
+                found = self.await_response(markers[-1])
+                if found or not self.lostConnection:
+                    break
+                if not self.is_idempotent(cmd):
+                    self.warning("Lost connection, not safe to run again")
+                    break
+                self.debug("Lost connection")
+            else:
+                # Nothing was run, always safe to go again
+                self.debug("Error writing")
+                found = False
+            delay = self.retry_delay()
+            if delay is None:
+                break
+            time.sleep(delay)
+        if not found:
+            self.debug("End marker not found")
+            # Whatever is still running would otherwise spill its output into
+            # the next command so start afresh
+            self.close_connection()
+            return False
+        self.split_response(markers)
+        if checkReturn is not None and checkReturn not in self.lastOut:
+            self.debug("Expected return data not found")
+            return False
+        return True
+
+    def reconnect(self, acceptNew):
+        # connect, backing off and trying again if it fails
+        while not self.connect(acceptNew):
+            delay = None if self.hostUnknown else self.retry_delay()
+            if delay is None:
+                self.debug("Error connecting")
+                return False
+            time.sleep(delay)
+        self.stamp("connected")
+        return True
+
+    def connect(self, acceptNew):
+        try:
+            if self.process.poll() is None:
+                self.debug(":o) Polling ok, process alive and well")
+                return True
+            else:
+                self.debug("Polling fail, process has died")
+        except Exception as e:
+            self.debug("Process not running: %s", e)
+        # Need to reconnect
+        self.create_process(acceptNew)
+        if acceptNew and self.platform == "windows":
+            # plink / psftp are run without -batch so they will ask whether
+            # to cache the host key. If they already know it the answer just
+            # ends up as a harmless unknown command.
+            self.write_command("y")
+        # Frame an empty command, once we see the end marker the shell (or
+        # sftp) is ready to accept work. A shell tells us its pid on the way.
+        marker = self.get_marker()
+        self.write_command(
+            self.frame_command("echo $$" if self.appType == "ssh" else "", marker)
+        )
+        found = self.await_response(marker, stopOn=["Password:"])
+        if not found and "Password:" in self.lastOut and self.get_server_setting("password", None):
+            self.write_command(self.get_server_setting("password"), mask=True)
+            found = self.await_response(marker)
+        if not found:
+            if "host key is not cached" in self.lastErr:
+                self.hostUnknown = True
+            self.warning("Connect failed: %s", self.lastErr)
+            self.close_connection()
+            return False
+        if self.appType == "ssh":
+            pid = self.cut_response(self.lastOut, "", marker)[0].strip()
+            self.shellPid = pid if pid.isdigit() else None
+        self.debug("Connection OK")
+        return True
+
+    def write_command(self, cmd, mask=False):
+        try:
+            self.debug("Sending command: %s", "*" * len(cmd) if mask else cmd)
+            self.process.stdin.write(bytes("%s\n" % (cmd), "utf-8"))
+            return True
+        except Exception as e:
+            self.debug("Command failed: %s", e)
+            return False
+
+    def interrupt(self):
+        # SIGINT whatever the shell is running. There's no tty to send a ^C
+        # down so it's done over a connection of its own. When multiplexing
+        # that's just a channel over the master, otherwise it's a whole new
+        # connection (TCP, key exchange and auth) so it isn't waited on and
+        # only one is on its way at a time, see await_response. The shell
+        # itself carries on and gives us the end marker as usual. Returns
+        # False if there's no shell to do it for or the last one failed.
+        if not self.shellPid:
+            return False
+        if self.interrupter and self.interrupter.returncode == 255:
+            self.warning("Interrupt failed, ssh couldn't connect")
+            return False
+        self.debug("Interrupting children of %s", self.shellPid)
+        try:
+            self.interrupter = subprocess.Popen(
+                self.get_local_command() + ["pkill -INT -P %s" % self.shellPid],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                close_fds=False,
+                **self.get_process_kwargs()
+            )
+        except Exception as e:
+            self.warning("Interrupt failed: %s", e)
+            return False
+        return True
+
+    def interrupting(self):
+        # Whether the last interrupt is still on its way
+        return self.interrupter is not None and self.interrupter.poll() is None
+
+    def stop_interrupting(self):
+        # One turning up late would interrupt the next command instead
+        if self.interrupting():
+            self.interrupter.kill()
+            self.interrupter.wait()
+        self.interrupter = None
+
+    def discard_output(self):
+        (outB, errB) = self.read_pipes()
+        if outB or errB:
+            self.debug("Discarded output: %s%s", outB, errB)
+            self.reset_decoders()
+
+    def await_response(self, marker=None, stopOn=None):
+        # Block on the reader threads until the end marker turns up, the
+        # process dies or we time out. Returns True if the marker was found.
+        self.debug("Waiting for output...")
+        self.reset_response()
+        found = False
+        interruptAt = None
+        while True:
+            if marker and self.find_end_marker(marker):
+                self.debug("Found response")
+                found = True
+                break
+            if stopOn and self.response_contains(stopOn):
+                self.debug("Found interactive prompt")
+                break
+            if self.is_cancelled() and self.shellPid and not self.interrupting() and (interruptAt is None or time.time() > interruptAt):
+                # Keep interrupting until the end marker turns up, a batch
+                # will move on to its next command, but never while the last
+                # one is still on its way. Give up after interruptTimeout and
+                # lose the connection instead. Without a shell to interrupt
+                # (the sftp binary) it's left to finish, the results go
+                # nowhere as the future's already done, which beats
+                # reconnecting.
+                if interruptAt is None:
+                    self.work["expire_at"] = min(
+                        self.work["expire_at"],
+                        time.time() + self.interruptTimeout
+                    )
+                if not self.interrupt():
+                    self.debug("Cancelled")
+                    break
+                interruptAt = time.time() + 1
+            remaining = self.work["expire_at"] - time.time()
+            if remaining <= 0:
+                self.warning("Connection timed out")
+                break
+            try:
+                (stream, data) = self.queueIn.get(timeout=min(remaining, 1))
+            except queue.Empty:
+                data = None
+            if data:
+                self.add_response(stream, data)
+                continue
+            process = self.process
+            if process is None:
+                # Closed from another thread, see stop
+                self.debug("Connection closed")
+                break
+            if data is not None:
+                # A pipe closed, the process is on its way out. Give it a
+                # moment to go rather than notice on the next poll.
+                try:
+                    process.wait(timeout=0.5)
+                except subprocess.TimeoutExpired:
+                    pass
+            if process.poll() is not None:
+                # Pick up anything the readers managed before the pipes closed
+                (outB, errB) = self.read_pipes()
+                self.add_response("out", outB)
+                self.add_response("err", errB)
+                self.debug("Process died")
+                self.lostConnection += 1
+                found = bool(marker and self.find_end_marker(marker))
+                break
+        self.stop_interrupting()
+        self.decode_response()
+        self.log_response()
+        return found
+
+    def read_forever(self, q):
+        # Hand output to q (anything with a put) as soon as it arrives, until
+        # the work is cancelled. Should the process die it's started again.
+        keepAliveAt = time.time() + 60
+        while True:
+            # Before the cancel check so that the last word gets to the shell
+            self.update_command(q)
+            if self.is_cancelled():
+                self.close_connection()
+                self.quit = True
+                break
+            # Send a keep alive every minute
+            if time.time() > keepAliveAt:
+                try:
+                    self.process.stdin.write(bytes(" ", "utf-8"))
+                except Exception:
+                    pass
+                keepAliveAt = time.time() + 60
+            try:
+                # Only wait so long so that cancelling is noticed
+                (stream, data) = self.queueIn.get(timeout=0.5)
+            except queue.Empty:
+                (stream, data) = ("out", None)
+            if data and stream == "out":
+                data = self.decoders["out"].decode(data)
+                if data:
+                    q.put(data)
+            elif not data and self.process.poll() is not None:
+                self.debug("Process died, starting again")
+                if hasattr(q, "restart_command"):
+                    self.work["cmd"] = q.restart_command()
+                return self.run_command(
+                    self.work["cmd"],
+                    self.work["prompt_contains"],
+                    self.work["accept_new_host"],
+                    self.work["queue"]
+                )
+
+    def read_pipes(self):
+        # Read whatever is waiting without blocking
+        out = bytearray()
+        err = bytearray()
+        while True:
+            try:
+                (stream, data) = self.queueIn.get_nowait()
+            except (queue.Empty, AttributeError):
+                break
+            if stream == "out":
+                out.extend(data)
+            else:
+                err.extend(data)
+        return (out, err)
+
+    def update_command(self, q):
+        # Send whatever q has for the shell now
+        if not hasattr(q, "next_command"):
+            return
+        cmd = q.next_command()
+        if cmd:
+            self.write_command(cmd)
+
+    def close_connection(self):
+        self.shellPid = None
+        try:
+            self.process.terminate()
+            self.process = None
+        except:
+            pass
+
+    def create_process(self, acceptNew=False):
         self.process = subprocess.Popen(
-            self.get_local_command(),
+            self.get_local_command(acceptNew),
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             bufsize=0,
             close_fds=False,
-            **kwargs
+            **self.get_process_kwargs()
         )
-        self.queueErr = queue.Queue()
-        self.queueOut = queue.Queue()
+        # Both readers feed the one queue so we can block on it for whichever
+        # has something to say first
+        self.queueIn = queue.Queue()
+        self.reset_decoders()
         self.threadOut = threading.Thread(
             target=enqueue_output,
-            args=(self.process.stdout, self.queueOut)
+            args=(self.process.stdout, self.queueIn, "out")
         )
         self.threadErr = threading.Thread(
             target=enqueue_output,
-            args=(self.process.stderr, self.queueErr)
+            args=(self.process.stderr, self.queueIn, "err")
         )
         self.threadOut.daemon = True
         self.threadErr.daemon = True
@@ -444,37 +1018,104 @@ class RemoteEditConnectionWorker(threading.Thread):
         self.threadErr.start()
         return self.process
 
-    def get_bin_path(self):
-        if not self.binPath:
-            if self.platform == "windows":
-                self.binPath = os.path.join(
-                    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-                    "bin"
-                )
-            else:
-                self.binPath = "/usr/bin"
-        return self.binPath
 
-    def debug(self, data):
-        if len(data) > 3000:
-            print("%s[%s] %s: %s" % (
-                self.appType.upper(),
-                self.threadId,
-                time.strftime("%H:%M:%S"),
-                data[0:3000]
-            ))
-        else:
-            print("%s[%s] %s: %s" % (
-                self.appType.upper(),
-                self.threadId,
-                time.strftime("%H:%M:%S"),
-                data
-            ))
+def get_control_dir():
+    # Kept out of the /tmp/RemoteEdit folder as tidy_local_tmp_path() would
+    # happily delete the sockets, and somewhere only we can get at so that
+    # nobody else can swap the sockets for their own. Returns None, in which
+    # case we don't multiplex, if it isn't ours alone.
+    path = os.path.join(os.path.expanduser("~"), ".ssh", "RemoteEditCM")
+    try:
+        os.makedirs(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        log.warning("Unable to create %s, not multiplexing: %s", path, e, app="SSH")
+        return None
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        log.warning("Unable to check %s, not multiplexing: %s", path, e, app="SSH")
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        log.warning("%s isn't a folder of ours, not multiplexing", path, app="SSH")
+        return None
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        log.warning("%s must only be open to us, not multiplexing", path, app="SSH")
+        return None
+    return path
+
+
+def stop_control_master(settings, platform):
+    # Ask the ssh master for this server to exit. plink's connection sharing
+    # on Windows goes away by itself along with the last plink / psftp.
+    if platform == "windows" or not settings or not settings.get("multiplex"):
+        return False
+    if not get_control_dir():
+        return False
+    c = RemoteEditConnectionBase()
+    c.config(None, "ssh", None, platform)
+    c.work = {"settings": settings}
+    cmd = c.get_local_command()
+    cmd = cmd[0:-1] + ["-O", "exit", cmd[-1]]
+    try:
+        subprocess.call(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=5
+        )
+    except Exception as e:
+        c.warning("Error stopping control master: %s", e)
+        return False
+    return True
+
+
+def get_fast_ciphers(platform):
+    # The AEAD ciphers our ssh knows, quickest first, as a list for -c. AES-GCM
+    # wins where the CPU has AES instructions, chacha20 where it doesn't. The
+    # ctr ciphers go on the end so there's always one an older server has.
+    # None if we can't say (plink takes no -c).
+    if platform == "windows":
+        return None
+    c = RemoteEditConnectionBase()
+    c.config(None, "ssh", None, platform)
+    try:
+        known = subprocess.check_output(
+            [c.get_app_path(), "-Q", "cipher"],
+            stderr=subprocess.STDOUT,
+            timeout=5
+        ).decode("utf-8").split()
+    except Exception:
+        return None
+    gcm = ["aes128-gcm@openssh.com", "aes256-gcm@openssh.com"]
+    chacha = ["chacha20-poly1305@openssh.com"]
+    try:
+        with open("/proc/cpuinfo") as f:
+            hasAes = " aes" in f.read()
+    except (IOError, OSError):
+        # Not linux, anything recent enough to run Sublime has them
+        hasAes = True
+    ciphers = (gcm + chacha if hasAes else chacha + gcm) + ["aes128-ctr", "aes256-ctr"]
+    ciphers = [c for c in ciphers if c in known]
+    return ",".join(ciphers) or None
+
+
+def next_read_size(size, got):
+    # A full read means there's more waiting so read bigger chunks, back off
+    # again once the output slows to a trickle.
+    if got == size:
+        return min(size * 2, 65536)
+    elif got < size // 4:
+        return max(size // 2, 1024)
+    return size
 
 
-def enqueue_output(out, queue):
+def enqueue_output(out, queue, stream):
+    size = 1024
     while True:
-        line = out.read(1000)
-        queue.put(str(line, "utf-8", errors="ignore"))
-        if not len(line):
+        data = out.read(size)
+        queue.put((stream, data))
+        if not len(data):
             break
+        size = next_read_size(size, len(data))
@@ -0,0 +1,75 @@
+# coding=utf-8
+import threading
+
+
+# A handle on a queued command. RemoteEditConnector puts one in every work
+# dict as work["future"] and the worker that runs the command completes it
+# with the results dict (see RemoteEditConnectionWorker.respond).
+#
+# Anyone can block on result() or ask to be told once it's done with
+# add_done_callback. Done callbacks run on whichever thread completes the
+# future so should only hand the results on, RemoteEditDispatcher takes them
+# to the main thread.
+#
+# cancel() completes the future straight away with a failed result carrying
+# "cancelled". Workers skip cancelled work still on the queue and interrupt
+# it if it's already running and they can (an ssh shell), otherwise it runs
+# to the end with nobody to hear the results.
+
+
+class RemoteEditFuture(object):
+
+    key = None
+    results = None
+    cancelled = False
+    event = None
+    lock = None
+    callbacks = None
+
+    def __init__(self, key=None):
+        self.key = key
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def set_result(self, results):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.results = results
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def cancel(self):
+        # Returns False if it had already finished
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.cancelled = True
+        self.set_result({
+            "success": False,
+            "out": "",
+            "err": "",
+            "exit_status": None,
+            "cancelled": True
+        })
+        return True
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        # The results dict, None if it didn't turn up in time
+        if self.event.wait(timeout):
+            return self.results
+        return None
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
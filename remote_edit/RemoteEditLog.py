@@ -0,0 +1,138 @@
+# coding=utf-8
+import collections
+import logging
+import logging.handlers
+import threading
+import time
+
+
+# Leveled logging for the whole plugin, log below is the one everything
+# writes to. Messages are only formatted if their level is enabled so
+#
+#   log.debug("Got %s", data)
+#
+# costs next to nothing with debug off where "Got %s" % data would build the
+# string anyway. Check is_enabled before working out anything expensive
+# that's only wanted for the log.
+#
+# Enabled messages are cut to maxLength and kept in a ring buffer of the
+# last bufferLines (see RemoteEditCommand.run(action="log")), printed to the console
+# and, if configured with a logFile, written there too. The file is rotated
+# once it reaches maxBytes, keeping backups old ones.
+
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+OFF = 100
+
+LEVELS = {
+    "debug": DEBUG,
+    "info": INFO,
+    "warning": WARNING,
+    "error": ERROR,
+    "off": OFF
+}
+LEVEL_NAMES = dict([(v, k.upper()) for (k, v) in LEVELS.items()])
+
+
+class RemoteEditLog(object):
+
+    level = INFO
+    console = True
+    maxLength = 3000
+    buffer = None
+    logFile = None
+    fileLogger = None
+    lock = None
+
+    def __init__(self, level=INFO, bufferLines=1000):
+        self.level = level
+        self.buffer = collections.deque(maxlen=bufferLines)
+        self.lock = threading.Lock()
+
+    def configure(self, level="info", bufferLines=1000, logFile=None, maxBytes=1048576, backups=3, console=True):
+        self.level = LEVELS.get(str(level).lower(), INFO)
+        self.console = console
+        with self.lock:
+            if bufferLines != self.buffer.maxlen:
+                self.buffer = collections.deque(self.buffer, maxlen=bufferLines)
+            if logFile != self.logFile:
+                self.set_log_file(logFile, maxBytes, backups)
+
+    def set_log_file(self, logFile, maxBytes, backups):
+        # A logger of our own so that nothing else's handlers get our lines
+        logger = logging.getLogger("RemoteEdit")
+        logger.propagate = False
+        logger.setLevel(DEBUG)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        self.logFile = logFile
+        self.fileLogger = None
+        if not logFile:
+            return
+        try:
+            handler = logging.handlers.RotatingFileHandler(
+                logFile,
+                maxBytes=maxBytes,
+                backupCount=backups,
+                encoding="utf-8",
+                delay=True
+            )
+        except (IOError, OSError) as e:
+            print("RemoteEdit: Unable to log to %s: %s" % (logFile, e))
+            return
+        logger.addHandler(handler)
+        self.fileLogger = logger
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def write(self, level, app, msg, args=()):
+        if level < self.level:
+            return
+        if args:
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                msg = "%s %s" % (msg, args)
+        if len(msg) > self.maxLength:
+            msg = msg[0:self.maxLength]
+        line = "%s %s %s: %s" % (
+            app,
+            time.strftime("%H:%M:%S"),
+            LEVEL_NAMES.get(level, level),
+            msg
+        )
+        with self.lock:
+            self.buffer.append(line)
+            fileLogger = self.fileLogger
+        if self.console:
+            print(line)
+        if fileLogger:
+            fileLogger.log(level, line)
+
+    def debug(self, msg, *args, app="MAIN"):
+        self.write(DEBUG, app, msg, args)
+
+    def info(self, msg, *args, app="MAIN"):
+        self.write(INFO, app, msg, args)
+
+    def warning(self, msg, *args, app="MAIN"):
+        self.write(WARNING, app, msg, args)
+
+    def error(self, msg, *args, app="MAIN"):
+        self.write(ERROR, app, msg, args)
+
+    def lines(self):
+        with self.lock:
+            return list(self.buffer)
+
+    def clear(self):
+        with self.lock:
+            self.buffer.clear()
+
+
+log = RemoteEditLog()
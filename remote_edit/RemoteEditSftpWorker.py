@@ -0,0 +1,647 @@
+# coding=utf-8
+import os
+import posixpath
+import queue
+import stat
+import struct
+import time
+from .RemoteEditConnectionWorker import RemoteEditConnectionWorker
+
+
+# A worker (appType "sftpv3") that talks the SFTP version 3 protocol itself
+# over "ssh -s sftp" rather than driving the sftp binary and scraping its
+# output.
+#
+# It takes the same commands as the sftp workers (ls, get, put, rm, rmdir,
+# mkdir, rename, chmod plus stat) with paths escaped the same way, so work
+# dicts and results are as described in RemoteEditConnectionWorker. get can
+# also be given an offset and length to fetch a single range of the file
+# into the same place in the (existing) local file, or just an offset for
+# the rest of it (the local file then ends where the remote one does), with
+# work["progress"]
+# an optional dict that the bytes fetched so far are written to under
+# work["key"]. On top of those, ls and stat return:
+#   data["entries"] = list of dicts, one per file, each with name, longname,
+#       size, uid, gid, permissions (full st_mode), atime, mtime and, for
+#       symlinks, link_dest (absolute path)
+#
+# Unlike the sftp binary we know for sure when a command has failed, so a
+# single command that fails has success set to False. Batches are still
+# successful as a whole with each command's exit_status telling its story.
+#
+# get and put keep many reads / writes in flight at once rather than waiting
+# on each in turn.
+
+
+SSH_FXP_INIT = 1
+SSH_FXP_VERSION = 2
+SSH_FXP_OPEN = 3
+SSH_FXP_CLOSE = 4
+SSH_FXP_READ = 5
+SSH_FXP_WRITE = 6
+SSH_FXP_LSTAT = 7
+SSH_FXP_SETSTAT = 9
+SSH_FXP_OPENDIR = 11
+SSH_FXP_READDIR = 12
+SSH_FXP_REMOVE = 13
+SSH_FXP_MKDIR = 14
+SSH_FXP_RMDIR = 15
+SSH_FXP_STAT = 17
+SSH_FXP_RENAME = 18
+SSH_FXP_READLINK = 19
+SSH_FXP_STATUS = 101
+SSH_FXP_HANDLE = 102
+SSH_FXP_DATA = 103
+SSH_FXP_NAME = 104
+SSH_FXP_ATTRS = 105
+
+SSH_FX_OK = 0
+SSH_FX_EOF = 1
+SSH_FX_NO_SUCH_FILE = 2
+SSH_FX_PERMISSION_DENIED = 3
+
+SSH_FILEXFER_ATTR_SIZE = 0x00000001
+SSH_FILEXFER_ATTR_UIDGID = 0x00000002
+SSH_FILEXFER_ATTR_PERMISSIONS = 0x00000004
+SSH_FILEXFER_ATTR_ACMODTIME = 0x00000008
+SSH_FILEXFER_ATTR_EXTENDED = 0x80000000
+
+SSH_FXF_READ = 0x00000001
+SSH_FXF_WRITE = 0x00000002
+SSH_FXF_CREAT = 0x00000008
+SSH_FXF_TRUNC = 0x00000010
+
+# Worded the same as ls / the sftp binary as that's what callers look for
+STATUS_MESSAGES = {
+    SSH_FX_NO_SUCH_FILE: "No such file or directory",
+    SSH_FX_PERMISSION_DENIED: "Permission denied"
+}
+
+
+class SftpError(Exception):
+
+    def __init__(self, msg, code=None):
+        Exception.__init__(self, msg)
+        self.code = code
+
+
+class SftpConnectionError(Exception):
+    pass
+
+
+class SftpSession(object):
+    # The protocol itself. Knows nothing about processes, just needs a
+    # function to write bytes and one that returns exactly n bytes.
+
+    write = None
+    read = None
+    requestId = 0
+    version = None
+    # Reads / writes of this size kept in flight during get / put
+    chunkSize = 32768
+    maxRequests = 32
+
+    def __init__(self, write, read):
+        self.write = write
+        self.read = read
+
+    def init(self):
+        self.write(self.packet(SSH_FXP_INIT, struct.pack(">I", 3)))
+        (t, data) = self.read_packet()
+        if t != SSH_FXP_VERSION:
+            raise SftpConnectionError("Unexpected reply to init: %s" % t)
+        self.version = struct.unpack(">I", data[0:4])[0]
+        return self.version
+
+    def packet(self, t, payload):
+        return struct.pack(">IB", len(payload) + 1, t) + payload
+
+    def send(self, t, payload=b""):
+        # Returns the request id so the caller can match up the reply
+        self.requestId = (self.requestId + 1) & 0xFFFFFFFF
+        self.write(self.packet(t, struct.pack(">I", self.requestId) + payload))
+        return self.requestId
+
+    def read_packet(self):
+        length = struct.unpack(">I", self.read(4))[0]
+        data = self.read(length)
+        return (data[0], data[1:])
+
+    def receive(self):
+        # Returns (request id, type, reader for the rest of the reply)
+        (t, data) = self.read_packet()
+        r = SftpReader(data)
+        return (r.uint32(), t, r)
+
+    def request(self, t, payload=b""):
+        # Send a single request and wait on its reply
+        rid = self.send(t, payload)
+        while True:
+            (replyId, replyType, r) = self.receive()
+            if replyId == rid:
+                return (replyType, r)
+
+    def check_status(self, t, r, okCodes=(SSH_FX_OK,)):
+        if t != SSH_FXP_STATUS:
+            raise SftpError("Unexpected reply type %s" % t)
+        code = r.uint32()
+        if code not in okCodes:
+            raise SftpError(self.status_message(code, r), code)
+        return code
+
+    def status_message(self, code, r):
+        if code in STATUS_MESSAGES:
+            return STATUS_MESSAGES[code]
+        try:
+            return r.string().decode("utf-8", "replace") or "Failure"
+        except Exception:
+            return "Failure"
+
+    def expect(self, t, r, wanted):
+        if t == SSH_FXP_STATUS:
+            self.check_status(t, r, ())
+        if t != wanted:
+            raise SftpError("Unexpected reply type %s" % t)
+        return r
+
+    def path(self, p):
+        return string(p.encode("utf-8"))
+
+    def stat(self, p, follow=True):
+        (t, r) = self.request(
+            SSH_FXP_STAT if follow else SSH_FXP_LSTAT,
+            self.path(p)
+        )
+        return self.expect(t, r, SSH_FXP_ATTRS).attrs()
+
+    def readlink(self, p):
+        (t, r) = self.request(SSH_FXP_READLINK, self.path(p))
+        r = self.expect(t, r, SSH_FXP_NAME)
+        r.uint32()
+        return r.string().decode("utf-8", "replace")
+
+    def listdir(self, p):
+        # Returns a list of entry dicts, see the top of the file
+        (t, r) = self.request(SSH_FXP_OPENDIR, self.path(p))
+        handle = self.expect(t, r, SSH_FXP_HANDLE).string()
+        entries = []
+        try:
+            while True:
+                (t, r) = self.request(SSH_FXP_READDIR, string(handle))
+                if t == SSH_FXP_STATUS:
+                    self.check_status(t, r, (SSH_FX_EOF,))
+                    break
+                r = self.expect(t, r, SSH_FXP_NAME)
+                for i in range(r.uint32()):
+                    name = r.string().decode("utf-8", "replace")
+                    longname = r.string().decode("utf-8", "replace")
+                    entry = r.attrs()
+                    if name in (".", ".."):
+                        continue
+                    entry["name"] = name
+                    entry["longname"] = longname
+                    entries.append(entry)
+        finally:
+            self.close(handle)
+        self.resolve_links(p, entries)
+        return entries
+
+    def resolve_links(self, p, entries):
+        # Fire off every readlink at once then collect the answers
+        pending = {}
+        for e in entries:
+            if stat.S_ISLNK(e.get("permissions", 0)):
+                rid = self.send(
+                    SSH_FXP_READLINK,
+                    self.path(posixpath.join(p, e["name"]))
+                )
+                pending[rid] = e
+        while pending:
+            (rid, t, r) = self.receive()
+            e = pending.pop(rid, None)
+            if e is None or t != SSH_FXP_NAME:
+                continue
+            r.uint32()
+            dest = r.string().decode("utf-8", "replace")
+            e["link_dest"] = posixpath.normpath(posixpath.join(p, dest))
+
+    def close(self, handle):
+        (t, r) = self.request(SSH_FXP_CLOSE, string(handle))
+        self.check_status(t, r)
+
+    def simple(self, t, payload):
+        (t, r) = self.request(t, payload)
+        self.check_status(t, r)
+
+    def remove(self, p):
+        self.simple(SSH_FXP_REMOVE, self.path(p))
+
+    def rmdir(self, p):
+        self.simple(SSH_FXP_RMDIR, self.path(p))
+
+    def mkdir(self, p):
+        self.simple(SSH_FXP_MKDIR, self.path(p) + struct.pack(">I", 0))
+
+    def rename(self, src, dest):
+        self.simple(SSH_FXP_RENAME, self.path(src) + self.path(dest))
+
+    def chmod(self, p, mode):
+        self.simple(
+            SSH_FXP_SETSTAT,
+            self.path(p) + struct.pack(">II", SSH_FILEXFER_ATTR_PERMISSIONS, mode)
+        )
+
+    def open(self, p, flags):
+        (t, r) = self.request(
+            SSH_FXP_OPEN,
+            self.path(p) + struct.pack(">II", flags, 0)
+        )
+        return self.expect(t, r, SSH_FXP_HANDLE).string()
+
+    def get(self, remote, local, offset=0, length=None, progress=None):
+        # Keeps up to maxRequests reads outstanding. Replies may come back in
+        # any order so each is written at its own offset. Fetches from offset
+        # to the end of the file, or length bytes if given. progress is
+        # called with the running total as data arrives.
+        handle = self.open(remote, SSH_FXF_READ)
+        end = offset + length if length is not None else None
+        ranged = offset or length is not None
+        got = 0
+        if ranged and not os.path.exists(local):
+            open(local, "wb").close()
+        try:
+            # Only part of the file, leave the rest of local alone
+            with open(local, "r+b" if ranged else "wb") as f:
+                pending = {}
+                nextOffset = offset
+                eof = False
+                while True:
+                    while not eof and len(pending) < self.maxRequests and (end is None or nextOffset < end):
+                        size = self.chunkSize
+                        if end is not None:
+                            size = min(size, end - nextOffset)
+                        rid = self.send(
+                            SSH_FXP_READ,
+                            string(handle) + struct.pack(">QI", nextOffset, size)
+                        )
+                        pending[rid] = (nextOffset, size)
+                        nextOffset += size
+                    if not pending:
+                        break
+                    (rid, t, r) = self.receive()
+                    if rid not in pending:
+                        continue
+                    (at, size) = pending.pop(rid)
+                    if t == SSH_FXP_STATUS:
+                        self.check_status(t, r, (SSH_FX_EOF,))
+                        eof = True
+                        continue
+                    data = self.expect(t, r, SSH_FXP_DATA).string()
+                    f.seek(at)
+                    f.write(data)
+                    got += len(data)
+                    if progress:
+                        progress(got)
+                    if data and len(data) < size:
+                        # Short read, ask again for the rest
+                        rid = self.send(
+                            SSH_FXP_READ,
+                            string(handle) + struct.pack(
+                                ">QI",
+                                at + len(data),
+                                size - len(data)
+                            )
+                        )
+                        pending[rid] = (at + len(data), size - len(data))
+                if ranged and end is None:
+                    # The last range, the file ends where the server's does
+                    f.truncate(offset + got)
+        finally:
+            self.close(handle)
+        if length is not None and got < length:
+            # Shorter than it was when we were asked for the range
+            raise SftpError("End of file after %s of %s bytes" % (got, length))
+        return got
+
+    def put(self, local, remote):
+        # As get, up to maxRequests writes in flight
+        handle = self.open(remote, SSH_FXF_WRITE | SSH_FXF_CREAT | SSH_FXF_TRUNC)
+        sent = 0
+        try:
+            with open(local, "rb") as f:
+                pending = set()
+                done = False
+                while True:
+                    while not done and len(pending) < self.maxRequests:
+                        data = f.read(self.chunkSize)
+                        if not data:
+                            done = True
+                            break
+                        pending.add(self.send(
+                            SSH_FXP_WRITE,
+                            string(handle) + struct.pack(">Q", sent) + string(data)
+                        ))
+                        sent += len(data)
+                    if not pending:
+                        break
+                    (rid, t, r) = self.receive()
+                    if rid in pending:
+                        pending.discard(rid)
+                        self.check_status(t, r)
+        finally:
+            self.close(handle)
+        return sent
+
+
+class SftpReader(object):
+    # Picks apart the payload of a reply
+
+    data = None
+    pos = 0
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def uint32(self):
+        v = struct.unpack(">I", self.data[self.pos:self.pos + 4])[0]
+        self.pos += 4
+        return v
+
+    def uint64(self):
+        v = struct.unpack(">Q", self.data[self.pos:self.pos + 8])[0]
+        self.pos += 8
+        return v
+
+    def string(self):
+        length = self.uint32()
+        v = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return bytes(v)
+
+    def attrs(self):
+        a = {}
+        flags = self.uint32()
+        if flags & SSH_FILEXFER_ATTR_SIZE:
+            a["size"] = self.uint64()
+        if flags & SSH_FILEXFER_ATTR_UIDGID:
+            a["uid"] = self.uint32()
+            a["gid"] = self.uint32()
+        if flags & SSH_FILEXFER_ATTR_PERMISSIONS:
+            a["permissions"] = self.uint32()
+        if flags & SSH_FILEXFER_ATTR_ACMODTIME:
+            a["atime"] = self.uint32()
+            a["mtime"] = self.uint32()
+        if flags & SSH_FILEXFER_ATTR_EXTENDED:
+            for i in range(self.uint32()):
+                self.string()
+                self.string()
+        return a
+
+
+class RemoteEditSftpWorker(RemoteEditConnectionWorker):
+
+    session = None
+    inBuf = None
+
+    def run_command(self, cmd, checkReturn=None, acceptNew=False, q=None):
+        self.hostUnknown = False
+        self.exitStatus = None
+        self.batchResults = None
+        self.entries = None
+        self.serverName = self.work["server_name"]
+        cmds = cmd if isinstance(cmd, list) else [cmd]
+        responses = None
+        self.attempt = 0
+        # The same back off and replay as the other workers should the
+        # connection drop on us
+        while True:
+            if not self.reconnect(acceptNew):
+                return False
+            try:
+                responses = [self.run_sftp(c) for c in cmds]
+                break
+            except SftpConnectionError as e:
+                self.warning("Lost connection: %s", e)
+                self.close_connection()
+            if not self.is_idempotent(cmd):
+                break
+            delay = self.retry_delay()
+            if delay is None:
+                break
+            time.sleep(delay)
+        if responses is None:
+            return False
+        if isinstance(cmd, list):
+            self.batchResults = responses
+            self.lastOut = "".join([r["out"] for r in responses])
+            self.lastErr = "".join([r["err"] for r in responses])
+        else:
+            self.lastOut = responses[-1]["out"]
+            self.lastErr = responses[-1]["err"]
+            self.entries = responses[-1]["entries"]
+        self.exitStatus = responses[-1]["exit_status"]
+        self.log_response()
+        if self.exitStatus and not isinstance(cmd, list):
+            return False
+        if checkReturn is not None and checkReturn not in self.lastOut:
+            self.debug("Expected return data not found")
+            return False
+        return True
+
+    def run_sftp(self, cmd):
+        self.debug("Running: %s", cmd)
+        response = {"out": "", "err": "", "exit_status": 0, "entries": None}
+        args = split_args(cmd)
+        try:
+            if not args:
+                pass
+            elif args[0] == "ls" or args[0] == "stat":
+                response["entries"] = self.ls(args[-1], args[0] == "stat")
+                response["out"] = "".join(
+                    ["%s\n" % e["longname"] for e in response["entries"]]
+                )
+            elif args[0] == "get":
+                # get remote local [offset [length]] fetches just that range,
+                # to the end of the file without a length
+                self.session.get(
+                    args[1],
+                    args[2],
+                    int(args[3]) if len(args) > 3 else 0,
+                    int(args[4]) if len(args) > 4 else None,
+                    self.report_progress
+                )
+            elif args[0] == "put":
+                self.session.put(args[1], args[2])
+            elif args[0] == "rm":
+                self.session.remove(args[1])
+            elif args[0] == "rmdir":
+                self.session.rmdir(args[1])
+            elif args[0] == "mkdir":
+                self.session.mkdir(args[1])
+            elif args[0] == "rename":
+                self.session.rename(args[1], args[2])
+            elif args[0] == "chmod":
+                self.session.chmod(args[2], int(args[1], 8))
+            else:
+                raise SftpError("Unsupported command: %s" % args[0])
+        except struct.error as e:
+            # A short or garbled packet, we can't trust what follows it.
+            # run_command drops the session so the next command reconnects.
+            raise SftpConnectionError("Bad packet: %s" % e)
+        except (SftpError, IOError, OSError, ValueError, IndexError) as e:
+            response["err"] = "%s: %s\n" % (args[-1] if args else "", e)
+            response["exit_status"] = getattr(e, "code", None) or 1
+        return response
+
+    def report_progress(self, got):
+        # work["progress"] is an optional dict shared with whoever queued the
+        # work, bytes transferred so far go in it under our key
+        self.transferred = got
+        if self.work.get("progress") is not None:
+            self.work["progress"][self.work["key"]] = got
+
+    def ls(self, path, statOnly=False):
+        if not statOnly:
+            try:
+                return self.session.listdir(path)
+            except SftpError as e:
+                # Either it doesn't exist or it isn't a folder, stat it to
+                # find out which
+                entry = self.session.stat(path.rstrip("/") or "/", follow=False)
+                if stat.S_ISDIR(entry.get("permissions", 0)):
+                    raise e
+                raise SftpError("Not a directory")
+        entry = self.session.stat(path.rstrip("/") or "/", follow=False)
+        entry["name"] = posixpath.basename(path.rstrip("/"))
+        entry["longname"] = entry["name"]
+        return [entry]
+
+    def connect(self, acceptNew):
+        try:
+            if self.process.poll() is None and self.session:
+                self.debug(":o) Polling ok, process alive and well")
+                return True
+        except Exception as e:
+            self.debug("Process not running: %s", e)
+        self.create_process(acceptNew)
+        if acceptNew and self.platform == "windows":
+            self.write_bytes(b"y\n")
+        self.inBuf = bytearray()
+        self.reset_response()
+        self.session = SftpSession(self.write_bytes, self.read_bytes)
+        try:
+            self.session.init()
+        except (SftpConnectionError, SftpError, struct.error, IndexError) as e:
+            self.decode_response()
+            if "host key is not cached" in self.lastErr:
+                self.hostUnknown = True
+            self.warning("Connect failed: %s %s", e, self.lastErr)
+            self.close_connection()
+            return False
+        self.debug("Connection OK, SFTP version %s", self.session.version)
+        return True
+
+    def keep_alive(self):
+        # As RemoteEditConnectionWorker.keep_alive but in packets
+        if not self.session or not self.work:
+            return
+        self.debug("Keep alive")
+        self.work = dict(
+            self.work,
+            expire_at=time.time() + self.keepAliveTimeout,
+            future=None,
+            timings=None
+        )
+        try:
+            self.session.stat(".")
+            return
+        except SftpError:
+            return
+        except (SftpConnectionError, struct.error) as e:
+            self.info("Keep alive failed, reconnecting: %s", e)
+        self.close_connection()
+        self.connect(False)
+
+    def write_bytes(self, data):
+        try:
+            self.process.stdin.write(data)
+        except Exception as e:
+            raise SftpConnectionError("Write failed: %s" % e)
+
+    def read_bytes(self, n):
+        # Block on the reader threads until we have n bytes of stdout. stderr
+        # is kept to report on should the connection fail.
+        while len(self.inBuf) < n:
+            if self.is_cancelled():
+                # Replies to whatever we have outstanding would follow us
+                # into the next command, there's no saving the connection
+                raise SftpConnectionError("Cancelled")
+            remaining = self.work["expire_at"] - time.time()
+            if remaining <= 0:
+                raise SftpConnectionError("Timed out")
+            try:
+                (stream, data) = self.queueIn.get(timeout=min(remaining, 1))
+            except queue.Empty:
+                continue
+            if stream == "err":
+                self.add_response("err", data)
+            elif data:
+                self.stamp("first_byte", after="connected")
+                self.inBuf.extend(data)
+            else:
+                raise SftpConnectionError("Connection closed")
+        data = bytes(self.inBuf[0:n])
+        del self.inBuf[0:n]
+        return data
+
+    def close_connection(self):
+        self.session = None
+        RemoteEditConnectionWorker.close_connection(self)
+
+
+def split_args(cmd):
+    # Undo RemoteEditCommand.escape_remote_path, paths with spaces come
+    # wrapped in double quotes with any quotes inside doubled up
+    args = []
+    current = ""
+    quoted = False
+    inArg = False
+    i = 0
+    while i < len(cmd):
+        c = cmd[i]
+        if c == "\"" and not inArg:
+            # Quotes starting a path are doubled up ones, bar the one that
+            # opens a quoted path, so an odd number means it's quoted
+            n = len(cmd[i:]) - len(cmd[i:].lstrip("\""))
+            current += "\"" * (n // 2)
+            quoted = n % 2 == 1
+            inArg = True
+            i += n - 1
+        elif c == "\"":
+            if quoted and cmd[i + 1:i + 2] == "\"":
+                current += "\""
+                i += 1
+            elif not quoted and cmd[i + 1:i + 2] == "\"":
+                # Doubled quote in an unquoted path
+                current += "\""
+                i += 1
+            else:
+                quoted = not quoted
+        elif c in " \t" and not quoted:
+            if inArg:
+                args.append(current)
+            current = ""
+            inArg = False
+        else:
+            current += c
+            inArg = True
+        i += 1
+    if inArg:
+        args.append(current)
+    # ls flags mean nothing to us
+    return [a for a in args if not (args[0] == "ls" and a[0:1] == "-")]
+
+
+def string(data):
+    return struct.pack(">I", len(data)) + data
@@ -0,0 +1,124 @@
+# coding=utf-8
+import collections
+import json
+import threading
+import time
+
+
+# Where the time goes. Each work dict gathers timestamps in work["timings"]
+# as it goes through the connector and a worker:
+#   enqueued = put on a pool / the engine's queue
+#   dequeued = picked up by a worker
+#   connected = the worker has a connection to run it on
+#   first_byte = the first of the response arrived
+#   complete = the worker has finished with it
+#   callback = the callback has been fired (callback work only)
+# and work["bytes"] is the size of the response / transfer.
+#
+# record() turns those into per stage durations, kept per server and command
+# type (appType plus the first word of the command) for the last maxSamples
+# commands of each.
+
+
+# (stage, from, to), to of None is whichever happened last
+STAGES = [
+    ("queue", "enqueued", "dequeued"),
+    ("connect", "dequeued", "connected"),
+    ("first_byte", "connected", "first_byte"),
+    ("execute", "connected", "complete"),
+    ("callback", "complete", "callback"),
+    ("total", "enqueued", None)
+]
+
+
+class RemoteEditStats(object):
+
+    samples = None
+    counts = None
+    maxSamples = 1000
+    lock = None
+    startedAt = None
+
+    def __init__(self, maxSamples=1000):
+        self.maxSamples = maxSamples
+        self.samples = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.startedAt = time.time()
+
+    def record(self, work):
+        timings = work.get("timings")
+        if not timings or "enqueued" not in timings:
+            return
+        key = (work.get("server_name"), self.get_command_type(work))
+        last = max(timings.values())
+        with self.lock:
+            if key not in self.samples:
+                self.samples[key] = dict([
+                    (s[0], collections.deque(maxlen=self.maxSamples))
+                    for s in STAGES + [("bytes", None, None)]
+                ])
+                self.counts[key] = 0
+            self.counts[key] += 1
+            for (stage, start, end) in STAGES:
+                endAt = last if end is None else timings.get(end)
+                if start in timings and endAt is not None:
+                    self.samples[key][stage].append(endAt - timings[start])
+            if work.get("bytes") is not None:
+                self.samples[key]["bytes"].append(work["bytes"])
+
+    def get_command_type(self, work):
+        cmd = work.get("cmd")
+        if isinstance(cmd, list):
+            name = "batch"
+        else:
+            words = (cmd or "").split()
+            name = words[0] if words else "(connect)"
+        return "%s:%s" % (work.get("app_type"), name)
+
+    def summary(self):
+        # A list of dicts, one per server and command type, busiest first.
+        # Times in ms.
+        with self.lock:
+            keys = sorted(self.samples, key=lambda k: -self.counts[k])
+            summary = []
+            for key in keys:
+                stages = {}
+                for (stage, samples) in self.samples[key].items():
+                    if not samples:
+                        continue
+                    scale = 1 if stage == "bytes" else 1000
+                    stages[stage] = self.percentiles(
+                        [s * scale for s in samples]
+                    )
+                summary.append({
+                    "server": key[0],
+                    "command": key[1],
+                    "count": self.counts[key],
+                    "stages": stages
+                })
+            return summary
+
+    def percentiles(self, samples):
+        samples = sorted(samples)
+        n = len(samples)
+        return {
+            "p50": samples[int(n * 0.5)],
+            "p95": samples[min(n - 1, int(n * 0.95))],
+            "p99": samples[min(n - 1, int(n * 0.99))],
+            "max": samples[-1],
+            "samples": n
+        }
+
+    def to_json(self):
+        return json.dumps({
+            "since": self.startedAt,
+            "generated": time.time(),
+            "stats": self.summary()
+        }, indent=4, sort_keys=True)
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.counts = {}
+            self.startedAt = time.time()
@@ -0,0 +1,303 @@
+# coding=utf-8
+import threading
+import queue
+import time
+import collections
+
+
+# A pool of worker threads of one appType sharing a queue. Starts with
+# minWorkers and adds another whenever work is waiting with nobody free to
+# take it (or has waited longer than maxWait), up to maxWorkers or the
+# server's "max_connections" setting. Workers that sit idle for idleTimeout
+# seconds retire themselves until we're back down to minWorkers.
+#
+# Work with a queue (tails) runs forever so gets a worker of its own that
+# doesn't count towards the cap and goes away once it's done.
+#
+# RemoteEditConnector keeps a pool per server so workers stay connected to
+# the one host. If evictAfter is set the last minWorkers go too once the
+# pool has had nothing to do for that long.
+#
+# Work is taken in priority order, see RemoteEditWorkQueue. With
+# reserveInteractive one extra worker is kept back for interactive work only
+# so the user is never stuck behind a catalogue build.
+#
+# With keepAlive set, workers waiting for work check their connection every
+# keepAlive seconds (see RemoteEditConnectionWorker.keep_alive) so it's
+# never found dead when work does turn up.
+
+
+# work["priority"], highest first
+PRIORITIES = {
+    "interactive": 0,
+    "normal": 1,
+    "background": 2
+}
+
+
+class RemoteEditWorkerPool(object):
+
+    appType = None
+    serverName = None
+    workerClass = None
+    queue = None
+    platform = None
+    workers = None
+    minWorkers = 1
+    maxWorkers = 4
+    idleTimeout = 60
+    maxWait = 0.5
+    evictAfter = None
+    reserveInteractive = False
+    keepAlive = None
+    lastUsed = 0
+    busy = 0
+    running = None
+    nextId = 0
+    lock = None
+
+    def __init__(self, appType, workerClass, platform, minWorkers=1, maxWorkers=4, idleTimeout=60, serverName=None, evictAfter=None, reserveInteractive=False, keepAlive=None):
+        self.appType = appType
+        self.serverName = serverName
+        self.evictAfter = evictAfter
+        self.lastUsed = time.time()
+        self.workerClass = workerClass
+        self.platform = platform
+        self.minWorkers = minWorkers
+        self.maxWorkers = max(maxWorkers, minWorkers, 1)
+        self.idleTimeout = idleTimeout
+        self.queue = RemoteEditWorkQueue()
+        self.workers = []
+        self.running = []
+        self.lock = threading.Lock()
+        self.reserveInteractive = reserveInteractive
+        self.keepAlive = keepAlive
+        if reserveInteractive:
+            self.spawn(reserved=True)
+        for i in range(minWorkers):
+            self.spawn()
+
+    def put(self, work):
+        work["queued_at"] = self.lastUsed = time.time()
+        if work.get("queue"):
+            work["started_at"] = work["queued_at"]
+            return self.spawn(work)
+        self.queue.put(work)
+        self.scale(work)
+
+    def get_work(self, worker):
+        # Blocks for up to idleTimeout, raising queue.Empty if nothing came.
+        # Stops on the way to ping the connection whenever worker.nextPingAt
+        # comes round. That carries over from one call to the next, so a
+        # worker kept on after idleTimeout (keepAlive no shorter than it say)
+        # is still pinged.
+        giveUpAt = time.time() + self.idleTimeout
+        while True:
+            now = time.time()
+            timeout = giveUpAt - now
+            if self.keepAlive:
+                if worker.nextPingAt is None:
+                    worker.nextPingAt = now + self.keepAlive
+                timeout = min(timeout, worker.nextPingAt - now)
+            try:
+                work = self.queue.get(
+                    timeout=max(timeout, 0),
+                    interactiveOnly=worker.reserved
+                )
+                # The work keeps the connection busy, count from when it's done
+                worker.nextPingAt = None
+                return work
+            except queue.Empty:
+                now = time.time()
+                if self.keepAlive and now >= worker.nextPingAt:
+                    worker.keep_alive()
+                    worker.nextPingAt = time.time() + self.keepAlive
+                if now >= giveUpAt:
+                    raise
+
+    def get_shared(self):
+        return [w for w in self.workers if not w.dedicated and not w.reserved]
+
+    def scale(self, work=None):
+        with self.lock:
+            shared = self.get_shared()
+            idle = len(shared) - self.busy
+            if self.queue.qsize() > idle and len(shared) < self.get_cap(work):
+                self.spawn()
+
+    def get_cap(self, work=None):
+        try:
+            return int(work["settings"]["max_connections"])
+        except (KeyError, TypeError, ValueError):
+            return self.maxWorkers
+
+    def spawn(self, work=None, reserved=False):
+        worker = self.workerClass()
+        worker.daemon = True
+        worker.config(
+            self.nextId,
+            self.appType,
+            self.queue,
+            self.platform
+        )
+        worker.pool = self
+        worker.dedicated = work is not None
+        worker.reserved = reserved
+        worker.work = work
+        self.nextId += 1
+        self.workers.append(worker)
+        worker.start()
+        return worker
+
+    def work_started(self, worker):
+        # Called by a worker as it picks up work from the queue
+        worker.work["started_at"] = time.time()
+        with self.lock:
+            self.running.append(worker.work)
+            if worker.reserved:
+                return
+            self.busy += 1
+        waited = time.time() - worker.work.get("queued_at", time.time())
+        if waited > self.maxWait and not self.queue.empty():
+            self.scale(worker.work)
+
+    def work_finished(self, worker):
+        with self.lock:
+            self.running.remove(worker.work)
+            if not worker.reserved:
+                self.busy -= 1
+            self.lastUsed = time.time()
+
+    def retire(self, worker):
+        # Called by a worker that's been idle for idleTimeout, returns True if
+        # it should go
+        with self.lock:
+            shared = self.get_shared()
+            if self.is_idle() or worker.dedicated or (not worker.reserved and len(shared) > self.minWorkers):
+                self.workers.remove(worker)
+                return True
+        return False
+
+    def remove(self, worker):
+        # For a worker that can't carry on
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+        if worker.reserved:
+            self.spawn(reserved=True)
+        self.scale()
+
+    def is_idle(self):
+        return (
+            self.evictAfter is not None and
+            not self.busy and
+            time.time() - self.lastUsed > self.evictAfter
+        )
+
+    def is_empty(self):
+        with self.lock:
+            return not self.workers and self.queue.empty()
+
+    def stats(self):
+        with self.lock:
+            shared = self.get_shared()
+            return {
+                "app_type": self.appType,
+                "server": self.serverName,
+                "size": len(shared),
+                "dedicated": len([w for w in self.workers if w.dedicated]),
+                "reserved": len([w for w in self.workers if w.reserved]),
+                "busy": self.busy,
+                "queued": self.queue.qsize(),
+                "utilisation": float(self.busy) / len(shared) if shared else 0.0
+            }
+
+    def jobs(self):
+        # Work dicts that are running (tails included) then those queued
+        with self.lock:
+            running = self.running + [w.work for w in self.workers if w.dedicated]
+        return running + self.queue.items()
+
+    def stop(self):
+        with self.lock:
+            workers = self.workers
+            self.workers = []
+        for worker in workers:
+            worker.stop()
+            # Wake it up if it's waiting on the queue
+            self.queue.put(None)
+
+
+class RemoteEditWorkQueue(object):
+    # Hands out the highest priority work first, oldest first within each
+    # class. So that background work still gets done while the user is busy,
+    # every starveAfter seconds an item has waited counts as one class higher.
+    # put(None) wakes a single waiting worker with nothing to do.
+
+    queues = None
+    cond = None
+    wakeUps = 0
+    starveAfter = 10
+
+    def __init__(self, starveAfter=10):
+        self.starveAfter = starveAfter
+        self.queues = dict([(p, collections.deque()) for p in PRIORITIES.values()])
+        self.cond = threading.Condition()
+
+    def put(self, work):
+        with self.cond:
+            if work is None:
+                self.wakeUps += 1
+            else:
+                self.queues[PRIORITIES.get(work.get("priority"), 1)].append(work)
+            self.cond.notify_all()
+
+    def get(self, timeout=None, interactiveOnly=False):
+        giveUpAt = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                if self.wakeUps:
+                    self.wakeUps -= 1
+                    return None
+                work = self.take(interactiveOnly)
+                if work is not None:
+                    return work
+                if giveUpAt is None:
+                    self.cond.wait()
+                else:
+                    remaining = giveUpAt - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.cond.wait(remaining)
+
+    def take(self, interactiveOnly=False):
+        now = time.time()
+        best = None
+        for p in sorted(self.queues):
+            q = self.queues[p]
+            if not q or (interactiveOnly and p != PRIORITIES["interactive"]):
+                continue
+            waited = now - q[0].get("queued_at", now)
+            effective = p - int(waited / self.starveAfter)
+            if best is None or effective < best[0]:
+                best = (effective, p)
+        if best is None:
+            return None
+        return self.queues[best[1]].popleft()
+
+    def items(self):
+        with self.cond:
+            queued = []
+            for p in sorted(self.queues):
+                queued.extend(self.queues[p])
+            return queued
+
+    def qsize(self):
+        with self.cond:
+            return sum([len(q) for q in self.queues.values()])
+
+    def empty(self):
+        return not self.qsize()
+
+    def task_done(self):
+        pass
@@ -0,0 +1,168 @@
+# coding=utf-8
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from remote_edit import RemoteEditCompactCat  # noqa: E402
+
+
+# Unit tests for the pure Python parts of the plugin, run from the top of
+# the repo with
+#
+#   python3 -m unittest discover tests
+#
+# No Sublime Text or server needed, see bench/ for end to end runs.
+
+
+def make_cat():
+    return {
+        "/CAT_DATA/": {"users": {0: "root"}, "groups": {0: "root"}},
+        "/": [2, 0o755, 0, 0, 4096, 100],
+        "etc": {
+            "/": [2, 0o755, 0, 0, 4096, 200],
+            "hosts": {"/": [1, 0o644, 0, 0, 12, 300]},
+            "link": {"/": [3, 0o777, 0, 0, 5, 400, "/etc/hosts"]}
+        },
+        "home": {
+            "/": [2, 0o755, 0, 0, 4096, 500],
+            "/NO_INDEX/": True
+        },
+        "café menu.txt": {"/": [1, 0o600, 0, 0, 1, 600]}
+    }
+
+
+class RemoteEditCompactCatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "server.cat")
+        self.opened = []
+
+    def tearDown(self):
+        for compact in self.opened:
+            compact.close()
+        shutil.rmtree(self.dir)
+
+    def load(self, path=None):
+        compact = RemoteEditCompactCat.RemoteEditCompactCat.load(path or self.path)
+        self.opened.append(compact)
+        return compact
+
+    def save(self, cat=None):
+        compact = RemoteEditCompactCat.RemoteEditCompactCat.build(cat or make_cat())
+        compact.save(self.path)
+
+    def damage(self, at, path=None):
+        # Flip the bits of the byte at, from the end if negative
+        with open(self.path, "rb") as f:
+            data = bytearray(f.read())
+        data[at] ^= 0xff
+        with open(path or self.path, "wb") as f:
+            f.write(data)
+
+    def test_reads_like_the_dict(self):
+        self.save()
+        root = self.load().root()
+        self.assertEqual(root["etc"]["hosts"]["/"], [1, 0o644, 0, 0, 12, 300])
+        self.assertEqual(root["etc"]["link"]["/"][6], "/etc/hosts")
+        self.assertEqual(root["café menu.txt"]["/"][1], 0o600)
+        self.assertTrue(root["home"]["/NO_INDEX/"])
+        self.assertNotIn("/NO_INDEX/", root["etc"])
+        self.assertEqual(root["/CAT_DATA/"]["users"], {"0": "root"})
+        self.assertEqual(
+            sorted(root),
+            sorted(["/", "/CAT_DATA/", "etc", "home", "café menu.txt"])
+        )
+        self.assertNotIn("missing", root)
+        with self.assertRaises(KeyError):
+            root["missing"]
+
+    def test_changes_thaw_nodes(self):
+        self.save()
+        root = self.load().root()
+        root["etc"]["passwd"] = {"/": [1, 0o644, 0, 0, 1, 1]}
+        del root["etc"]["hosts"]
+        self.assertEqual(sorted(root["etc"]), ["/", "link", "passwd"])
+        # And the changes are packed into the next one
+        compact = RemoteEditCompactCat.RemoteEditCompactCat.build(root)
+        self.assertEqual(sorted(compact.root()["etc"]), ["/", "link", "passwd"])
+
+    def test_is_compact_cat(self):
+        self.save()
+        self.assertTrue(RemoteEditCompactCat.is_compact_cat(self.path))
+        with open(self.path, "wb") as f:
+            f.write(b"\x80\x03}q\x00")
+        self.assertFalse(RemoteEditCompactCat.is_compact_cat(self.path))
+
+    def test_truncated(self):
+        self.save()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for length in [0, 10, RemoteEditCompactCat.HEADER.size + 1, len(data) - 1]:
+            with open(self.path, "wb") as f:
+                f.write(data[0:length])
+            self.assertTrue(RemoteEditCompactCat.is_compact_cat(self.path))
+            with self.assertRaises(ValueError):
+                self.load()
+
+    def test_damaged_meta(self):
+        self.save()
+        self.damage(RemoteEditCompactCat.HEADER.size + 2)
+        with self.assertRaisesRegex(ValueError, "Checksum"):
+            self.load()
+
+    def test_other_version(self):
+        self.save()
+        self.damage(len(RemoteEditCompactCat.MAGIC))
+        with self.assertRaisesRegex(ValueError, "Version"):
+            self.load()
+
+    def test_damaged_array_found_when_used(self):
+        self.save()
+        # flags is the last array, the file ends with it and its padding
+        self.damage(-8)
+        compact = self.load()
+        root = compact.root()
+        with self.assertRaisesRegex(ValueError, "flags"):
+            root["etc"]["/"]
+        # Still damaged the next time rather than half checked
+        with self.assertRaisesRegex(ValueError, "flags"):
+            compact.flags
+
+    def test_arrays_checked_lazily(self):
+        self.save()
+        compact = self.load()
+        self.assertEqual(len(compact.unchecked), 12)
+        compact.root()["etc"]
+        self.assertNotIn("names", compact.unchecked)
+        self.assertIn("mtimes", compact.unchecked)
+
+    def test_nodes_outlive_close(self):
+        self.save()
+        compact = self.load()
+        root = compact.root()
+        etc = root["etc"]
+        etc["/"]
+        compact.close()
+        self.assertIsNone(compact.mapped)
+        self.assertEqual(etc["hosts"]["/"][4], 12)
+        self.assertEqual(root["home"]["/"][5], 500)
+        # The file can go now nothing's mapping it
+        os.remove(self.path)
+
+    def test_save_over_a_mapped_one(self):
+        self.save()
+        root = self.load().root()
+        cat = make_cat()
+        cat["new"] = {"/": [1, 0o644, 0, 0, 1, 1]}
+        self.save(cat)
+        self.assertNotIn("new", root)
+        self.assertIn("new", self.load().root())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# coding=utf-8
+import os
+import shutil
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from remote_edit import RemoteEditConnectionWorker  # noqa: E402
+
+
+def make_connection(appType):
+    c = RemoteEditConnectionWorker.RemoteEditConnectionBase()
+    c.config(0, appType, None, "linux")
+    c.work = {"cmd": None}
+    c.reset_response()
+    c.reset_decoders()
+    return c
+
+
+@unittest.skipUnless(shutil.which("bash"), "needs bash")
+class SshFramingTest(unittest.TestCase):
+    # Framed commands run through a local shell, as they would be over ssh
+
+    def run_framed(self, cmd, chunkSize=None):
+        c = make_connection("ssh")
+        (framed, markers) = c.frame_commands(cmd)
+        p = subprocess.run(
+            ["bash", "--norc", "--noprofile"],
+            input=framed.encode("utf-8"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        out = p.stdout
+        chunkSize = chunkSize or len(out) or 1
+        found = False
+        # As the reader threads would hand it over
+        for i in range(0, len(out), chunkSize):
+            self.assertFalse(found, "end marker found early")
+            c.add_response("out", out[i:i + chunkSize])
+            found = c.find_end_marker(markers[-1])
+        c.add_response("err", p.stderr)
+        self.assertTrue(found or c.find_end_marker(markers[-1]))
+        c.decode_response()
+        c.split_response(markers)
+        return c
+
+    def test_single_command(self):
+        c = self.run_framed("echo hello; echo oops >&2; false")
+        self.assertEqual(c.lastOut, "hello\n")
+        self.assertIn("oops", c.lastErr)
+        self.assertEqual(c.exitStatus, 1)
+        self.assertIsNone(c.batchResults)
+
+    def test_marker_split_across_reads(self):
+        for chunkSize in [1, 3, 7]:
+            c = self.run_framed("printf 'a\\nb'", chunkSize)
+            self.assertEqual(c.lastOut, "a\nb")
+            self.assertEqual(c.exitStatus, 0)
+
+    def test_multibyte_split_across_reads(self):
+        c = self.run_framed("echo café", 1)
+        self.assertEqual(c.lastOut, "café\n")
+
+    def test_batch(self):
+        c = self.run_framed([
+            "echo one",
+            "echo two >&2; exit_two() { return 2; }; exit_two",
+            "echo three"
+        ])
+        self.assertEqual(
+            [(r["out"], r["err"], r["exit_status"]) for r in c.batchResults],
+            [("one\n", "", 0), ("", "two\n", 2), ("three\n", "", 0)]
+        )
+        self.assertEqual(c.lastOut, "one\nthree\n")
+        self.assertEqual(c.exitStatus, 0)
+
+    def test_echoed_command_isnt_the_marker(self):
+        # Should the shell echo what it's sent, the quotes in the framing
+        # keep the echo from matching
+        c = make_connection("ssh")
+        (framed, markers) = c.frame_commands("true")
+        c.add_response("out", framed.encode("utf-8"))
+        self.assertFalse(c.find_end_marker(markers[-1]))
+
+
+class SftpFramingTest(unittest.TestCase):
+    # The sftp binary, which echoes what it's sent and can't echo markers
+
+    def test_cut_response(self):
+        c = make_connection("sftp")
+        (framed, markers) = c.frame_commands("ls /a")
+        marker = markers[-1]
+        out = "sftp> ls /a\n/a/b\n/a/c\nsftp> ls /%sE\n" % marker
+        err = "Can't ls: \"/%sE\" not found\n" % marker
+        c.add_response("out", out.encode("utf-8"))
+        self.assertFalse(c.find_end_marker(marker))
+        c.add_response("err", err.encode("utf-8"))
+        self.assertTrue(c.find_end_marker(marker))
+        c.decode_response()
+        c.split_response(markers)
+        self.assertEqual(c.lastOut, "sftp> ls /a\n/a/b\n/a/c\n")
+        self.assertEqual(c.lastErr, "")
+        self.assertEqual(c.exitStatus, 0)
+
+    def test_error_before_marker(self):
+        c = make_connection("sftp")
+        (framed, markers) = c.frame_commands("rm /x")
+        marker = markers[-1]
+        c.lastOut = "sftp> rm /x\nsftp> ls /%sE\n" % marker
+        c.lastErr = "Couldn't delete file: No such file\nCan't ls: \"/%sE\"\n" % marker
+        c.split_response(markers)
+        self.assertEqual(c.lastErr, "Couldn't delete file: No such file")
+        self.assertEqual(c.exitStatus, 1)
+
+
+class IdempotentTest(unittest.TestCase):
+
+    def test_commands(self):
+        c = make_connection("ssh")
+        self.assertTrue(c.is_idempotent("ls -la /a; cat /a/b | grep x"))
+        self.assertFalse(c.is_idempotent("ls; rm /a"))
+        self.assertFalse(c.is_idempotent("echo x >> /a"))
+        self.assertTrue(c.is_idempotent(["cd /a", "ls"]))
+        c.work["idempotent"] = True
+        self.assertTrue(c.is_idempotent("rm /a"))
+
+    def test_sftp(self):
+        c = make_connection("sftpv3")
+        self.assertTrue(c.is_idempotent("get /a /tmp/a"))
+        self.assertFalse(c.is_idempotent("put /tmp/a /a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
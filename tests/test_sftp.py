@@ -0,0 +1,157 @@
+# coding=utf-8
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from remote_edit import RemoteEditSftpWorker as S  # noqa: E402
+from remote_edit.RemoteEditSftpWorker import split_args  # noqa: E402
+
+
+def attrs(size=None, uid=None, permissions=None, mtime=None, extended=None):
+    flags = 0
+    data = b""
+    if size is not None:
+        flags |= S.SSH_FILEXFER_ATTR_SIZE
+        data += struct.pack(">Q", size)
+    if uid is not None:
+        flags |= S.SSH_FILEXFER_ATTR_UIDGID
+        data += struct.pack(">II", uid, uid + 1)
+    if permissions is not None:
+        flags |= S.SSH_FILEXFER_ATTR_PERMISSIONS
+        data += struct.pack(">I", permissions)
+    if mtime is not None:
+        flags |= S.SSH_FILEXFER_ATTR_ACMODTIME
+        data += struct.pack(">II", mtime - 1, mtime)
+    if extended is not None:
+        flags |= S.SSH_FILEXFER_ATTR_EXTENDED
+        data += struct.pack(">I", len(extended))
+        for (k, v) in extended:
+            data += S.string(k) + S.string(v)
+    return struct.pack(">I", flags) + data
+
+
+class SplitArgsTest(unittest.TestCase):
+    # What RemoteEditCommand.escape_remote_path makes of a path, split back
+
+    def test_plain(self):
+        self.assertEqual(split_args("get /a/b /tmp/b"), ["get", "/a/b", "/tmp/b"])
+        self.assertEqual(split_args("  rm \t /a  "), ["rm", "/a"])
+
+    def test_quoted(self):
+        self.assertEqual(
+            split_args("rename \"/a b/c\" \"/d e\""),
+            ["rename", "/a b/c", "/d e"]
+        )
+        self.assertEqual(split_args("put x \"/a  b\""), ["put", "x", "/a  b"])
+
+    def test_escaped_quotes(self):
+        # Quotes inside a path are doubled, quoted or not
+        self.assertEqual(split_args("rm /a\"\"b"), ["rm", "/a\"b"])
+        self.assertEqual(split_args("rm /a\"\""), ["rm", "/a\""])
+        self.assertEqual(
+            split_args("rm \"/a \"\"b\"\" c\""),
+            ["rm", "/a \"b\" c"]
+        )
+        self.assertEqual(split_args("rm \"a \"\"\""), ["rm", "a \""])
+
+    def test_leading_quotes(self):
+        # A path that starts with a quote
+        self.assertEqual(split_args("rm \"\"a"), ["rm", "\"a"])
+        self.assertEqual(split_args("rm \"\"\"\"a x"), ["rm", "\"\"a", "x"])
+        self.assertEqual(split_args("rm \"\"\"a b\""), ["rm", "\"a b"])
+        self.assertEqual(split_args("rm \"\"\"a b\"\"\""), ["rm", "\"a b\""])
+        self.assertEqual(split_args("\"\"a"), ["\"a"])
+
+    def test_ls_flags_dropped(self):
+        self.assertEqual(split_args("ls -la \"/a b\""), ["ls", "/a b"])
+        self.assertEqual(split_args("rm -x"), ["rm", "-x"])
+
+
+class SftpReaderTest(unittest.TestCase):
+
+    def test_fields(self):
+        r = S.SftpReader(
+            struct.pack(">IQ", 7, 2 ** 40) + S.string(b"name") + b"rest"
+        )
+        self.assertEqual(r.uint32(), 7)
+        self.assertEqual(r.uint64(), 2 ** 40)
+        self.assertEqual(r.string(), b"name")
+        self.assertEqual(r.pos, 4 + 8 + 8)
+
+    def test_attrs(self):
+        r = S.SftpReader(attrs(size=10, uid=5, permissions=0o100644, mtime=99))
+        self.assertEqual(r.attrs(), {
+            "size": 10,
+            "uid": 5,
+            "gid": 6,
+            "permissions": 0o100644,
+            "atime": 98,
+            "mtime": 99
+        })
+        self.assertEqual(S.SftpReader(attrs()).attrs(), {})
+
+    def test_extended_attrs_skipped(self):
+        r = S.SftpReader(
+            attrs(size=1, extended=[(b"a@b", b"x"), (b"c@d", b"")]) + b"\0\0\0\1"
+        )
+        self.assertEqual(r.attrs(), {"size": 1})
+        self.assertEqual(r.uint32(), 1)
+
+    def test_short_packet(self):
+        # struct.error is what the worker takes as a lost connection
+        with self.assertRaises(struct.error):
+            S.SftpReader(b"\0\0").uint32()
+        with self.assertRaises(struct.error):
+            S.SftpReader(attrs(size=10)[0:8]).attrs()
+
+
+class SftpSessionTest(unittest.TestCase):
+    # Against canned replies rather than a server
+
+    def setUp(self):
+        self.sent = []
+        self.replies = bytearray()
+        self.session = S.SftpSession(self.sent.append, self.read)
+
+    def read(self, n):
+        data = bytes(self.replies[0:n])
+        del self.replies[0:n]
+        return data
+
+    def reply(self, t, rid, payload):
+        self.replies.extend(self.session.packet(t, struct.pack(">I", rid) + payload))
+
+    def test_init(self):
+        self.replies.extend(self.session.packet(S.SSH_FXP_VERSION, struct.pack(">I", 3)))
+        self.assertEqual(self.session.init(), 3)
+        self.assertEqual(self.sent, [b"\0\0\0\5\1\0\0\0\3"])
+
+    def test_stat(self):
+        self.reply(S.SSH_FXP_ATTRS, 1, attrs(size=3))
+        self.assertEqual(self.session.stat("/a b"), {"size": 3})
+        self.assertEqual(
+            self.sent,
+            [self.session.packet(S.SSH_FXP_STAT, struct.pack(">I", 1) + S.string(b"/a b"))]
+        )
+
+    def test_replies_matched_by_id(self):
+        self.reply(S.SSH_FXP_ATTRS, 7, attrs(size=7))
+        self.reply(S.SSH_FXP_ATTRS, 1, attrs(size=1))
+        self.assertEqual(self.session.stat("/a"), {"size": 1})
+
+    def test_error_status(self):
+        self.reply(
+            S.SSH_FXP_STATUS,
+            1,
+            struct.pack(">I", S.SSH_FX_NO_SUCH_FILE) + S.string(b"gone") + S.string(b"")
+        )
+        with self.assertRaises(S.SftpError) as e:
+            self.session.stat("/a")
+        self.assertEqual(e.exception.code, S.SSH_FX_NO_SUCH_FILE)
+
+
+if __name__ == "__main__":
+    unittest.main()
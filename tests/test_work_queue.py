@@ -0,0 +1,140 @@
+# coding=utf-8
+import os
+import queue
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from remote_edit import RemoteEditFuture, RemoteEditWorkerPool  # noqa: E402
+
+
+def work(name, priority=None, waited=0):
+    return {
+        "cmd": name,
+        "priority": priority,
+        "queued_at": time.time() - waited
+    }
+
+
+class RemoteEditWorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = RemoteEditWorkerPool.RemoteEditWorkQueue(starveAfter=10)
+
+    def take_all(self, interactiveOnly=False):
+        taken = []
+        while True:
+            w = self.queue.take(interactiveOnly)
+            if w is None:
+                return taken
+            taken.append(w["cmd"])
+
+    def test_priority_order(self):
+        self.queue.put(work("background", "background"))
+        self.queue.put(work("normal"))
+        self.queue.put(work("interactive", "interactive"))
+        self.queue.put(work("normal 2", "normal"))
+        self.assertEqual(self.queue.qsize(), 4)
+        self.assertEqual(
+            [w["cmd"] for w in self.queue.items()],
+            ["interactive", "normal", "normal 2", "background"]
+        )
+        self.assertEqual(
+            self.take_all(),
+            ["interactive", "normal", "normal 2", "background"]
+        )
+        self.assertTrue(self.queue.empty())
+
+    def test_aging(self):
+        # Waited three classes' worth, so ahead of fresh interactive work
+        self.queue.put(work("interactive", "interactive"))
+        self.queue.put(work("background", "background", waited=31))
+        self.assertEqual(self.take_all(), ["background", "interactive"])
+        # Two classes' worth gets it ahead of fresh normal work, but only
+        # level with interactive work and the higher class goes first then
+        self.queue.put(work("normal"))
+        self.queue.put(work("background", "background", waited=21))
+        self.queue.put(work("interactive", "interactive"))
+        self.assertEqual(self.take_all(), ["interactive", "background", "normal"])
+        self.queue.put(work("background", "background", waited=11))
+        self.queue.put(work("normal"))
+        self.assertEqual(self.take_all(), ["normal", "background"])
+
+    def test_interactive_only(self):
+        self.queue.put(work("normal"))
+        self.queue.put(work("background", "background", waited=100))
+        self.assertEqual(self.take_all(interactiveOnly=True), [])
+        self.queue.put(work("interactive", "interactive"))
+        self.assertEqual(self.take_all(interactiveOnly=True), ["interactive"])
+        self.assertEqual(self.queue.qsize(), 2)
+
+    def test_get_times_out(self):
+        started = time.time()
+        with self.assertRaises(queue.Empty):
+            self.queue.get(0.05)
+        self.assertGreaterEqual(time.time() - started, 0.05)
+
+    def test_get_wakes_for_work(self):
+        threading.Timer(0.05, self.queue.put, [work("late")]).start()
+        self.assertEqual(self.queue.get(5)["cmd"], "late")
+
+    def test_put_none_wakes_one(self):
+        self.queue.put(None)
+        self.assertIsNone(self.queue.get(0))
+        with self.assertRaises(queue.Empty):
+            self.queue.get(0)
+
+
+class RemoteEditFutureTest(unittest.TestCase):
+
+    def test_result(self):
+        future = RemoteEditFuture.RemoteEditFuture("key")
+        self.assertFalse(future.done())
+        self.assertIsNone(future.result(0.01))
+        future.set_result({"success": True})
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(0), {"success": True})
+        # Only the first result counts
+        future.set_result({"success": False})
+        self.assertEqual(future.result(0), {"success": True})
+
+    def test_result_from_another_thread(self):
+        future = RemoteEditFuture.RemoteEditFuture()
+        threading.Timer(0.05, future.set_result, [{"success": True}]).start()
+        self.assertEqual(future.result(5), {"success": True})
+
+    def test_callbacks(self):
+        future = RemoteEditFuture.RemoteEditFuture()
+        called = []
+        future.add_done_callback(called.append)
+        self.assertEqual(called, [])
+        future.set_result({"success": True})
+        self.assertEqual(called, [future])
+        # Added once it's done it's called straight away
+        future.add_done_callback(called.append)
+        self.assertEqual(called, [future, future])
+
+    def test_cancel(self):
+        future = RemoteEditFuture.RemoteEditFuture()
+        called = []
+        future.add_done_callback(called.append)
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled)
+        self.assertTrue(future.result(0)["cancelled"])
+        self.assertFalse(future.result(0)["success"])
+        self.assertEqual(called, [future])
+        self.assertFalse(future.cancel())
+
+    def test_cancel_once_done(self):
+        future = RemoteEditFuture.RemoteEditFuture()
+        future.set_result({"success": True})
+        self.assertFalse(future.cancel())
+        self.assertFalse(future.cancelled)
+        self.assertTrue(future.result(0)["success"])
+
+
+if __name__ == "__main__":
+    unittest.main()